@@ -1,2 +1,2 @@
 from .src.flamingo import Flamingo
-from .src.factory import create_model_and_transforms
+from .src.factory import create_model_and_transforms, quantize_model
@@ -366,6 +366,27 @@ parser.add_argument(
     default=None,
 )
 
+# Device arguments
+parser.add_argument(
+    "--device",
+    type=str,
+    default=None,
+    choices=["cuda", "cpu"],
+    help="Device to evaluate on. Defaults to cuda if available. CPU evaluation does not wrap the model in DDP.",
+)
+parser.add_argument(
+    "--num_threads",
+    type=int,
+    default=None,
+    help="Number of intra-op CPU threads per process. When evaluating on CPU, defaults to the number of cores divided by the number of local processes.",
+)
+parser.add_argument(
+    "--num_interop_threads",
+    type=int,
+    default=None,
+    help="Number of inter-op CPU threads per process.",
+)
+
 # Distributed evaluation
 parser.add_argument(
     "--dist-url",
@@ -382,6 +403,13 @@ parser.add_argument(
     action="store_true",
     help="Use horovod for distributed training.",
 )
+parser.add_argument(
+    "--profile_dir",
+    type=str,
+    default=None,
+    help="Profile the vision encoder, perceiver, cross attention and decoder layers over the whole evaluation, "
+    "and save each rank's summary and Chrome trace to this directory.",
+)
 parser.add_argument(
     "--no-set-device-rank",
     default=False,
@@ -392,6 +420,16 @@ parser.add_argument(
 
 def main():
     args, leftovers = parser.parse_known_args()
+    use_cpu = args.device == "cpu" or not torch.cuda.is_available()
+    # the CPU thread pools only matter for CPU evaluation, unless set explicitly
+    if use_cpu or args.num_threads is not None or args.num_interop_threads is not None:
+        utils.set_num_threads(
+            args.num_threads,
+            args.num_interop_threads,
+            local_world_size=int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+            if use_cpu
+            else 1,
+        )
     module = importlib.import_module(f"open_flamingo.eval.models.{args.model}")
 
     model_args = {
@@ -401,9 +439,22 @@ def main():
 
     # set up distributed evaluation
     args.local_rank, args.rank, args.world_size = world_info_from_env()
+    if use_cpu:
+        # nccl requires GPUs; the process group is only used to gather predictions
+        args.dist_backend = "gloo"
     device_id = init_distributed_device(args)
-    eval_model.set_device(device_id)
-    eval_model.init_distributed()
+    if use_cpu:
+        eval_model.set_device(torch.device("cpu"))
+    else:
+        eval_model.set_device(device_id)
+        eval_model.init_distributed()
+
+    profiler = None
+    if args.profile_dir is not None:
+        model = utils.unwrap_model(eval_model.model)
+        assert isinstance(model, Flamingo), "Profiling requires an OpenFlamingo model."
+        profiler = model.profile()
+        profiler.start()
 
     if args.model != "open_flamingo" and args.shots != [0]:
         raise ValueError("Only 0 shot eval is supported for non-open_flamingo models")
@@ -724,6 +775,14 @@ def main():
         with open(args.results_file, "w") as f:
             json.dump(results, f)
 
+    if profiler is not None:
+        profiler.stop()
+        os.makedirs(args.profile_dir, exist_ok=True)
+        profiler.save_json(os.path.join(args.profile_dir, f"profile_{args.rank}.json"))
+        profiler.save_chrome_trace(
+            os.path.join(args.profile_dir, f"trace_{args.rank}.json")
+        )
+
 
 def evaluate_captioning(
     args: argparse.Namespace,
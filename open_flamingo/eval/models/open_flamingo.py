@@ -5,7 +5,7 @@ import torch
 from einops import repeat
 
 from open_flamingo.eval.eval_model import BaseEvalModel
-from open_flamingo.src.factory import create_model_and_transforms
+from open_flamingo.src.factory import create_model_and_transforms, quantize_model
 from open_flamingo.eval.utils import unwrap_model, get_autocast, get_cast_dtype
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
@@ -16,7 +16,7 @@ class EvalModel(BaseEvalModel):
     Attributes:
       model (nn.Module): Underlying Torch model.
       tokenizer (transformers.PreTrainedTokenizer): Tokenizer for model.
-      device: Index of GPU to use, or the string "CPU"
+      device: Index of GPU to use, or the string "cpu"
     """
 
     def __init__(self, model_args):
@@ -30,11 +30,9 @@ class EvalModel(BaseEvalModel):
             and "precision" in model_args
         ), "OpenFlamingo requires vision_encoder_path, lm_path, device, checkpoint_path, lm_tokenizer_path, cross_attn_every_n_layers, vision_encoder_pretrained, and precision arguments to be specified"
 
-        self.device = (
-            model_args["device"]
-            if ("device" in model_args and model_args["device"] >= 0)
-            else "cpu"
-        )
+        # device is a GPU index, or "cpu" / a negative index for CPU
+        device = model_args.get("device", -1)
+        self.device = "cpu" if str(device) == "cpu" or int(device) < 0 else int(device)
 
         (
             self.model,
@@ -46,21 +44,98 @@ class EvalModel(BaseEvalModel):
             model_args["lm_path"],
             model_args["lm_tokenizer_path"],
             cross_attn_every_n_layers=int(model_args["cross_attn_every_n_layers"]),
+            checkpoint_path=model_args["checkpoint_path"],
         )
-        checkpoint = torch.load(model_args["checkpoint_path"], map_location=self.device)
-        if "model_state_dict" in checkpoint:
-            checkpoint = checkpoint["model_state_dict"]
-            checkpoint = {k.replace("module.", ""): v for k, v in checkpoint.items()}
-        self.model.load_state_dict(checkpoint, strict=False)
         self.model.to(self.device)
         self.model.eval()
+
+        # optionally skip the gated cross attention layers with near-zero gates
+        if (
+            "cross_attn_gate_threshold" in model_args
+            or "num_cross_attn_layers" in model_args
+        ):
+            threshold = model_args.get("cross_attn_gate_threshold", None)
+            num_layers = model_args.get("num_cross_attn_layers", None)
+            self.skipped_cross_attn_layers = self.model.skip_cross_attn_layers(
+                threshold=float(threshold) if threshold is not None else None,
+                num_layers=int(num_layers) if num_layers is not None else None,
+            )
+            print(
+                f"Skipped the cross attention of decoder layers {self.skipped_cross_attn_layers}"
+            )
+
+        # optionally fold gates, layer norms and attention scales into the weights
+        self.freeze_for_inference = (
+            str(model_args.get("freeze_for_inference", False)).lower() == "true"
+        )
+        if self.freeze_for_inference:
+            self.model.freeze_for_inference()
+
+        # optional int8 quantization: "dynamic_int8" (CPU only) or "weight_only_int8"
+        self.quantize = model_args.get("quantize", None)
+        if self.quantize is not None:
+            assert self.quantize in (
+                "dynamic_int8",
+                "weight_only_int8",
+            ), "quantize must be one of dynamic_int8, weight_only_int8"
+            self._check_quantize_device(self.device)
+            quantize_model(
+                self.model, weight_only=(self.quantize == "weight_only_int8")
+            )
         self.tokenizer.padding_side = "left"
 
         self.lm_name = model_args["lm_path"].split("/")[-1]
 
+        # channels last memory format for the vision encoder convolutions
+        if str(model_args.get("channels_last", False)).lower() == "true":
+            self.model.vision_encoder.to(memory_format=torch.channels_last)
+
+        # optional visual token budgets: num_latents per image, and num_query_latents for
+        # the query image; "pool" or "select" latent_reduction
+        self.num_latents = None
+        if "num_latents" in model_args or "num_query_latents" in model_args:
+            num_latents = int(
+                model_args.get("num_latents", self.model.perceiver.latents.shape[0])
+            )
+            num_query_latents = model_args.get("num_query_latents", None)
+            self.num_latents = (
+                num_latents
+                if num_query_latents is None
+                else (num_latents, int(num_query_latents))
+            )
+        self.model.latent_reduction = model_args.get("latent_reduction", "pool")
+
+        # optionally store each prompt's keys / values once for all of its beams
+        self.share_prompt_across_beams = (
+            str(model_args.get("share_prompt_across_beams", False)).lower() == "true"
+        )
+
+        # optionally prefill long prompts in chunks of this many tokens
+        self.prefill_chunk_size = (
+            int(model_args["prefill_chunk_size"])
+            if "prefill_chunk_size" in model_args
+            else None
+        )
+
         # autocast
-        self.autocast = get_autocast(model_args["precision"])
-        self.cast_dtype = get_cast_dtype(model_args["precision"])
+        self.precision = model_args["precision"]
+        self.autocast = get_autocast(
+            self.precision, device_type=torch.device(self.device).type
+        )
+        self.cast_dtype = get_cast_dtype(self.precision)
+
+    def _check_quantize_device(self, device):
+        assert (
+            self.quantize != "dynamic_int8" or torch.device(device).type == "cpu"
+        ), "dynamic_int8 quantization is only supported on CPU"
+
+    def set_device(self, device):
+        # the model is created on the device in model_args, and may be moved later
+        self._check_quantize_device(device)
+        super().set_device(device)
+        self.autocast = get_autocast(
+            self.precision, device_type=torch.device(device).type
+        )
 
     def _prepare_images(self, batch: List[List[Image.Image]]) -> torch.Tensor:
         """
@@ -89,6 +164,25 @@ class EvalModel(BaseEvalModel):
             )
         return batch_images
 
+    def _prepare_images_mask(self, batch: List[List[Image.Image]]) -> torch.Tensor:
+        """
+        Mark which images of _prepare_images(batch) are not zero-padding.
+        Returns:
+            images mask (tensor) or None
+                shape (B, T_img)
+                None if no images in batch
+        """
+        images_per_example = max(len(x) for x in batch)
+        if images_per_example == 0:
+            return None
+        return torch.tensor(
+            [
+                [i < len(example) for i in range(images_per_example)]
+                for example in batch
+            ],
+            device=self.device,
+        )
+
     def _prepare_text(
         self,
         batch: List[List[str]],
@@ -132,6 +226,7 @@ class EvalModel(BaseEvalModel):
         """
         Get generation outputs.
         """
+        batch_images_mask = self._prepare_images_mask(batch_images)
         batch_images = self._prepare_images(batch_images)
         input_ids, attention_mask = self._prepare_text(batch_text)
 
@@ -141,10 +236,14 @@ class EvalModel(BaseEvalModel):
                     batch_images,
                     input_ids,
                     attention_mask,
+                    vision_x_mask=batch_images_mask,
+                    num_latents=self.num_latents,
                     min_new_tokens=min_generation_length,
                     max_new_tokens=max_generation_length,
                     num_beams=num_beams,
                     length_penalty=length_penalty,
+                    share_prompt_across_beams=self.share_prompt_across_beams,
+                    prefill_chunk_size=self.prefill_chunk_size,
                 )
 
         # Extract only the new gnerated tokens
@@ -163,6 +262,7 @@ class EvalModel(BaseEvalModel):
         """
         Returns a (B, |all_class_names|) tensor containing the logprobs for each class name.
         """
+        batch_images_mask = self._prepare_images_mask(batch_images)
         batch_images = self._prepare_images(batch_images)
         ctx_input_ids, ctx_attention_mask = self._prepare_text(batch_text)
 
@@ -172,6 +272,7 @@ class EvalModel(BaseEvalModel):
             self.cache_media(
                 input_ids=ctx_input_ids,
                 vision_x=batch_images,
+                vision_x_mask=batch_images_mask,
             )
             precomputed = self.__call__(
                 vision_x=None,
@@ -212,10 +313,12 @@ class EvalModel(BaseEvalModel):
                     dim=1,
                 )
                 _vision_x = batch_images
+                _vision_x_mask = batch_images_mask
             else:
                 _lang_x = classname_tokens
                 _attention_mask = None
                 _vision_x = None
+                _vision_x_mask = None
 
             # Call forward to get the logits
             outputs = self.__call__(
@@ -224,6 +327,7 @@ class EvalModel(BaseEvalModel):
                 attention_mask=_attention_mask,
                 clear_conditioned_layers=(not use_cache),
                 past_key_values=precomputed_pkvs,
+                vision_x_mask=_vision_x_mask,
             )
 
             # Get the logits of the classname
@@ -261,6 +365,7 @@ class EvalModel(BaseEvalModel):
         past_key_values: torch.Tensor = None,
         clear_conditioned_layers: bool = False,
         use_cache: bool = False,
+        vision_x_mask: torch.Tensor = None,
     ):
         """
         Calls the forward function of the model.
@@ -280,6 +385,8 @@ class EvalModel(BaseEvalModel):
                         clear_conditioned_layers=clear_conditioned_layers,
                         past_key_values=past_key_values,
                         use_cache=use_cache,
+                        vision_x_mask=vision_x_mask,
+                        num_latents=self.num_latents,
                     )
             return outputs
 
@@ -301,6 +408,8 @@ class EvalModel(BaseEvalModel):
                         clear_conditioned_layers=False,
                         past_key_values=past_key_values,
                         use_cache=True,
+                        vision_x_mask=vision_x_mask,
+                        num_latents=self.num_latents,
                     )
 
             past_key_values = outputs.past_key_values
@@ -318,8 +427,13 @@ class EvalModel(BaseEvalModel):
     def uncache_media(self):
         unwrap_model(self.model).uncache_media()
 
-    def cache_media(self, input_ids, vision_x):
-        unwrap_model(self.model).cache_media(input_ids=input_ids, vision_x=vision_x)
+    def cache_media(self, input_ids, vision_x, vision_x_mask=None):
+        unwrap_model(self.model).cache_media(
+            input_ids=input_ids,
+            vision_x=vision_x,
+            vision_x_mask=vision_x_mask,
+            num_latents=self.num_latents,
+        )
 
     def get_vqa_prompt(self, question, answer=None) -> str:
         return f"<image>Question:{question} Short answer:{answer if answer is not None else ''}{'<|endofchunk|>' if answer is not None else ''}"
@@ -1,8 +1,8 @@
-import open_clip
 import torch
 from tqdm import tqdm
 import torch
 from utils import custom_collate_fn
+from open_flamingo.src.factory import create_vision_encoder_and_transforms
 
 
 class RICES:
@@ -19,10 +19,10 @@ class RICES:
         self.device = device
         self.batch_size = batch_size
 
-        # Load the model and processor
-        vision_encoder, _, image_processor = open_clip.create_model_and_transforms(
+        # Load the model and processor. Only the visual tower is needed to embed images.
+        vision_encoder, image_processor = create_vision_encoder_and_transforms(
             vision_encoder_path,
-            pretrained=vision_encoder_pretrained,
+            vision_encoder_pretrained,
         )
         self.model = vision_encoder.to(self.device)
         self.image_processor = image_processor
@@ -55,7 +55,7 @@ class RICES:
                 inputs = torch.stack(
                     [self.image_processor(image) for image in batch]
                 ).to(self.device)
-                image_features = self.model.encode_image(inputs)
+                image_features = self.model(inputs)
                 image_features /= image_features.norm(dim=-1, keepdim=True)
                 features.append(image_features.detach())
 
@@ -75,7 +75,7 @@ class RICES:
             )
 
             # Get the feature of the input image
-            query_feature = self.model.encode_image(inputs)
+            query_feature = self.model(inputs)
             query_feature /= query_feature.norm(dim=-1, keepdim=True)
             query_feature = query_feature.detach().cpu()
 
@@ -1,3 +1,5 @@
+import os
+
 import numpy as np
 import torch
 import random
@@ -114,11 +116,31 @@ def get_cast_dtype(precision: str):
     return cast_dtype
 
 
-def get_autocast(precision):
+def get_autocast(precision, device_type="cuda"):
+    """
+    Returns a function creating the autocast context for precision on device_type.
+    On CPU, "amp" autocasts to bfloat16, the lower precision CPU kernels support.
+    """
     if precision == "amp":
-        return torch.cuda.amp.autocast
+        dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+        return lambda: torch.autocast(device_type, dtype=dtype)
     elif precision == "amp_bfloat16" or precision == "amp_bf16":
         # amp_bfloat16 is more stable than amp float16 for clip training
-        return lambda: torch.cuda.amp.autocast(dtype=torch.bfloat16)
+        return lambda: torch.autocast(device_type, dtype=torch.bfloat16)
     else:
         return suppress
+
+
+def set_num_threads(num_threads=None, num_interop_threads=None, local_world_size=1):
+    """
+    Configure the intra-op and inter-op thread pools of this process for CPU inference.
+    If num_threads is not given and several processes share the machine, the cores are
+    split evenly between them instead of every process using all of them.
+    Must be called before running any torch ops: the inter-op pool can only be set once.
+    """
+    if num_threads is None and local_world_size > 1:
+        num_threads = max(1, (os.cpu_count() or 1) // local_world_size)
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        torch.set_num_interop_threads(num_interop_threads)
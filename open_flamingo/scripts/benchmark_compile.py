@@ -0,0 +1,149 @@
+"""
+Compare the prefill and decode throughput of an OpenFlamingo checkpoint in eager mode and
+after Flamingo.compile() on synthetic inputs, e.g.
+
+python open_flamingo/scripts/benchmark_compile.py --device cpu --num_text_tokens 200 ...
+
+Prefill throughput is measured on forward passes over the prompt, decode throughput on
+greedy generate() calls, from which the prefill time is subtracted. The first calls of the
+compiled model compile the graphs for the input shapes, so they are excluded as warmup.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+    )
+)
+from open_flamingo.src.factory import create_model_and_transforms
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--num_images", type=int, default=3, help="images per prompt")
+parser.add_argument("--num_text_tokens", type=int, default=200)
+parser.add_argument("--max_new_tokens", type=int, default=32)
+parser.add_argument("--num_warmup", type=int, default=3)
+parser.add_argument("--num_repeats", type=int, default=10)
+parser.add_argument("--device", type=str, default="cpu", help="GPU index, or cpu")
+parser.add_argument(
+    "--compile_mode",
+    type=str,
+    default=None,
+    help="mode passed to torch.compile, e.g. max-autotune",
+)
+parser.add_argument(
+    "--freeze_for_inference",
+    action="store_true",
+    help="fold gates, layer norms and attention scales into the weights first",
+)
+
+# Model arguments
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument(
+    "--lm_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument(
+    "--lm_tokenizer_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--checkpoint_path", type=str, required=True)
+
+
+def measure_throughput(model, vision_x, lang_x, args):
+    """
+    Median prefill and decode throughput on the synthetic inputs, in tokens per second.
+    """
+    device = vision_x.device
+
+    def timed(fn):
+        latencies = []
+        for _ in range(args.num_warmup + args.num_repeats):
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            latencies.append(time.perf_counter() - start)
+        return float(np.median(latencies[args.num_warmup :]))
+
+    with torch.inference_mode():
+        prefill = timed(lambda: model(vision_x, lang_x))
+        generate = timed(
+            lambda: model.generate(
+                vision_x,
+                lang_x,
+                min_new_tokens=args.max_new_tokens,
+                max_new_tokens=args.max_new_tokens,
+                num_beams=1,
+            )
+        )
+    decode = max(generate - prefill, 1e-9)
+    return {
+        "prefill": lang_x.numel() / prefill,
+        "decode": args.batch_size * args.max_new_tokens / decode,
+    }
+
+
+def get_synthetic_inputs(model, tokenizer, args, device):
+    """Random images and text with one <image> token per image, evenly spaced."""
+    vision_x = torch.randn(
+        args.batch_size, args.num_images, 1, 3, 224, 224, device=device
+    )
+    lang_x = torch.randint(
+        100, len(tokenizer) - 2, (args.batch_size, args.num_text_tokens), device=device
+    )
+    spacing = args.num_text_tokens // args.num_images
+    lang_x[:, ::spacing][:, : args.num_images] = model.media_token_id
+    return vision_x, lang_x
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device("cpu" if args.device == "cpu" else f"cuda:{args.device}")
+
+    model, image_processor, tokenizer = create_model_and_transforms(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.lm_path,
+        args.lm_tokenizer_path,
+        cross_attn_every_n_layers=args.cross_attn_every_n_layers,
+        checkpoint_path=args.checkpoint_path,
+    )
+    model.to(device)
+    model.eval()
+    if args.freeze_for_inference:
+        model.freeze_for_inference()
+
+    vision_x, lang_x = get_synthetic_inputs(model, tokenizer, args, device)
+    eager = measure_throughput(model, vision_x, lang_x, args)
+    with torch.inference_mode():
+        logits = model(vision_x, lang_x).logits
+
+    compile_kwargs = {"mode": args.compile_mode} if args.compile_mode else {}
+    model.compile(**compile_kwargs)
+    start = time.perf_counter()
+    with torch.inference_mode():
+        compiled_logits = model(vision_x, lang_x).logits
+    print(f"compiled the prefill graphs in {time.perf_counter() - start:.1f}s")
+    compiled = measure_throughput(model, vision_x, lang_x, args)
+
+    for name in ("prefill", "decode"):
+        print(
+            f"{name}: eager {eager[name]:.1f} tokens/s, compiled {compiled[name]:.1f} "
+            f"tokens/s ({compiled[name] / eager[name]:.2f}x)"
+        )
+    print(f"max logit difference {(logits - compiled_logits).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+"""
+Report the gates of each gated cross attention layer of a checkpoint, skip the layers
+with the smallest gates (Flamingo.skip_cross_attn_layers), and compare the predicted
+speedup with the measured one on synthetic inputs, e.g.
+
+python open_flamingo/scripts/benchmark_cross_attn_skipping.py --threshold 0.05 ...
+python open_flamingo/scripts/benchmark_cross_attn_skipping.py --num_layers 12 ...
+
+The predicted speedup counts the FLOPs of the linear layers only, so it ignores the
+attention over the context and kernel launch overheads. To measure the effect on accuracy,
+pass --cross_attn_gate_threshold or --num_cross_attn_layers to evaluate.py.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+    )
+)
+from open_flamingo.src.factory import create_model_and_transforms
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=None,
+    help="skip the layers whose largest |tanh(gate)| is below threshold",
+)
+parser.add_argument(
+    "--num_layers",
+    type=int,
+    default=None,
+    help="keep only the num_layers cross attention layers with the largest gates",
+)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--num_images", type=int, default=5, help="images per prompt")
+parser.add_argument("--num_text_tokens", type=int, default=256)
+parser.add_argument("--max_new_tokens", type=int, default=20)
+parser.add_argument("--num_beams", type=int, default=3)
+parser.add_argument("--num_repeats", type=int, default=10)
+parser.add_argument("--device", type=str, default="0", help="GPU index, or cpu")
+
+# Model arguments
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument(
+    "--lm_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument(
+    "--lm_tokenizer_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--checkpoint_path", type=str, required=True)
+
+
+def count_params(module):
+    return sum(p.numel() for p in module.parameters()) if module is not None else 0
+
+
+def estimate_flops(model, num_text_tokens, num_images, num_vision_tokens):
+    """
+    Rough FLOPs of the linear layers for one forward pass over a single prompt.
+    Returns:
+        dict with the FLOPs of the vision encoder and perceiver ("vision"), the gated
+        cross attention layers ("cross_attn") and the rest of the language model ("lm")
+    """
+    num_latents = model.perceiver.latents.shape[0]
+    vision = 2 * num_images * num_vision_tokens * count_params(model.vision_encoder)
+    vision += (
+        2
+        * num_images
+        * (num_vision_tokens + num_latents)
+        * count_params(model.perceiver)
+    )
+
+    cross_attn = 0
+    for layer in model.lang_encoder.gated_cross_attn_layers:
+        if layer is None:
+            continue
+        # keys / values are projected once per latent, the rest runs once per text token
+        to_kv = count_params(layer.attn.to_kv)
+        cross_attn += 2 * num_images * num_latents * to_kv
+        cross_attn += 2 * num_text_tokens * (count_params(layer) - to_kv)
+
+    lm = (
+        2
+        * num_text_tokens
+        * (
+            sum(count_params(block) for block in model.lang_encoder.old_decoder_blocks)
+            + count_params(model.lang_encoder.get_output_embeddings())
+        )
+    )
+    return {"vision": vision, "cross_attn": cross_attn, "lm": lm}
+
+
+def measure_latency(model, vision_x, lang_x, args):
+    """
+    Median latency of a forward pass and of generate() on the synthetic inputs, in seconds.
+    """
+    device = vision_x.device
+
+    def timed(fn):
+        latencies = []
+        for _ in range(args.num_repeats + 1):
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            latencies.append(time.perf_counter() - start)
+        # the first run is a warmup
+        return float(np.median(latencies[1:]))
+
+    with torch.inference_mode():
+        return {
+            "forward": timed(lambda: model(vision_x, lang_x)),
+            "generate": timed(
+                lambda: model.generate(
+                    vision_x,
+                    lang_x,
+                    min_new_tokens=args.max_new_tokens,
+                    max_new_tokens=args.max_new_tokens,
+                    num_beams=args.num_beams,
+                )
+            ),
+        }
+
+
+def get_synthetic_inputs(model, tokenizer, args, device):
+    """Random images and text with one <image> token per image, evenly spaced."""
+    vision_x = torch.randn(
+        args.batch_size, args.num_images, 1, 3, 224, 224, device=device
+    )
+    lang_x = torch.randint(
+        100, len(tokenizer) - 2, (args.batch_size, args.num_text_tokens), device=device
+    )
+    spacing = args.num_text_tokens // args.num_images
+    lang_x[:, ::spacing][:, : args.num_images] = model.media_token_id
+    return vision_x, lang_x
+
+
+def main():
+    args = parser.parse_args()
+    assert (args.threshold is None) != (
+        args.num_layers is None
+    ), "Pass exactly one of --threshold and --num_layers."
+    device = torch.device("cpu" if args.device == "cpu" else f"cuda:{args.device}")
+
+    model, image_processor, tokenizer = create_model_and_transforms(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.lm_path,
+        args.lm_tokenizer_path,
+        cross_attn_every_n_layers=args.cross_attn_every_n_layers,
+        checkpoint_path=args.checkpoint_path,
+    )
+    model.to(device)
+    model.eval()
+
+    print("gated cross attention layers (tanh of the gates):")
+    for layer_idx, (attn_gate, ff_gate) in model.get_cross_attn_gates().items():
+        print(f"  layer {layer_idx:>3}: attn {attn_gate:+.4f}, ff {ff_gate:+.4f}")
+
+    vision_x, lang_x = get_synthetic_inputs(model, tokenizer, args, device)
+    with torch.inference_mode():
+        num_vision_tokens = model.vision_encoder(vision_x[0, :1, 0])[1].shape[1]
+
+    flops = estimate_flops(
+        model, args.num_text_tokens, args.num_images, num_vision_tokens
+    )
+    # generate() decodes one text token at a time, with the media already projected
+    decode_flops = estimate_flops(model, 1, 0, num_vision_tokens)
+    latency = measure_latency(model, vision_x, lang_x, args)
+    with torch.inference_mode():
+        logits = model(vision_x, lang_x).logits
+
+    skipped = model.skip_cross_attn_layers(
+        threshold=args.threshold, num_layers=args.num_layers
+    )
+    print(
+        f"skipped the cross attention of {len(skipped)} decoder layers: {skipped}, "
+        f"{len(model.get_cross_attn_gates())} left"
+    )
+
+    skipped_flops = estimate_flops(
+        model, args.num_text_tokens, args.num_images, num_vision_tokens
+    )
+    skipped_decode_flops = estimate_flops(model, 1, 0, num_vision_tokens)
+    skipped_latency = measure_latency(model, vision_x, lang_x, args)
+    with torch.inference_mode():
+        skipped_logits = model(vision_x, lang_x).logits
+
+    print(
+        f"predicted forward speedup {sum(flops.values()) / sum(skipped_flops.values()):.2f}x "
+        f"(cross attention FLOPs {flops['cross_attn'] / 1e9:.1f}G -> "
+        f"{skipped_flops['cross_attn'] / 1e9:.1f}G of {sum(flops.values()) / 1e9:.1f}G)"
+    )
+    print(
+        f"predicted speedup per decoded token "
+        f"{sum(decode_flops.values()) / sum(skipped_decode_flops.values()):.2f}x"
+    )
+    for name in ("forward", "generate"):
+        print(
+            f"measured {name} speedup {latency[name] / skipped_latency[name]:.2f}x "
+            f"({latency[name]:.3f}s -> {skipped_latency[name]:.3f}s)"
+        )
+    agreement = (logits.argmax(-1) == skipped_logits.argmax(-1)).float().mean()
+    print(
+        f"next token predictions unchanged for {agreement.item() * 100:.1f}% of tokens, "
+        f"max logit difference {(logits - skipped_logits).abs().max().item():.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Measure the accuracy / latency trade-off of representing each image by fewer visual tokens
+on a small few-shot COCO captioning / VQAv2 subset. The model is loaded once and evaluated
+with each budget in --budgets, using the same demonstrations for all budgets. A budget is
+either a number of latents for every image, or demo/query budgets such as 16/64, e.g.
+
+python open_flamingo/scripts/benchmark_latent_budget.py --budgets 64 32 16 16/64 8/64 \
+    --shots 4 --results_file latent_budget.json ...
+
+The first budget is the reference that the others are compared against.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+import numpy as np
+import torch
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+    )
+)
+from eval import utils
+from eval.coco_metric import compute_cider, postprocess_captioning_generation
+from eval.eval_datasets import CaptionDataset, VQADataset
+from eval.models.open_flamingo import EvalModel
+from eval.vqa_metric import compute_vqa_accuracy, postprocess_vqa_generation
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--budgets",
+    nargs="+",
+    type=str,
+    default=["64", "32", "16", "8", "16/64", "8/64"],
+    help="Visual tokens per image, or num_demo_latents/num_query_latents",
+)
+parser.add_argument(
+    "--latent_reduction", type=str, default="pool", choices=["pool", "select"]
+)
+parser.add_argument(
+    "--results_file", type=str, required=True, help="JSON file to save results"
+)
+parser.add_argument("--shots", type=int, default=4)
+parser.add_argument("--num_samples", type=int, default=100)
+parser.add_argument("--query_set_size", type=int, default=2048)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--num_beams", type=int, default=3)
+parser.add_argument("--seed", type=int, default=42)
+parser.add_argument("--device", type=str, default="0", help="GPU index, or cpu")
+parser.add_argument(
+    "--precision", type=str, default="fp32", choices=["fp32", "amp_bf16", "bf16"]
+)
+
+# Model arguments
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument(
+    "--lm_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument(
+    "--lm_tokenizer_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--checkpoint_path", type=str, required=True)
+
+# Dataset arguments
+parser.add_argument("--coco_train_image_dir_path", type=str, default=None)
+parser.add_argument("--coco_val_image_dir_path", type=str, default=None)
+parser.add_argument("--coco_karpathy_json_path", type=str, default=None)
+parser.add_argument("--coco_annotations_json_path", type=str, default=None)
+parser.add_argument("--vqav2_train_image_dir_path", type=str, default=None)
+parser.add_argument("--vqav2_train_questions_json_path", type=str, default=None)
+parser.add_argument("--vqav2_train_annotations_json_path", type=str, default=None)
+parser.add_argument("--vqav2_test_image_dir_path", type=str, default=None)
+parser.add_argument("--vqav2_test_questions_json_path", type=str, default=None)
+parser.add_argument("--vqav2_test_annotations_json_path", type=str, default=None)
+
+
+def parse_budget(budget):
+    """Parse a budget: "16" -> 16, "16/64" -> (16, 64)"""
+    if "/" in budget:
+        num_demo_latents, num_query_latents = budget.split("/")
+        return int(num_demo_latents), int(num_query_latents)
+    return int(budget)
+
+
+def get_batches(train_dataset, test_dataset, args):
+    """
+    Sample the test subset and the demonstrations of each test example once, so that
+    every budget is evaluated on the same prompts.
+    Returns:
+        list of batches, each a (batch, demos) tuple where demos holds the list of
+        demonstrations for each example of the batch
+    """
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    indices = np.random.choice(
+        len(test_dataset), min(args.num_samples, len(test_dataset)), replace=False
+    )
+    query_set = utils.get_query_set(train_dataset, args.query_set_size)
+    loader = torch.utils.data.DataLoader(
+        torch.utils.data.Subset(test_dataset, indices),
+        batch_size=args.batch_size,
+        collate_fn=utils.custom_collate_fn,
+    )
+    return [
+        (
+            batch,
+            utils.sample_batch_demos_from_query_set(
+                query_set, args.shots, len(batch["image"])
+            ),
+        )
+        for batch in loader
+    ]
+
+
+def run_inference(eval_model, batches, get_prompt, id_key, max_generation_length, args):
+    """
+    Few-shot generation over batches.
+    Args:
+        get_prompt: maps (sample, is_demo) to the prompt text of a test sample or a demo
+    Returns:
+        dict mapping sample ids (batch[id_key]) to generated text
+        list of per-batch latencies, in seconds
+    """
+    outputs, latencies = {}, []
+    for batch, demos in batches:
+        batch_images, batch_text = [], []
+        for i in range(len(batch["image"])):
+            batch_images.append([x["image"] for x in demos[i]] + [batch["image"][i]])
+            sample = {k: v[i] for k, v in batch.items()}
+            batch_text.append(
+                "".join(get_prompt(x, True) + "\n" for x in demos[i])
+                + get_prompt(sample, False)
+            )
+
+        if eval_model.device != "cpu":
+            torch.cuda.synchronize(eval_model.device)
+        start = time.perf_counter()
+        batch_outputs = eval_model.get_outputs(
+            batch_text=batch_text,
+            batch_images=batch_images,
+            min_generation_length=0,
+            max_generation_length=max_generation_length,
+            num_beams=args.num_beams,
+            length_penalty=0.0,
+        )
+        if eval_model.device != "cpu":
+            torch.cuda.synchronize(eval_model.device)
+        latencies.append(time.perf_counter() - start)
+        outputs.update(zip(batch[id_key], batch_outputs))
+    return outputs, latencies
+
+
+def evaluate_coco(eval_model, batches, args):
+    outputs, latencies = run_inference(
+        eval_model,
+        batches,
+        lambda x, is_demo: eval_model.get_caption_prompt(
+            caption=x["caption"].strip() if is_demo else None
+        ),
+        "image_id",
+        20,
+        args,
+    )
+    predictions = {
+        k: postprocess_captioning_generation(out).replace('"', "")
+        for k, out in outputs.items()
+    }
+
+    results_path = f"cocoresults_{uuid.uuid4()}.json"
+    with open(results_path, "w") as f:
+        json.dump([{"image_id": k, "caption": v} for k, v in predictions.items()], f)
+    metrics = compute_cider(
+        result_path=results_path, annotations_path=args.coco_annotations_json_path
+    )
+    os.remove(results_path)
+    return {"score": metrics["CIDEr"] * 100.0, "latencies": latencies}
+
+
+def evaluate_vqav2(eval_model, batches, args):
+    outputs, latencies = run_inference(
+        eval_model,
+        batches,
+        lambda x, is_demo: eval_model.get_vqa_prompt(
+            question=x["question"], answer=x["answers"][0] if is_demo else None
+        ),
+        "question_id",
+        5,
+        args,
+    )
+    predictions = {k: postprocess_vqa_generation(out) for k, out in outputs.items()}
+
+    results_path = f"vqav2results_{uuid.uuid4()}.json"
+    with open(results_path, "w") as f:
+        json.dump([{"question_id": k, "answer": v} for k, v in predictions.items()], f)
+    score = compute_vqa_accuracy(
+        results_path,
+        args.vqav2_test_questions_json_path,
+        args.vqav2_test_annotations_json_path,
+    )
+    os.remove(results_path)
+    return {"score": score, "latencies": latencies}
+
+
+def summarize(results):
+    for task, task_results in results.items():
+        reference_budget = next(iter(task_results))
+        reference = task_results[reference_budget]
+        reference_latency = np.median(reference["latencies"])
+        print(f"{task} ({len(reference['latencies'])} batches):")
+        for budget, budget_results in task_results.items():
+            latency = np.median(budget_results["latencies"])
+            print(
+                f"  {budget:>7} latents: score {budget_results['score']:.2f} "
+                f"({budget_results['score'] - reference['score']:+.2f}), "
+                f"median batch latency {latency:.3f}s "
+                f"({reference_latency / latency:.2f}x vs {reference_budget})"
+            )
+
+
+def main():
+    args = parser.parse_args()
+    budgets = {budget: parse_budget(budget) for budget in args.budgets}
+
+    eval_model = EvalModel(
+        {
+            "vision_encoder_path": args.vision_encoder_path,
+            "vision_encoder_pretrained": args.vision_encoder_pretrained,
+            "lm_path": args.lm_path,
+            "lm_tokenizer_path": args.lm_tokenizer_path,
+            "cross_attn_every_n_layers": args.cross_attn_every_n_layers,
+            "checkpoint_path": args.checkpoint_path,
+            "precision": args.precision,
+            "device": args.device,
+            "latent_reduction": args.latent_reduction,
+        }
+    )
+
+    tasks = {}
+    if args.coco_karpathy_json_path is not None:
+        train_dataset, test_dataset = [
+            CaptionDataset(
+                image_train_dir_path=args.coco_train_image_dir_path,
+                image_val_dir_path=args.coco_val_image_dir_path,
+                annotations_path=args.coco_karpathy_json_path,
+                is_train=is_train,
+                dataset_name="coco",
+            )
+            for is_train in (True, False)
+        ]
+        tasks["coco"] = (evaluate_coco, get_batches(train_dataset, test_dataset, args))
+    if args.vqav2_test_questions_json_path is not None:
+        train_dataset = VQADataset(
+            image_dir_path=args.vqav2_train_image_dir_path,
+            question_path=args.vqav2_train_questions_json_path,
+            annotations_path=args.vqav2_train_annotations_json_path,
+            is_train=True,
+            dataset_name="vqav2",
+        )
+        test_dataset = VQADataset(
+            image_dir_path=args.vqav2_test_image_dir_path,
+            question_path=args.vqav2_test_questions_json_path,
+            annotations_path=args.vqav2_test_annotations_json_path,
+            is_train=False,
+            dataset_name="vqav2",
+        )
+        tasks["vqav2"] = (
+            evaluate_vqav2,
+            get_batches(train_dataset, test_dataset, args),
+        )
+
+    results = {}
+    for task, (evaluate, batches) in tasks.items():
+        results[task] = {}
+        for budget, num_latents in budgets.items():
+            eval_model.num_latents = num_latents
+            utils.random_seed(args.seed)
+            results[task][budget] = evaluate(eval_model, batches, args)
+
+    with open(args.results_file, "w") as f:
+        json.dump(results, f, indent=4)
+    summarize(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Measure the accuracy, latency and memory of an int8 quantized OpenFlamingo model on a
+small COCO captioning / VQAv2 subset. Run once with --quantize none to get the full
+precision baseline, then with --quantize dynamic_int8 or weight_only_int8 and
+--baseline_results_file to print the deltas against it. Pass --freeze_for_inference to
+compare the model frozen with Flamingo.freeze_for_inference(), alone or quantized, e.g.
+
+python open_flamingo/scripts/benchmark_quantization.py --quantize none --results_file fp32.json ...
+python open_flamingo/scripts/benchmark_quantization.py --quantize dynamic_int8 \
+    --results_file int8.json --baseline_results_file fp32.json ...
+python open_flamingo/scripts/benchmark_quantization.py --quantize none --freeze_for_inference \
+    --results_file frozen.json --baseline_results_file fp32.json ...
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+import torch
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+    )
+)
+from eval.coco_metric import compute_cider, postprocess_captioning_generation
+from eval.eval_datasets import CaptionDataset, VQADataset
+from eval.models.open_flamingo import EvalModel
+from eval.utils import custom_collate_fn
+from eval.vqa_metric import compute_vqa_accuracy, postprocess_vqa_generation
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--quantize",
+    type=str,
+    default="none",
+    choices=["none", "dynamic_int8", "weight_only_int8"],
+)
+parser.add_argument(
+    "--freeze_for_inference",
+    action="store_true",
+    help="fold gates, layer norms and attention scales into the weights before quantizing",
+)
+parser.add_argument(
+    "--results_file", type=str, required=True, help="JSON file to save results"
+)
+parser.add_argument(
+    "--baseline_results_file",
+    type=str,
+    default=None,
+    help="Results of a previous run (typically --quantize none) to compare against",
+)
+parser.add_argument("--num_samples", type=int, default=100)
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--num_beams", type=int, default=3)
+parser.add_argument("--num_threads", type=int, default=None)
+parser.add_argument("--seed", type=int, default=42)
+
+# Model arguments
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument(
+    "--lm_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument(
+    "--lm_tokenizer_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--checkpoint_path", type=str, required=True)
+
+# Dataset arguments
+parser.add_argument("--coco_train_image_dir_path", type=str, default=None)
+parser.add_argument("--coco_val_image_dir_path", type=str, default=None)
+parser.add_argument("--coco_karpathy_json_path", type=str, default=None)
+parser.add_argument("--coco_annotations_json_path", type=str, default=None)
+parser.add_argument("--vqav2_test_image_dir_path", type=str, default=None)
+parser.add_argument("--vqav2_test_questions_json_path", type=str, default=None)
+parser.add_argument("--vqav2_test_annotations_json_path", type=str, default=None)
+
+
+def get_rss_mb():
+    """
+    Current and peak resident set size of this process, in MB (Linux). The peak is
+    since the last reset_peak_rss(), or since the process started.
+    """
+    with open("/proc/self/status") as f:
+        status = dict(line.split(":", 1) for line in f)
+    current = int(status["VmRSS"].split()[0]) / 1024
+    peak = int(status["VmHWM"].split()[0]) / 1024
+    return current, peak
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size to the current one (Linux)."""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def get_dataloader(dataset, args):
+    np.random.seed(args.seed)
+    indices = np.random.choice(
+        len(dataset), min(args.num_samples, len(dataset)), replace=False
+    )
+    return torch.utils.data.DataLoader(
+        torch.utils.data.Subset(dataset, indices),
+        batch_size=args.batch_size,
+        collate_fn=custom_collate_fn,
+    )
+
+
+def run_inference(
+    eval_model, dataloader, get_prompt, id_key, max_generation_length, args
+):
+    """
+    Zero-shot generation over dataloader.
+    Returns:
+        dict mapping sample ids (batch[id_key]) to generated text
+        list of per-batch latencies, in seconds
+    """
+    outputs, latencies = {}, []
+    for batch in dataloader:
+        batch_text = [get_prompt(batch, i) for i in range(len(batch["image"]))]
+        start = time.perf_counter()
+        batch_outputs = eval_model.get_outputs(
+            batch_text=batch_text,
+            batch_images=[[image] for image in batch["image"]],
+            min_generation_length=0,
+            max_generation_length=max_generation_length,
+            num_beams=args.num_beams,
+            length_penalty=0.0,
+        )
+        latencies.append(time.perf_counter() - start)
+        outputs.update(zip(batch[id_key], batch_outputs))
+    return outputs, latencies
+
+
+def evaluate_coco(eval_model, args):
+    dataset = CaptionDataset(
+        image_train_dir_path=args.coco_train_image_dir_path,
+        image_val_dir_path=args.coco_val_image_dir_path,
+        annotations_path=args.coco_karpathy_json_path,
+        is_train=False,
+        dataset_name="coco",
+    )
+    outputs, latencies = run_inference(
+        eval_model,
+        get_dataloader(dataset, args),
+        lambda batch, i: eval_model.get_caption_prompt(),
+        "image_id",
+        20,
+        args,
+    )
+    predictions = {
+        k: postprocess_captioning_generation(out).replace('"', "")
+        for k, out in outputs.items()
+    }
+
+    results_path = f"cocoresults_{uuid.uuid4()}.json"
+    with open(results_path, "w") as f:
+        json.dump([{"image_id": k, "caption": v} for k, v in predictions.items()], f)
+    metrics = compute_cider(
+        result_path=results_path, annotations_path=args.coco_annotations_json_path
+    )
+    os.remove(results_path)
+    return {
+        "score": metrics["CIDEr"] * 100.0,
+        "predictions": {str(k): v for k, v in predictions.items()},
+        "latencies": latencies,
+    }
+
+
+def evaluate_vqav2(eval_model, args):
+    dataset = VQADataset(
+        image_dir_path=args.vqav2_test_image_dir_path,
+        question_path=args.vqav2_test_questions_json_path,
+        annotations_path=args.vqav2_test_annotations_json_path,
+        is_train=False,
+        dataset_name="vqav2",
+    )
+    outputs, latencies = run_inference(
+        eval_model,
+        get_dataloader(dataset, args),
+        lambda batch, i: eval_model.get_vqa_prompt(question=batch["question"][i]),
+        "question_id",
+        5,
+        args,
+    )
+    predictions = {k: postprocess_vqa_generation(out) for k, out in outputs.items()}
+
+    results_path = f"vqav2results_{uuid.uuid4()}.json"
+    with open(results_path, "w") as f:
+        json.dump([{"question_id": k, "answer": v} for k, v in predictions.items()], f)
+    score = compute_vqa_accuracy(
+        results_path,
+        args.vqav2_test_questions_json_path,
+        args.vqav2_test_annotations_json_path,
+    )
+    os.remove(results_path)
+    return {
+        "score": score,
+        "predictions": {str(k): v for k, v in predictions.items()},
+        "latencies": latencies,
+    }
+
+
+def summarize(results, baseline):
+    print(f"quantize: {results['quantize']}")
+    print(
+        f"load time {results['load_time']:.1f}s, RSS after load {results['rss_after_load_mb']:.0f}MB, "
+        f"peak RSS {results['peak_rss_mb']:.0f}MB, "
+        f"peak RSS during inference +{results['inference_peak_rss_delta_mb']:.0f}MB over RSS after load"
+    )
+    if baseline is not None:
+        print(
+            f"  vs {baseline['quantize']}: RSS after load {baseline['rss_after_load_mb']:.0f}MB, "
+            f"peak RSS {baseline['peak_rss_mb']:.0f}MB, "
+            f"peak RSS during inference +{baseline['inference_peak_rss_delta_mb']:.0f}MB over RSS after load"
+        )
+    for task in ("coco", "vqav2"):
+        if task not in results:
+            continue
+        task_results = results[task]
+        latency = np.median(task_results["latencies"])
+        print(
+            f"{task}: score {task_results['score']:.2f}, median batch latency {latency:.3f}s"
+        )
+        if baseline is None or task not in baseline:
+            continue
+        baseline_results = baseline[task]
+        baseline_latency = np.median(baseline_results["latencies"])
+        shared = set(task_results["predictions"]) & set(baseline_results["predictions"])
+        agreement = np.mean(
+            [
+                task_results["predictions"][k] == baseline_results["predictions"][k]
+                for k in shared
+            ]
+        )
+        print(
+            f"  vs {baseline['quantize']}: score delta {task_results['score'] - baseline_results['score']:+.2f}, "
+            f"speedup {baseline_latency / latency:.2f}x, "
+            f"identical predictions {agreement * 100:.1f}% of {len(shared)}"
+        )
+
+
+def main():
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    model_args = {
+        "vision_encoder_path": args.vision_encoder_path,
+        "vision_encoder_pretrained": args.vision_encoder_pretrained,
+        "lm_path": args.lm_path,
+        "lm_tokenizer_path": args.lm_tokenizer_path,
+        "cross_attn_every_n_layers": args.cross_attn_every_n_layers,
+        "checkpoint_path": args.checkpoint_path,
+        "precision": "fp32",
+        "device": -1,
+    }
+    if args.quantize != "none":
+        model_args["quantize"] = args.quantize
+    if args.freeze_for_inference:
+        model_args["freeze_for_inference"] = "true"
+
+    start = time.perf_counter()
+    eval_model = EvalModel(model_args)
+    results = {
+        "quantize": args.quantize + (" (frozen)" if args.freeze_for_inference else ""),
+        "load_time": time.perf_counter() - start,
+    }
+    results["rss_after_load_mb"], results["peak_rss_mb"] = get_rss_mb()
+    # loading peaks with the full precision weights; measure inference on its own
+    reset_peak_rss()
+
+    if args.coco_karpathy_json_path is not None:
+        results["coco"] = evaluate_coco(eval_model, args)
+    if args.vqav2_test_questions_json_path is not None:
+        results["vqav2"] = evaluate_vqav2(eval_model, args)
+    _, peak_inference_rss = get_rss_mb()
+    results["peak_rss_mb"] = max(results["peak_rss_mb"], peak_inference_rss)
+    results["inference_peak_rss_delta_mb"] = (
+        peak_inference_rss - results["rss_after_load_mb"]
+    )
+
+    with open(args.results_file, "w") as f:
+        json.dump(results, f, indent=4)
+
+    baseline = None
+    if args.baseline_results_file is not None:
+        with open(args.baseline_results_file) as f:
+            baseline = json.load(f)
+    summarize(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Compare the latency and peak memory of beam search on long few-shot prompts, on synthetic
+inputs, e.g.
+
+python open_flamingo/scripts/benchmark_shared_prompt_beams.py --device 0 --num_beams 3 \
+    --num_text_tokens 1024 ...
+
+Three implementations are compared:
+- generate: Hugging Face beam search, which repeats each prompt for every beam
+- repeated: generate(share_prompt_across_beams=True) with the prompt keys / values
+  repeated for each beam in each layer while decoding, as for language models without a
+  shared prompt attention (see beam_search.SHARED_PROMPT_ATTENTION_FORWARDS)
+- shared: generate(share_prompt_across_beams=True), where the beams attend to a single
+  copy of their prompt's keys / values
+
+Peak memory is measured for the whole call, dominated by the prefill on long prompts, and
+for its decoding steps alone, with torch.cuda.max_memory_allocated() on GPU and the
+profiler's allocations on CPU.
+The language model's attention must be in beam_search.SHARED_PROMPT_ATTENTION_FORWARDS
+(e.g. GPT-NeoX, as in OpenFlamingo-3B / 4B, or Llama) for shared to differ from repeated.
+"""
+import argparse
+import os
+import sys
+import time
+from unittest import mock
+
+import numpy as np
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+    )
+)
+from open_flamingo.src import beam_search
+from open_flamingo.src.factory import create_model_and_transforms
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch_size", type=int, default=1)
+parser.add_argument("--num_beams", type=int, default=3)
+parser.add_argument("--num_images", type=int, default=8, help="images per prompt")
+parser.add_argument("--num_text_tokens", type=int, default=1024)
+parser.add_argument("--max_new_tokens", type=int, default=20)
+parser.add_argument("--num_warmup", type=int, default=1)
+parser.add_argument("--num_repeats", type=int, default=5)
+parser.add_argument("--device", type=str, default="cpu", help="GPU index, or cpu")
+
+# Model arguments
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument(
+    "--lm_path", default="togethercomputer/RedPajama-INCITE-Base-3B-v1", type=str
+)
+parser.add_argument(
+    "--lm_tokenizer_path",
+    default="togethercomputer/RedPajama-INCITE-Base-3B-v1",
+    type=str,
+)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=2)
+parser.add_argument(
+    "--checkpoint_path",
+    type=str,
+    default=None,
+    help="Flamingo checkpoint; latency and memory do not depend on the weights",
+)
+
+DECODE_START = "decode_start"
+IMPLEMENTATIONS = {
+    "generate": dict(share_prompt_across_beams=False),
+    "repeated": dict(share_prompt_across_beams=True),
+    "shared": dict(share_prompt_across_beams=True),
+}
+
+
+def peak_memory(generate, model, device):
+    """
+    Peak memory allocated by generate() above the memory allocated before the call, and
+    peak memory allocated by its decoding steps above the memory allocated when the first
+    one starts, in bytes. The first forward pass of the language model is the prefill.
+    """
+    decode_start = []
+
+    def mark_decode_start(module, args, kwargs):
+        if len(decode_start) == 0 and kwargs.get("past_key_values") is not None:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+                decode_start.append(
+                    (
+                        torch.cuda.max_memory_allocated(device),
+                        torch.cuda.memory_allocated(device),
+                    )
+                )
+                torch.cuda.reset_peak_memory_stats(device)
+            else:
+                with record_function(DECODE_START):
+                    decode_start.append(None)
+
+    handle = model.lang_encoder.register_forward_pre_hook(
+        mark_decode_start, with_kwargs=True
+    )
+    try:
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            before = torch.cuda.memory_allocated(device)
+            generate()
+            torch.cuda.synchronize(device)
+            prefill_peak, decode_before = decode_start[0]
+            decode_peak = torch.cuda.max_memory_allocated(device)
+            return (
+                max(prefill_peak, decode_peak) - before,
+                decode_peak - decode_before,
+            )
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            generate()
+    finally:
+        handle.remove()
+    events = sorted(prof.events(), key=lambda e: e.time_range.start)
+    allocated = peak = decode_before = decode_peak = 0
+    decoding = False
+    for event in events:
+        if event.name == DECODE_START:
+            decoding, decode_before, decode_peak = True, allocated, allocated
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+        if decoding:
+            decode_peak = max(decode_peak, allocated)
+    return peak, decode_peak - decode_before
+
+
+def measure(model, vision_x, lang_x, implementation, args):
+    """
+    Median latency of one beam search call, in seconds, and its peak memory and that of
+    its decoding steps, in bytes. See peak_memory().
+    """
+    device = vision_x.device
+
+    def generate():
+        model.generate(
+            vision_x,
+            lang_x,
+            min_new_tokens=args.max_new_tokens,
+            max_new_tokens=args.max_new_tokens,
+            num_beams=args.num_beams,
+            **IMPLEMENTATIONS[implementation],
+        )
+
+    # "repeated" runs the fallback for language models without a shared prompt attention
+    with mock.patch.dict(
+        beam_search.SHARED_PROMPT_ATTENTION_FORWARDS, clear=implementation == "repeated"
+    ), torch.inference_mode():
+        latencies = []
+        for _ in range(args.num_warmup + args.num_repeats):
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            generate()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            latencies.append(time.perf_counter() - start)
+        memory, decode_memory = peak_memory(generate, model, device)
+    return float(np.median(latencies[args.num_warmup :])), memory, decode_memory
+
+
+def get_synthetic_inputs(model, tokenizer, args, device):
+    """Random images and text with one <image> token per image, evenly spaced."""
+    vision_x = torch.randn(
+        args.batch_size, args.num_images, 1, 3, 224, 224, device=device
+    )
+    lang_x = torch.randint(
+        100, len(tokenizer) - 2, (args.batch_size, args.num_text_tokens), device=device
+    )
+    spacing = args.num_text_tokens // args.num_images
+    lang_x[:, ::spacing][:, : args.num_images] = model.media_token_id
+    return vision_x, lang_x
+
+
+def report(results):
+    reference = results["generate"]
+    for implementation, (latency, memory, decode_memory) in results.items():
+        print(
+            f"{implementation:>8}: {latency:.3f}s ({reference[0] / latency:.2f}x), "
+            f"peak memory {memory / 2**20:.1f} MiB ({memory / reference[1]:.2f}x), "
+            f"while decoding {decode_memory / 2**20:.1f} MiB "
+            f"({decode_memory / reference[2]:.2f}x)"
+        )
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device("cpu" if args.device == "cpu" else f"cuda:{args.device}")
+
+    model, image_processor, tokenizer = create_model_and_transforms(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.lm_path,
+        args.lm_tokenizer_path,
+        cross_attn_every_n_layers=args.cross_attn_every_n_layers,
+        checkpoint_path=args.checkpoint_path,
+    )
+    model.to(device)
+    model.eval()
+
+    vision_x, lang_x = get_synthetic_inputs(model, tokenizer, args, device)
+    report(
+        {
+            implementation: measure(model, vision_x, lang_x, implementation, args)
+            for implementation in IMPLEMENTATIONS
+        }
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+Convert checkpoints saved by train.py (checkpoint_*.pt) to the safetensors layout:
+the model weights are written to checkpoint_*.safetensors next to each checkpoint, which
+create_model_and_transforms(checkpoint_path=...) and EvalModel memory-map instead of
+unpickling the optimizer state. With --strip_model_state, the model weights are then
+removed from the .pt file, which keeps the optimizer and lr_scheduler states for resuming.
+"""
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+    )
+)
+from open_flamingo.src.checkpoint import (
+    get_safetensors_path,
+    save_safetensors_state_dict,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "checkpoint_paths", nargs="+", type=str, help="checkpoint_*.pt files to convert"
+)
+parser.add_argument(
+    "--strip_model_state",
+    action="store_true",
+    help="remove the model weights from the .pt files after converting them",
+)
+
+
+def main():
+    args = parser.parse_args()
+    for checkpoint_path in args.checkpoint_paths:
+        checkpoint = torch.load(checkpoint_path, map_location="cpu")
+        if "model_state_dict" in checkpoint:
+            state_dict = checkpoint["model_state_dict"]
+            metadata = {"epoch": str(checkpoint["epoch"])}
+        elif "optimizer_state_dict" in checkpoint:
+            print(f"Skipping {checkpoint_path}: it has no model weights")
+            continue
+        else:
+            # released checkpoints only contain the model state dict
+            state_dict, metadata = checkpoint, None
+
+        output_path = get_safetensors_path(checkpoint_path)
+        print(f"Saving model weights of {checkpoint_path} to {output_path}")
+        save_safetensors_state_dict(state_dict, output_path, metadata=metadata)
+
+        if args.strip_model_state and "model_state_dict" in checkpoint:
+            del checkpoint["model_state_dict"]
+            torch.save(checkpoint, checkpoint_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Export the vision encoder and perceiver of an OpenFlamingo checkpoint as a TorchScript or
+ONNX graph mapping preprocessed images to perceiver latents, e.g. to encode images in a
+separate CPU service:
+
+python open_flamingo/scripts/export_vision_encoder.py --format onnx \
+    --output_path vision_encoder.onnx --checkpoint_path checkpoint.pt ...
+
+The latents are passed back to the model with
+Flamingo.get_vision_conditioning_from_latents(). tests/test_vision_export.py checks that
+they and the resulting logits match the model's.
+"""
+import argparse
+import os
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+    )
+)
+from open_flamingo.src.factory import create_model_and_transforms
+from open_flamingo.src.vision_export import export_vision_encoder
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--format", type=str, default="torchscript", choices=["torchscript", "onnx"]
+)
+parser.add_argument("--output_path", type=str, required=True)
+parser.add_argument(
+    "--freeze_for_inference",
+    action="store_true",
+    help="fold gates, layer norms and attention scales into the weights before exporting",
+)
+parser.add_argument("--image_size", type=int, default=224)
+
+# Model arguments
+parser.add_argument("--vision_encoder_path", default="ViT-L-14", type=str)
+parser.add_argument("--vision_encoder_pretrained", default="openai", type=str)
+parser.add_argument(
+    "--lm_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument(
+    "--lm_tokenizer_path", default="anas-awadalla/mpt-1b-redpajama-200b", type=str
+)
+parser.add_argument("--cross_attn_every_n_layers", type=int, default=1)
+parser.add_argument("--checkpoint_path", type=str, required=True)
+
+
+def main():
+    args = parser.parse_args()
+    model, image_processor, tokenizer = create_model_and_transforms(
+        args.vision_encoder_path,
+        args.vision_encoder_pretrained,
+        args.lm_path,
+        args.lm_tokenizer_path,
+        cross_attn_every_n_layers=args.cross_attn_every_n_layers,
+        checkpoint_path=args.checkpoint_path,
+    )
+    model.eval()
+    if args.freeze_for_inference:
+        model.freeze_for_inference()
+
+    export_vision_encoder(
+        model, args.output_path, format=args.format, image_size=args.image_size
+    )
+    print(f"Saved the {args.format} vision encoder to {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
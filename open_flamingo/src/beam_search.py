@@ -0,0 +1,530 @@
+"""
+Beam search that keeps a single copy of each prompt's keys / values and media for all of
+its beams. See Flamingo.generate(share_prompt_across_beams=True).
+"""
+
+from contextlib import ExitStack, contextmanager
+from types import MethodType
+
+import torch
+import transformers
+from einops import rearrange
+from packaging import version
+from torch.nn import functional as F
+from transformers import BeamSearchScorer
+from transformers.models.gpt_neox import modeling_gpt_neox
+from transformers.models.llama import modeling_llama
+from transformers.models.opt import modeling_opt
+
+from .utils import get_past_position_dims
+
+# transformers versions whose attention modules the forwards of
+# SHARED_PROMPT_ATTENTION_FORWARDS follow, and whose language models pass past_key_values
+# as tuples (4.36 introduces Cache objects). Keep in sync with setup.py.
+SUPPORTED_TRANSFORMERS_VERSIONS = ("4.28.1", "4.36")
+
+
+class SharedPromptLayerPast(tuple):
+    """
+    Past of one layer for the shared prompt attention (see shared_prompt_attention()): the
+    keys / values of the prompts, of batch size B, and those of the generated tokens, of
+    batch size B * num_beams.
+    As a tuple, it holds a keys and a values tensor of the shape of the full past of the
+    beams, so that language models find the past length where they expect it. They are
+    expanded views of a single element, which allocate no memory and must never be read.
+    """
+
+    def __new__(cls, prompt, generated, num_beams):
+        prompt_key = prompt[0]
+        shape = list(prompt_key.shape)
+        shape[0] *= num_beams
+        if generated is not None:
+            shape[2] += generated[0].shape[2]
+        placeholder = prompt_key[:1, :1, :1, :1].expand(shape)
+        layer_past = super().__new__(cls, (placeholder, placeholder))
+        layer_past.prompt = prompt
+        layer_past.generated = generated
+        layer_past.num_beams = num_beams
+        return layer_past
+
+
+class SharedPromptPastKeyValues:
+    """
+    past_key_values of a batch of beams, split into the keys / values of the prompts, stored
+    once per example, and those of the generated tokens, stored per beam.
+    Language models read past_key_values one layer at a time. With the shared prompt
+    attention installed (see shared_prompt_attention()), indexing returns the layer's
+    SharedPromptLayerPast, and the beams attend to their prompt's keys / values without
+    ever repeating them. Otherwise, indexing concatenates the layer's prompt keys / values,
+    repeated for each beam, with its generated ones: only one layer's full past exists at a
+    time, and drop_prompt_past() cuts the prompt positions from the past the layers return.
+    In both cases, the language model's output past_key_values only hold the generated
+    tokens.
+    """
+
+    def __init__(
+        self,
+        prompt_past_key_values,
+        num_beams,
+        past_key_values=None,
+        position_dims=None,
+        share_prompt=True,
+    ):
+        """
+        Args:
+            prompt_past_key_values: past_key_values of the prompts, of batch size B
+            num_beams (int): number of beams per prompt
+            past_key_values (optional): past_key_values of the generated tokens, of batch
+                size B * num_beams, or None before the first generated token
+            position_dims (optional): position dimension of each past_key_values tensor.
+                See utils.get_past_position_dims(). Required with past_key_values.
+            share_prompt (bool, optional): if True, return SharedPromptLayerPasts rather
+                than repeating the prompt keys / values for each beam
+        """
+        self.prompt_past_key_values = prompt_past_key_values
+        self.num_beams = num_beams
+        self.past_key_values = (
+            list(past_key_values)
+            if past_key_values is not None
+            else [None] * len(prompt_past_key_values)
+        )
+        self.position_dims = position_dims
+        self.share_prompt = share_prompt
+        # the last layer that was read, as models may read the first layer twice
+        self._last_layer_past = (None, None)
+
+    def __len__(self):
+        return len(self.prompt_past_key_values)
+
+    def __getitem__(self, layer_idx):
+        if self.share_prompt:
+            return SharedPromptLayerPast(
+                self.prompt_past_key_values[layer_idx],
+                self.past_key_values[layer_idx],
+                self.num_beams,
+            )
+        if self._last_layer_past[0] == layer_idx:
+            return self._last_layer_past[1]
+        layer_past = tuple(
+            t.repeat_interleave(self.num_beams, dim=0)
+            for t in self.prompt_past_key_values[layer_idx]
+        )
+        if self.past_key_values[layer_idx] is not None:
+            layer_past = tuple(
+                torch.cat([t, generated_t], dim=dim)
+                for t, generated_t, dim in zip(
+                    layer_past,
+                    self.past_key_values[layer_idx],
+                    self.position_dims[layer_idx],
+                )
+            )
+        self._last_layer_past = (layer_idx, layer_past)
+        return layer_past
+
+    def __setitem__(self, layer_idx, layer_past):
+        # MPT models write each layer's new past back into past_key_values
+        self.past_key_values[layer_idx] = layer_past
+
+
+def _attend_shared_prompt(q, k, v, layer_past, attention_mask, scale):
+    """
+    Attention of one new token per beam to its prompt's keys / values, shared by the beams
+    of the prompt, and to the keys / values of its own generated tokens.
+    For the prompt, the beams of an example (and the query heads sharing a key / value
+    head) are folded into the query axis, like the cross attention does with the media:
+    the prompt keys / values are never repeated. Both parts of the attention scores are
+    normalized by a single softmax, so the output matches attending to the concatenated
+    past.
+    Args:
+        q (torch.Tensor): queries of the new tokens
+            shape (B * num_beams, H, 1, d)
+        k, v (torch.Tensor): keys / values of the new tokens
+            shape (B * num_beams, H_kv, 1, d)
+        layer_past (SharedPromptLayerPast): past of the layer, in the same layout
+        attention_mask (torch.Tensor): additive attention mask over the prompt, the
+            generated and the new tokens, or None
+            shape (B * num_beams, 1, 1, T_prompt + T_generated + 1)
+        scale (float): scale of the attention scores
+    Returns:
+        torch.Tensor: output of the attention
+            shape (B * num_beams, H, 1, d)
+        tuple: keys / values of the generated and the new tokens, the layer's present
+    """
+    prompt_k, prompt_v = layer_past.prompt
+    if layer_past.generated is not None:
+        k = torch.cat([layer_past.generated[0], k], dim=2)
+        v = torch.cat([layer_past.generated[1], v], dim=2)
+    present = (k, v)
+    fold = dict(r=layer_past.num_beams, g=q.shape[1] // k.shape[1])
+
+    scores = torch.cat(
+        [
+            rearrange(
+                rearrange(q, "(b r) (h g) i d -> b h (r g i) d", **fold)
+                @ prompt_k.transpose(-1, -2),
+                "b h (r g i) j -> (b r) (h g) i j",
+                **fold,
+            ),
+            rearrange(
+                rearrange(q, "n (h g) i d -> n h (g i) d", g=fold["g"])
+                @ k.transpose(-1, -2),
+                "n h (g i) j -> n (h g) i j",
+                g=fold["g"],
+            ),
+        ],
+        dim=-1,
+    )
+    scores = scores * scale
+    if attention_mask is not None:
+        scores = scores + attention_mask
+    attn = scores.softmax(dim=-1, dtype=torch.float32).to(q.dtype)
+
+    prompt_length = prompt_k.shape[2]
+    prompt_attn = rearrange(
+        attn[..., :prompt_length], "(b r) (h g) i j -> b h (r g i) j", **fold
+    )
+    own_attn = rearrange(
+        attn[..., prompt_length:], "n (h g) i j -> n h (g i) j", g=fold["g"]
+    )
+    out = rearrange(
+        prompt_attn @ prompt_v, "b h (r g i) d -> (b r) (h g) i d", **fold
+    ) + rearrange(own_attn @ v, "n h (g i) d -> n (h g) i d", g=fold["g"])
+    return out, present
+
+
+def _opt_attention_forward(
+    attn,
+    hidden_states,
+    key_value_states=None,
+    past_key_value=None,
+    attention_mask=None,
+    layer_head_mask=None,
+    output_attentions=False,
+    **kwargs,
+):
+    """OPTAttention.forward() with a SharedPromptLayerPast."""
+    bsz, tgt_len, _ = hidden_states.shape
+    q = attn._shape(attn.q_proj(hidden_states), tgt_len, bsz)
+    k = attn._shape(attn.k_proj(hidden_states), tgt_len, bsz)
+    v = attn._shape(attn.v_proj(hidden_states), tgt_len, bsz)
+    out, present = _attend_shared_prompt(
+        q, k, v, past_key_value, attention_mask, attn.scaling
+    )
+    out = attn.out_proj(out.transpose(1, 2).reshape(bsz, tgt_len, attn.embed_dim))
+    return out, None, present
+
+
+def _llama_attention_forward(
+    attn,
+    hidden_states,
+    attention_mask=None,
+    position_ids=None,
+    past_key_value=None,
+    output_attentions=False,
+    use_cache=False,
+    **kwargs,
+):
+    """LlamaAttention.forward() with a SharedPromptLayerPast."""
+    bsz, q_len, _ = hidden_states.shape
+    num_key_value_heads = getattr(attn, "num_key_value_heads", attn.num_heads)
+    q = attn.q_proj(hidden_states).view(bsz, q_len, attn.num_heads, attn.head_dim)
+    k = attn.k_proj(hidden_states).view(bsz, q_len, num_key_value_heads, attn.head_dim)
+    v = attn.v_proj(hidden_states).view(bsz, q_len, num_key_value_heads, attn.head_dim)
+    q, k, v = (t.transpose(1, 2) for t in (q, k, v))
+    cos, sin = attn.rotary_emb(v, seq_len=past_key_value[0].shape[-2] + q_len)
+    q, k = modeling_llama.apply_rotary_pos_emb(q, k, cos, sin, position_ids)
+    out, present = _attend_shared_prompt(
+        q, k, v, past_key_value, attention_mask, attn.head_dim**-0.5
+    )
+    out = attn.o_proj(out.transpose(1, 2).reshape(bsz, q_len, attn.hidden_size))
+    return out, None, present
+
+
+def _gpt_neox_attention_forward(
+    attn,
+    hidden_states,
+    attention_mask,
+    position_ids,
+    head_mask=None,
+    layer_past=None,
+    use_cache=False,
+    output_attentions=False,
+    **kwargs,
+):
+    """GPTNeoXAttention.forward() with a SharedPromptLayerPast."""
+    qkv = attn.query_key_value(hidden_states)
+    qkv = qkv.view(*qkv.shape[:-1], attn.num_attention_heads, 3 * attn.head_size)
+    q, k, v = qkv.permute(0, 2, 1, 3).split(attn.head_size, dim=-1)
+    cos, sin = attn.rotary_emb(v, seq_len=layer_past[0].shape[-2] + q.shape[-2])
+    rotary_q, rotary_k = modeling_gpt_neox.apply_rotary_pos_emb(
+        q[..., : attn.rotary_ndims],
+        k[..., : attn.rotary_ndims],
+        cos,
+        sin,
+        position_ids,
+    )
+    q = torch.cat([rotary_q, q[..., attn.rotary_ndims :]], dim=-1)
+    k = torch.cat([rotary_k, k[..., attn.rotary_ndims :]], dim=-1)
+    out, present = _attend_shared_prompt(
+        q, k, v, layer_past, attention_mask, attn.head_size**-0.5
+    )
+    out = attn.dense(attn._merge_heads(out, attn.num_attention_heads, attn.head_size))
+    return out, present
+
+
+# self attention modules that can attend to a SharedPromptLayerPast, with the forward()
+# replacing theirs while decoding. See shared_prompt_attention().
+SHARED_PROMPT_ATTENTION_FORWARDS = {
+    modeling_opt.OPTAttention: _opt_attention_forward,
+    modeling_llama.LlamaAttention: _llama_attention_forward,
+    modeling_gpt_neox.GPTNeoXAttention: _gpt_neox_attention_forward,
+}
+
+
+def _get_shared_prompt_attention_modules(lang_encoder):
+    """
+    The self attention module of each decoder layer, or None if some decoder layer has no
+    self attention in SHARED_PROMPT_ATTENTION_FORWARDS.
+    """
+    modules = []
+    for layer in lang_encoder._get_decoder_layers():
+        layer_modules = [
+            module
+            for module in layer.decoder_layer.modules()
+            if type(module) in SHARED_PROMPT_ATTENTION_FORWARDS
+        ]
+        if len(layer_modules) != 1 or (
+            getattr(getattr(layer_modules[0], "config", None), "pretraining_tp", 1) > 1
+        ):
+            return None
+        modules.append(layer_modules[0])
+    return modules
+
+
+@contextmanager
+def shared_prompt_attention(lang_encoder):
+    """
+    While active, the self attention of lang_encoder's decoder layers attends to the
+    SharedPromptLayerPasts returned by SharedPromptPastKeyValues, one new token per beam.
+    Language models whose self attention is not in SHARED_PROMPT_ATTENTION_FORWARDS
+    (e.g. MPT) are left untouched.
+    Yields:
+        bool: whether the shared prompt attention is installed
+    """
+    modules = _get_shared_prompt_attention_modules(lang_encoder)
+    if modules is None:
+        yield False
+        return
+    for module in modules:
+        module.forward = MethodType(
+            SHARED_PROMPT_ATTENTION_FORWARDS[type(module)], module
+        )
+    try:
+        yield True
+    finally:
+        for module in modules:
+            del module.forward
+
+
+@contextmanager
+def drop_prompt_past(lang_encoder, prompt_length):
+    """
+    While active, the decoder layers of lang_encoder drop the first prompt_length
+    positions from the past they return, for SharedPromptPastKeyValues that repeat the
+    prompt keys / values for each beam. The past is copied, so that the full keys / values
+    computed for a layer are freed as soon as the next layer runs.
+    """
+
+    def hook(module, args, kwargs, output):
+        *outputs, present = output
+        # GPT-NeoX layers name their past layer_past
+        past_key_value = kwargs.get("past_key_value", kwargs.get("layer_past"))
+        position_dims = get_past_position_dims((present,), (past_key_value,))[0]
+        present = tuple(
+            t.narrow(dim, prompt_length, t.shape[dim] - prompt_length).clone()
+            for t, dim in zip(present, position_dims)
+        )
+        return (*outputs, present)
+
+    handles = [
+        layer.register_forward_hook(hook, with_kwargs=True)
+        for layer in lang_encoder._get_decoder_layers()
+    ]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+@torch.no_grad()
+def generate_beam_search(
+    lang_encoder,
+    conditioning,
+    input_ids,
+    attention_mask,
+    num_beams,
+    max_new_tokens,
+    min_new_tokens=0,
+    eos_token_id=None,
+    pad_token_id=None,
+    length_penalty=1.0,
+    early_stopping=False,
+    num_return_sequences=1,
+):
+    """
+    Beam search with lang_encoder, scoring and selecting beams like Hugging Face
+    generate(num_beams=...), but without repeating the prompts for every beam.
+    Each prompt is prefilled once, and its keys / values are shared by its beams (see
+    SharedPromptPastKeyValues): only the keys / values of the generated tokens are stored
+    per beam. The self attention attends from all the beams of an example to its prompt's
+    keys / values at once (see shared_prompt_attention()), and the cross attention to its
+    media.
+
+    Args:
+        lang_encoder: language model, with the Flamingo layers
+        conditioning (VisionConditioning): vision conditioning of batch size B, activated
+            around the call so that the decoding steps attend to the last media of the
+            prompt
+        input_ids (torch.Tensor): prompts of at least 2 tokens
+            shape (B, T_txt)
+        attention_mask (torch.Tensor): attention mask of the prompts, or None
+        num_beams (int): number of beams per prompt
+        max_new_tokens (int): maximum number of generated tokens
+        min_new_tokens (int, optional): eos_token_id is not generated before this many tokens
+        eos_token_id (int or list, optional): token(s) that end a beam
+        pad_token_id (int, optional): token appended to finished sequences.
+            Defaults to eos_token_id.
+        length_penalty (float, optional): exponent of the length in the beam scores
+        early_stopping (bool or str, optional): see Hugging Face GenerationConfig
+        num_return_sequences (int, optional): number of sequences returned per prompt
+    Returns:
+        torch.Tensor: input_ids, repeated num_return_sequences times, with the generated
+        tokens appended to it
+    """
+    min_version, max_version = SUPPORTED_TRANSFORMERS_VERSIONS
+    if not (
+        version.parse(min_version)
+        <= version.parse(transformers.__version__)
+        < version.parse(max_version)
+    ):
+        raise RuntimeError(
+            f"Sharing the prompt across beams requires transformers>={min_version},"
+            f"<{max_version}, found {transformers.__version__}. "
+            "Use share_prompt_across_beams=False."
+        )
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    if pad_token_id is None:
+        pad_token_id = (
+            eos_token_id[0] if isinstance(eos_token_id, (list, tuple)) else eos_token_id
+        )
+    batch_size, prompt_length = input_ids.shape
+    assert prompt_length > 1, "The prompts must have at least 2 tokens."
+    max_length = prompt_length + max_new_tokens
+    beam_scorer = BeamSearchScorer(
+        batch_size=batch_size,
+        num_beams=num_beams,
+        device=input_ids.device,
+        length_penalty=length_penalty,
+        do_early_stopping=early_stopping,
+        num_beam_hyps_to_keep=num_return_sequences,
+        max_length=max_length,
+    )
+
+    def forward(ids, mask, past_key_values=None):
+        model_inputs = lang_encoder.prepare_inputs_for_generation(
+            ids, past_key_values=past_key_values, attention_mask=mask, use_cache=True
+        )
+        with conditioning.activate():
+            output = lang_encoder(**model_inputs)
+        return output.logits[:, -1], output.past_key_values
+
+    # prefill each prompt once, then let its beams share its keys / values
+    logits, prompt_past_key_values = forward(input_ids, attention_mask)
+    logits = logits.repeat_interleave(num_beams, dim=0)
+    input_ids = input_ids.repeat_interleave(num_beams, dim=0)
+    attention_mask = attention_mask.repeat_interleave(num_beams, dim=0)
+    past_key_values, position_dims = None, None
+
+    # all beams of a prompt start out identical, so only the first one is expanded at first
+    beam_scores = torch.zeros(batch_size, num_beams, device=input_ids.device)
+    beam_scores[:, 1:] = -1e9
+    beam_scores = beam_scores.view(-1)
+
+    with ExitStack() as stack:
+        share_prompt = stack.enter_context(shared_prompt_attention(lang_encoder))
+        if not share_prompt:
+            stack.enter_context(drop_prompt_past(lang_encoder, prompt_length))
+        while True:
+            scores = F.log_softmax(logits, dim=-1)
+            if (
+                eos_token_id is not None
+                and input_ids.shape[1] - prompt_length < min_new_tokens
+            ):
+                scores[:, eos_token_id] = -float("inf")
+            scores = scores + beam_scores[:, None].expand_as(scores)
+
+            # keep 2 candidates per beam, so that there are enough beams left after eos
+            vocab_size = scores.shape[-1]
+            scores, tokens = torch.topk(
+                scores.view(batch_size, num_beams * vocab_size), 2 * num_beams, dim=1
+            )
+            beam_indices = torch.div(tokens, vocab_size, rounding_mode="floor")
+            tokens = tokens % vocab_size
+            beam_outputs = beam_scorer.process(
+                input_ids,
+                scores,
+                tokens,
+                beam_indices,
+                pad_token_id=pad_token_id,
+                eos_token_id=eos_token_id,
+            )
+            beam_scores = beam_outputs["next_beam_scores"]
+            beam_idx = beam_outputs["next_beam_indices"]
+            input_ids = torch.cat(
+                [input_ids[beam_idx], beam_outputs["next_beam_tokens"][:, None]], dim=-1
+            )
+            if beam_scorer.is_done or input_ids.shape[1] >= max_length:
+                break
+
+            # beams always stay within their prompt's group of rows, so only the keys /
+            # values of the generated tokens are reordered
+            if past_key_values is not None:
+                past_key_values = [
+                    tuple(t.index_select(0, beam_idx) for t in layer_past)
+                    for layer_past in past_key_values
+                ]
+            attention_mask = torch.cat(
+                [attention_mask, attention_mask.new_ones(attention_mask.shape[0], 1)],
+                dim=1,
+            )
+            logits, output_past_key_values = forward(
+                input_ids,
+                attention_mask,
+                SharedPromptPastKeyValues(
+                    prompt_past_key_values,
+                    num_beams,
+                    past_key_values,
+                    position_dims,
+                    share_prompt=share_prompt,
+                ),
+            )
+            if isinstance(output_past_key_values, SharedPromptPastKeyValues):
+                output_past_key_values = output_past_key_values.past_key_values
+            past_key_values = output_past_key_values
+            if position_dims is None:
+                # the prompt has at least 2 positions, and the generated tokens 1 so far
+                position_dims = get_past_position_dims(
+                    past_key_values, prompt_past_key_values
+                )
+
+    return beam_scorer.finalize(
+        input_ids,
+        beam_scores,
+        tokens,
+        beam_indices,
+        max_length=max_length,
+        pad_token_id=pad_token_id,
+        eos_token_id=eos_token_id,
+    )["sequences"]
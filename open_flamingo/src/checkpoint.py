@@ -0,0 +1,98 @@
+"""
+Reading and writing Flamingo model weights.
+Checkpoints are either torch.save files written by train.py (model, optimizer and
+lr_scheduler states together), or safetensors files holding only the model weights.
+Safetensors files are memory-mapped, so weights are loaded lazily and without copies
+from the page cache.
+"""
+
+import os
+from collections.abc import Mapping
+
+import torch
+
+try:
+    from safetensors import safe_open
+    from safetensors.torch import save_file
+except ImportError:
+    safe_open = None
+    save_file = None
+
+
+def get_safetensors_path(checkpoint_path):
+    """Path of the model weights saved next to a train.py checkpoint_{epoch}.pt file."""
+    return os.path.splitext(checkpoint_path)[0] + ".safetensors"
+
+
+def load_model_state_dict(checkpoint_path):
+    """
+    Load the model weights of a checkpoint on CPU.
+    Args:
+        checkpoint_path (str): path to a .safetensors file, or to a torch.save checkpoint.
+            If a .safetensors file exists next to a torch.save checkpoint, the weights are
+            read from it instead, skipping the optimizer state.
+    Returns:
+        Mapping: state dict of the model, without DDP "module." prefixes. For safetensors
+            files, a SafetensorsStateDict that reads each tensor when it is accessed.
+    """
+    if not checkpoint_path.endswith(".safetensors") and os.path.exists(
+        get_safetensors_path(checkpoint_path)
+    ):
+        checkpoint_path = get_safetensors_path(checkpoint_path)
+
+    if checkpoint_path.endswith(".safetensors"):
+        return SafetensorsStateDict(checkpoint_path)
+
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    if "model_state_dict" in checkpoint:
+        checkpoint = checkpoint["model_state_dict"]
+        checkpoint = {k.replace("module.", ""): v for k, v in checkpoint.items()}
+    return checkpoint
+
+
+class SafetensorsStateDict(Mapping):
+    """
+    Read-only state dict backed by a safetensors file. Tensors are read from the
+    memory-mapped file on access and not kept, so that loading them one at a time into a
+    model never holds a second copy of all the weights.
+    """
+
+    def __init__(self, path):
+        assert safe_open is not None, "safetensors is not installed"
+        self._file = safe_open(path, framework="pt", device="cpu")
+        self._keys = list(self._file.keys())
+        self._key_set = set(self._keys)
+
+    def __getitem__(self, key):
+        if key not in self._key_set:
+            raise KeyError(key)
+        return self._file.get_tensor(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def save_safetensors_state_dict(state_dict, path, metadata=None):
+    """
+    Save model weights to a safetensors file.
+    safetensors does not store aliased tensors, so only the first key of tensors sharing
+    memory (e.g. tied input / output embeddings) is kept. Loading the weights into the
+    model restores the other keys through the tie.
+    Args:
+        state_dict (dict): model state dict, e.g. filtered to the trainable weights
+        path (str): path of the .safetensors file
+        metadata (dict, optional): str -> str metadata stored in the file header
+    """
+    assert save_file is not None, "safetensors is not installed"
+    tensors, seen = {}, set()
+    for k, v in state_dict.items():
+        k = k.replace("module.", "")
+        ptr = (v.device, v.untyped_storage().data_ptr(), v.storage_offset())
+        if ptr in seen:
+            continue
+        seen.add(ptr)
+        tensors[k] = v.detach().cpu().contiguous()
+    save_file(tensors, path, metadata=metadata)
@@ -0,0 +1,333 @@
+"""
+Continuous batching for greedy generation: rows leave the batch as soon as they finish,
+and waiting requests take their place. See Flamingo.generate_continuous().
+"""
+
+import torch
+from torch.nn import functional as F
+
+from .flamingo_lm import VisionConditioning
+from .helpers import MediaAttentionMask
+from .utils import get_past_position_dims, get_position_ids, narrow_past_key_values
+
+
+class ContinuousBatch:
+    """
+    Decoding state of the rows being generated: the language model's past_key_values and
+    attention mask, left-padded to a common length, and each row's media, padded with
+    zeros to a common number of images (or of slots, see Flamingo._reduce_vision_latents()). Rows are added after their prompt was prefilled,
+    and removed as soon as they finish, which shrinks all the state.
+    """
+
+    def __init__(self):
+        self.request_ids = []
+        self.token_ids = []  # tokens generated by each row
+        self.num_images = []  # number of images (or slots) of each row's media
+        self.past_key_values = None
+        self.attention_mask = None
+        self.vis_x = None
+        self.media_kv = None
+        self.media_time = None
+        # number of media in each row's prompt, which the generated text attends to
+        self.media_offset = None
+        # position dimension of each past_key_values tensor, found once lengths differ
+        self.position_dims = None
+
+    def __len__(self):
+        return len(self.request_ids)
+
+    def add(
+        self,
+        request_id,
+        token_id,
+        past_key_values,
+        attention_mask,
+        vis_x,
+        media_kv,
+        num_media,
+        media_time=None,
+    ):
+        """
+        Add a row of batch size 1, with its past_key_values and media conditioning.
+        Args:
+            request_id: identifies the row's request
+            token_id (int): the row's first generated token, not yet in past_key_values
+            past_key_values: the row's past_key_values for its prompt
+            attention_mask (torch.Tensor): shape (1, T_txt)
+            vis_x (torch.Tensor): shape (1, T_img, n, D)
+            media_kv (dict): maps decoder layer indices to keys / values for vis_x
+            num_media (int): number of media tokens in the prompt
+            media_time (torch.Tensor, optional): media of each slot of vis_x, if the media
+                have different numbers of latents. See VisionConditioning.
+                shape (1, T_img)
+        """
+        self.request_ids.append(request_id)
+        self.token_ids.append([token_id])
+        self.num_images.append(vis_x.shape[1])
+        media_offset = torch.tensor([num_media], device=vis_x.device)
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.vis_x = vis_x
+            self.media_kv = media_kv
+            self.media_offset = media_offset
+            self.media_time = media_time
+            return
+
+        # left-pad the shorter past to the length of the other one
+        length, row_length = self.attention_mask.shape[1], attention_mask.shape[1]
+        if length != row_length and self.position_dims is None:
+            self.position_dims = get_past_position_dims(
+                self.past_key_values, past_key_values
+            )
+        if row_length < length:
+            past_key_values = _left_pad_past_key_values(
+                past_key_values, self.position_dims, length - row_length
+            )
+            attention_mask = F.pad(attention_mask, (length - row_length, 0))
+        elif length < row_length:
+            self.past_key_values = _left_pad_past_key_values(
+                self.past_key_values, self.position_dims, row_length - length
+            )
+            self.attention_mask = F.pad(self.attention_mask, (row_length - length, 0))
+
+        # pad the media to the larger number of images. Text never attends to padding,
+        # since each row only attends to the media of its prompt.
+        T_img, n = max(self.vis_x.shape[1], vis_x.shape[1]), vis_x.shape[2]
+        self.vis_x = torch.cat(
+            [_pad_dim(self.vis_x, 1, T_img), _pad_dim(vis_x, 1, T_img)]
+        )
+        # keys / values are laid out as (B, h, T_img * n, d)
+        self.media_kv = {
+            layer_idx: tuple(
+                torch.cat([_pad_dim(t, 2, T_img * n), _pad_dim(row_t, 2, T_img * n)])
+                for t, row_t in zip(kv, media_kv[layer_idx])
+            )
+            for layer_idx, kv in self.media_kv.items()
+        }
+        if self.media_time is not None:
+            padding = MediaAttentionMask.PADDING_MEDIA_TIME
+            self.media_time = torch.cat(
+                [
+                    _pad_dim(self.media_time, 1, T_img, value=padding),
+                    _pad_dim(media_time, 1, T_img, value=padding),
+                ]
+            )
+        self.past_key_values = tuple(
+            tuple(torch.cat([t, row_t]) for t, row_t in zip(layer_past, row_past))
+            for layer_past, row_past in zip(self.past_key_values, past_key_values)
+        )
+        self.attention_mask = torch.cat([self.attention_mask, attention_mask])
+        self.media_offset = torch.cat([self.media_offset, media_offset])
+
+    def step(self, lang_encoder, eos_token_id=None, suppress_eos=None):
+        """
+        Decode one token for every row.
+        Args:
+            suppress_eos (list of bool, optional): rows that may not generate eos_token_id
+        Returns:
+            list of the generated token ids
+        """
+        input_ids = torch.tensor(
+            [[tokens[-1]] for tokens in self.token_ids],
+            device=self.attention_mask.device,
+        )
+        attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+        kwargs = {}
+        if lang_encoder.accepts_position_ids():
+            # the rows are left-padded: each row's position is its number of real tokens
+            kwargs["position_ids"] = get_position_ids(attention_mask, 1)
+        conditioning = VisionConditioning(
+            self.vis_x,
+            self.media_kv,
+            use_cached_vision_x=False,
+            media_offset=self.media_offset,
+            media_time=self.media_time,
+        )
+        with torch.no_grad(), conditioning.activate():
+            output = lang_encoder(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=self.past_key_values,
+                use_cache=True,
+                **kwargs,
+            )
+        if self.position_dims is None:
+            self.position_dims = get_past_position_dims(
+                output.past_key_values, self.past_key_values
+            )
+        self.past_key_values = output.past_key_values
+        self.attention_mask = attention_mask
+
+        logits = output.logits[:, -1]
+        if eos_token_id is not None and suppress_eos is not None and any(suppress_eos):
+            logits = logits.clone()
+            logits[torch.tensor(suppress_eos), eos_token_id] = -float("inf")
+        token_ids = logits.argmax(dim=-1).tolist()
+        for tokens, token_id in zip(self.token_ids, token_ids):
+            tokens.append(token_id)
+        return token_ids
+
+    def remove(self, rows):
+        """
+        Remove rows from the batch, and drop the positions and images that only the
+        removed rows used.
+        Returns:
+            list of (request_id, generated token ids) for the removed rows
+        """
+        if len(rows) == 0:
+            return []
+        removed = [(self.request_ids[i], self.token_ids[i]) for i in rows]
+        keep = [i for i in range(len(self)) if i not in set(rows)]
+        self.request_ids = [self.request_ids[i] for i in keep]
+        self.token_ids = [self.token_ids[i] for i in keep]
+        self.num_images = [self.num_images[i] for i in keep]
+        if len(keep) == 0:
+            self.past_key_values = self.attention_mask = self.vis_x = None
+            self.media_kv = self.media_offset = self.media_time = None
+            return removed
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[index]
+        # leading positions that are padding for all remaining rows
+        start = attention_mask.any(dim=0).long().argmax().item()
+        length = attention_mask.shape[1] - start
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = narrow_past_key_values(
+            tuple(
+                tuple(t[index] for t in layer_past)
+                for layer_past in self.past_key_values
+            ),
+            self.position_dims,
+            start,
+            length,
+        )
+        T_img = max(self.num_images)
+        n = self.vis_x.shape[2]
+        self.vis_x = self.vis_x[index, :T_img]
+        self.media_kv = {
+            layer_idx: tuple(t[index, :, : T_img * n] for t in kv)
+            for layer_idx, kv in self.media_kv.items()
+        }
+        self.media_offset = self.media_offset[index]
+        if self.media_time is not None:
+            self.media_time = self.media_time[index, :T_img]
+        return removed
+
+
+def generate_continuous(
+    model,
+    requests,
+    batch_size,
+    max_new_tokens,
+    min_new_tokens=0,
+    eos_token_id=None,
+    num_latents=None,
+):
+    """
+    Greedy generation for a stream of requests with continuous batching. Up to batch_size
+    requests are decoded together. After every decoding step, the rows that emitted
+    eos_token_id or reached max_new_tokens are removed from the batch, and the next
+    requests are prefilled and join it.
+    Args:
+        model (Flamingo): the model
+        requests (iterable): (vision_x, lang_x) pairs of a single prompt each, of shapes
+            (1, T_img, F, C, H, W) and (1, T_txt). Requests are only read from the iterable
+            when the batch has room, so it can be fed by a queue.
+        batch_size (int): maximum number of rows decoded together
+        max_new_tokens (int): maximum number of generated tokens per request
+        min_new_tokens (int, optional): eos_token_id is not generated before this many tokens
+        eos_token_id (int, optional): token that ends a request
+        num_latents (int or tuple, optional): visual token budget per image.
+            See Flamingo._reduce_vision_latents().
+    Yields:
+        (index, output) as each request finishes, where index is the position of the
+        request in requests and output is its lang_x with the generated tokens appended
+    """
+    requests = enumerate(requests)
+    prompts = {}
+    batch = ContinuousBatch()
+    exhausted = False
+
+    def finish(request_id, token_ids):
+        lang_x = prompts.pop(request_id)
+        return request_id, torch.cat([lang_x, lang_x.new_tensor([token_ids])], dim=1)
+
+    while True:
+        # fill the free rows of the batch with new requests
+        while len(batch) < batch_size and not exhausted:
+            request = next(requests, None)
+            if request is None:
+                exhausted = True
+                break
+            request_id, (vision_x, lang_x) = request
+            prompts[request_id] = lang_x
+            attention_mask = torch.ones_like(lang_x)
+            with torch.no_grad():
+                conditioning = model.get_vision_conditioning(
+                    vision_x, num_latents=num_latents
+                )
+                with conditioning.activate():
+                    output = model.lang_encoder(
+                        input_ids=lang_x, attention_mask=attention_mask, use_cache=True
+                    )
+            logits = output.logits[:, -1]
+            if eos_token_id is not None and min_new_tokens > 0:
+                logits = logits.clone()
+                logits[:, eos_token_id] = -float("inf")
+            token_id = logits.argmax(dim=-1).item()
+            if token_id == eos_token_id or max_new_tokens == 1:
+                yield finish(request_id, [token_id])
+                continue
+            batch.add(
+                request_id,
+                token_id,
+                output.past_key_values,
+                attention_mask,
+                conditioning.vis_x,
+                conditioning.media_kv,
+                (lang_x == model.media_token_id).sum().item(),
+                conditioning.media_time,
+            )
+
+        if len(batch) == 0:
+            return
+
+        token_ids = batch.step(
+            model.lang_encoder,
+            eos_token_id=eos_token_id,
+            suppress_eos=[len(tokens) < min_new_tokens for tokens in batch.token_ids],
+        )
+        finished = [
+            i
+            for i, (token_id, tokens) in enumerate(zip(token_ids, batch.token_ids))
+            if token_id == eos_token_id or len(tokens) >= max_new_tokens
+        ]
+        for request_id, tokens in batch.remove(finished):
+            yield finish(request_id, tokens)
+
+
+def _left_pad_past_key_values(past_key_values, position_dims, num_positions):
+    return tuple(
+        tuple(
+            torch.cat(
+                [
+                    t.new_zeros(t.shape[:dim] + (num_positions,) + t.shape[dim + 1 :]),
+                    t,
+                ],
+                dim=dim,
+            )
+            for t, dim in zip(layer_past, layer_dims)
+        )
+        for layer_past, layer_dims in zip(past_key_values, position_dims)
+    )
+
+
+def _pad_dim(t, dim, size, value=0):
+    """Pad dimension dim of t with value (zeros by default) at the end, up to size."""
+    if t.shape[dim] == size:
+        return t
+    padding = t.new_full(
+        t.shape[:dim] + (size - t.shape[dim],) + t.shape[dim + 1 :], value
+    )
+    return torch.cat([t, padding], dim=dim)
@@ -1,11 +1,31 @@
+import json
+import os
+import warnings
+from contextlib import nullcontext
 from typing import Optional
 
+import torch
+from torch import nn
 from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.utils import is_accelerate_available
 import open_clip
+from open_clip.factory import HF_HUB_PREFIX
 
+try:
+    from open_clip.transform import (
+        PreprocessCfg,
+        image_transform_v2,
+        merge_preprocess_dict,
+    )
+except ImportError:
+    # open_clip < 2.24, whose image transforms only take the normalization
+    PreprocessCfg = None
+
+from .checkpoint import load_model_state_dict
 from .flamingo import Flamingo
 from .flamingo_lm import FlamingoLMMixin
-from .utils import extend_instance
+from .helpers import Int8WeightOnlyLinear
+from .utils import assign_state_dict, extend_instance, getattr_recursive
 
 
 def create_model_and_transforms(
@@ -18,6 +38,7 @@ def create_model_and_transforms(
     decoder_layers_attr_name: str = None,
     freeze_lm_embeddings: bool = False,
     cache_dir: Optional[str] = None,
+    checkpoint_path: Optional[str] = None,
     **flamingo_kwargs,
 ):
     """
@@ -34,18 +55,24 @@ def create_model_and_transforms(
         decoder_layers_attr_name (str, optional): name of the decoder layers attribute. Defaults to None.
         freeze_lm_embeddings (bool, optional): whether to freeze LM input embeddings when configuring Perceiver.
         cache_dir (str, optional): path to cache directory for downloading OpenClip/HF weights.
+        checkpoint_path (str, optional): path to a Flamingo checkpoint to load. The perceiver and cross attention
+            layers are then built on the meta device and materialised directly from the checkpoint instead of
+            being randomly initialized and overwritten, and the language model is loaded with low_cpu_mem_usage
+            if accelerate is installed.
     Returns:
         Flamingo: Flamingo model from pretrained vision and language encoders
         Image processor: Pipeline to preprocess input images
         Tokenizer: A tokenizer for the language model
     """
-    vision_encoder, _, image_processor = open_clip.create_model_and_transforms(
+    visual, image_processor = create_vision_encoder_and_transforms(
         clip_vision_encoder_path,
-        pretrained=clip_vision_encoder_pretrained,
+        clip_vision_encoder_pretrained,
         cache_dir=cache_dir,
     )
     # set the vision encoder to output the visual features
-    vision_encoder.visual.output_tokens = True
+    visual.output_tokens = True
+    # Flamingo takes the visual tower from vision_encoder.visual, like for a full CLIP model
+    vision_encoder = nn.ModuleDict({"visual": visual})
 
     text_tokenizer = AutoTokenizer.from_pretrained(
         tokenizer_path,
@@ -67,6 +94,7 @@ def create_model_and_transforms(
         local_files_only=use_local_files,
         trust_remote_code=True,
         cache_dir=cache_dir,
+        low_cpu_mem_usage=checkpoint_path is not None and is_accelerate_available(),
     )
 
     # hacks for MPT-1B, which doesn't have a get_input_embeddings method
@@ -89,17 +117,21 @@ def create_model_and_transforms(
     lang_encoder.set_decoder_layers_attr_name(decoder_layers_attr_name)
     lang_encoder.resize_token_embeddings(len(text_tokenizer))
 
-    model = Flamingo(
-        vision_encoder,
-        lang_encoder,
-        text_tokenizer.encode("<|endofchunk|>")[-1],
-        text_tokenizer.encode("<image>")[-1],
-        vis_dim=open_clip.get_model_config(clip_vision_encoder_path)["vision_cfg"][
-            "width"
-        ],
-        cross_attn_every_n_layers=cross_attn_every_n_layers,
-        **flamingo_kwargs,
-    )
+    # with a checkpoint, the new Flamingo modules are allocated when loading it
+    with torch.device("meta") if checkpoint_path is not None else nullcontext():
+        model = Flamingo(
+            vision_encoder,
+            lang_encoder,
+            text_tokenizer.encode("<|endofchunk|>")[-1],
+            text_tokenizer.encode("<image>")[-1],
+            vis_dim=_get_clip_configs(clip_vision_encoder_path, cache_dir)[0][
+                "vision_cfg"
+            ]["width"],
+            cross_attn_every_n_layers=cross_attn_every_n_layers,
+            **flamingo_kwargs,
+        )
+    if checkpoint_path is not None:
+        _load_flamingo_checkpoint(model, checkpoint_path)
 
     # Freeze all parameters
     model.requires_grad_(False)
@@ -119,6 +151,229 @@ def create_model_and_transforms(
     return model, image_processor, text_tokenizer
 
 
+def create_vision_encoder_and_transforms(
+    clip_vision_encoder_path: str,
+    clip_vision_encoder_pretrained: str,
+    cache_dir: Optional[str] = None,
+):
+    """
+    Build the visual tower of an OpenCLIP model and load its pretrained weights, without
+    allocating the text tower or keeping its weights in memory.
+
+    Args:
+        clip_vision_encoder_path (str): path to pretrained clip model (e.g. "ViT-B-32"), or an "hf-hub:" model id.
+            hf-hub: models are built and loaded by open_clip.create_model(), text tower included, from the config
+            and weights on the hub, and clip_vision_encoder_pretrained is ignored.
+        clip_vision_encoder_pretrained (str): name of pretraining dataset for clip model (e.g. "laion2b_s32b_b79k"),
+            or path to a CLIP checkpoint
+        cache_dir (str, optional): path to cache directory for downloading OpenClip weights.
+    Returns:
+        nn.Module: CLIP visual tower, equivalent to open_clip.create_model(...).visual
+        Image processor: Pipeline to preprocess input images, as built by open_clip.create_model_and_transforms()
+    """
+    _, preprocess_cfg = _get_clip_configs(clip_vision_encoder_path, cache_dir)
+    if clip_vision_encoder_path.startswith(HF_HUB_PREFIX):
+        visual = open_clip.create_model(
+            clip_vision_encoder_path, cache_dir=cache_dir
+        ).visual
+        return visual, _image_transform(visual.image_size, preprocess_cfg)
+
+    checkpoint_path = None
+    if clip_vision_encoder_pretrained:
+        pretrained_cfg = open_clip.get_pretrained_cfg(
+            clip_vision_encoder_path, clip_vision_encoder_pretrained
+        )
+        if pretrained_cfg:
+            checkpoint_path = open_clip.download_pretrained(
+                pretrained_cfg, cache_dir=cache_dir
+            )
+            # the preprocessing the weights were trained with
+            preprocess_cfg = pretrained_cfg
+        elif os.path.exists(clip_vision_encoder_pretrained):
+            checkpoint_path = clip_vision_encoder_pretrained
+        else:
+            raise RuntimeError(
+                f"Pretrained weights ({clip_vision_encoder_pretrained}) not found for model {clip_vision_encoder_path}."
+            )
+
+    # OpenAI models were trained with QuickGELU
+    is_openai = (clip_vision_encoder_pretrained or "").lower() == "openai"
+    # pretrained weights are allocated when loading them, not randomly initialized first.
+    # On the meta device, the text tower built alongside the visual one takes no memory
+    device = "meta" if checkpoint_path is not None else "cpu"
+    with torch.device(device) if checkpoint_path is not None else nullcontext():
+        visual = open_clip.create_model(
+            clip_vision_encoder_path, device=device, force_quick_gelu=is_openai
+        ).visual
+    if checkpoint_path is not None:
+        missing_keys = assign_state_dict(
+            visual, _load_visual_state_dict(checkpoint_path)
+        )
+        if len(missing_keys) > 0:
+            raise RuntimeError(
+                f"Missing keys in the vision encoder checkpoint {checkpoint_path}: {missing_keys}"
+            )
+    if is_openai:
+        visual.eval()
+
+    return visual, _image_transform(visual.image_size, preprocess_cfg)
+
+
+def _get_clip_configs(clip_vision_encoder_path, cache_dir=None):
+    """
+    Returns:
+        dict: model config of an OpenCLIP model
+        dict: preprocessing config stored with the model, for hf-hub: models, or {}
+    """
+    if clip_vision_encoder_path.startswith(HF_HUB_PREFIX):
+        config_path = open_clip.pretrained.download_pretrained_from_hf(
+            clip_vision_encoder_path[len(HF_HUB_PREFIX) :],
+            filename="open_clip_config.json",
+            cache_dir=cache_dir,
+        )
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return config["model_cfg"], config.get("preprocess_cfg", {})
+
+    model_cfg = open_clip.get_model_config(clip_vision_encoder_path)
+    if model_cfg is None:
+        raise ValueError(
+            f"Model config for {clip_vision_encoder_path} not found; available models {open_clip.list_models()}."
+        )
+    return model_cfg, {}
+
+
+def _image_transform(image_size, preprocess_cfg):
+    """
+    The inference image transform of open_clip.create_model_and_transforms() for a model
+    whose pretrained or hub config is preprocess_cfg: its normalization, and with recent
+    open_clip versions its interpolation and resize mode.
+    """
+    if PreprocessCfg is None:
+        return open_clip.image_transform(
+            image_size,
+            is_train=False,
+            mean=preprocess_cfg.get("mean", None),
+            std=preprocess_cfg.get("std", None),
+        )
+    preprocess_cfg = merge_preprocess_dict(
+        PreprocessCfg(), {**preprocess_cfg, "size": image_size}
+    )
+    return image_transform_v2(PreprocessCfg(**preprocess_cfg), is_train=False)
+
+
+def _load_visual_state_dict(checkpoint_path):
+    """Load the visual tower weights of a CLIP checkpoint, dropping all other weights."""
+    try:
+        # OpenAI checkpoints are TorchScript archives
+        state_dict = torch.jit.load(checkpoint_path, map_location="cpu").state_dict()
+    except RuntimeError:
+        state_dict = open_clip.factory.load_state_dict(checkpoint_path)
+    return {
+        k[len("visual.") :]: v for k, v in state_dict.items() if k.startswith("visual.")
+    }
+
+
+def _load_flamingo_checkpoint(model, checkpoint_path):
+    """
+    Materialise the Flamingo modules built on the meta device from a checkpoint saved by
+    train.py (torch.save or safetensors), in place. Other weights in the checkpoint (e.g. the LM embeddings) replace the
+    pretrained ones, like model.load_state_dict(checkpoint, strict=False).
+    As with strict=False, Flamingo weights missing from the checkpoint are not an error:
+    they are initialized as in the Flamingo constructors, with a warning.
+    """
+    missing_keys = assign_state_dict(model, load_model_state_dict(checkpoint_path))
+    if len(missing_keys) > 0:
+        warnings.warn(
+            f"Initializing weights missing from the Flamingo checkpoint {checkpoint_path}: {missing_keys}"
+        )
+        _init_meta_tensors(model, missing_keys)
+    # re-tie the output embeddings if the checkpoint replaced the input embeddings
+    model.lang_encoder.tie_weights()
+
+
+@torch.no_grad()
+def _init_meta_tensors(model, names):
+    """
+    Allocate the parameters of model named names, which are on the meta device, on the
+    CPU and initialize them as in the constructors of the Flamingo modules: linears and
+    layer norms with their default initialization, the tanh gates with zeros, and the
+    perceiver's latents and embeddings from a standard normal distribution.
+    """
+    for name in names:
+        module_name, _, tensor_name = name.rpartition(".")
+        module = getattr_recursive(model, module_name)
+        tensor = getattr(module, tensor_name)
+        if isinstance(module, nn.Linear):
+            reference = nn.Linear(
+                module.in_features, module.out_features, bias=module.bias is not None
+            )
+            value = getattr(reference, tensor_name)
+        elif isinstance(module, nn.LayerNorm):
+            value = (torch.ones if tensor_name == "weight" else torch.zeros)(
+                tensor.shape
+            )
+        elif tensor_name in ("attn_gate", "ff_gate"):
+            value = torch.zeros(tensor.shape)
+        else:
+            value = torch.randn(tensor.shape)
+        value = value.to(tensor.dtype)
+        if isinstance(tensor, nn.Parameter):
+            value = nn.Parameter(value, requires_grad=tensor.requires_grad)
+        setattr(module, tensor_name, value)
+
+
+def quantize_model(model: Flamingo, weight_only: bool = False):
+    """
+    Quantize the linear layers of a Flamingo model to int8 for inference, in place.
+    Covers the vision encoder, the perceiver, the gated cross-attention layers and the
+    language model decoder layers. Embeddings, the LM head, and the attention in-projections
+    of the CLIP vision encoder (stored as raw parameters) are left in full precision.
+    Call this after loading the checkpoint: the quantized model can no longer load
+    full-precision state dicts.
+
+    Args:
+        model (Flamingo): model to quantize
+        weight_only (bool, optional): whether to only quantize the weights, keeping
+            activations in full precision. Weight-only linears dequantize on the fly, work on
+            any device and halve the memory of bf16 weights (quarter of fp32 weights).
+            Otherwise, linears are dynamically quantized with torch.ao.quantization, which
+            also runs the matmuls in int8 but is CPU only. Defaults to False.
+    Returns:
+        Flamingo: the quantized model
+    """
+    model.eval()
+    model.requires_grad_(False)
+    if model.media_cache is not None:
+        # cached latents were computed by the full precision model
+        model.media_cache.clear()
+
+    modules = [model.vision_encoder, model.perceiver]
+    modules += list(model.lang_encoder._get_decoder_layers())
+    for module in modules:
+        if weight_only:
+            _replace_linears(module, Int8WeightOnlyLinear.from_float)
+        else:
+            assert all(
+                p.device.type == "cpu" for p in module.parameters()
+            ), "Dynamic int8 quantization is only supported on CPU. Use weight_only=True on GPU."
+            torch.ao.quantization.quantize_dynamic(
+                module, {nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+    return model
+
+
+def _replace_linears(module, fn):
+    """Recursively replace the nn.Linear children of module with fn(child)."""
+    for name, child in module.named_children():
+        # excludes subclasses such as the out_proj of nn.MultiheadAttention, whose weight
+        # is read directly by the attention function
+        if type(child) is nn.Linear:
+            setattr(module, name, fn(child))
+        else:
+            _replace_linears(child, fn)
+
+
 def _infer_decoder_layers_attr_name(model):
     for k in __KNOWN_DECODER_LAYERS_ATTR_NAMES:
         if k.lower() in model.__class__.__name__.lower():
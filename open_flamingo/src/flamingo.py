@@ -1,7 +1,17 @@
+import asyncio
+import contextlib
+import queue
+
 import torch
-from einops import rearrange
+import torch._dynamo
+from einops import rearrange, repeat
 from torch import nn
-from .helpers import PerceiverResampler
+from .helpers import (
+    MediaAttentionMask,
+    PerceiverResampler,
+    fold_layer_norm_into_linear,
+    reduce_latents,
+)
 from torch.distributed.fsdp.wrap import (
     enable_wrap,
     wrap,
@@ -10,8 +20,18 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 from torch.distributed.fsdp import (
     FullyShardedDataParallel as FSDP,
 )
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
+    CheckpointWrapper,
+)
 
-from .utils import apply_with_stopping_condition
+from .beam_search import generate_beam_search
+from .continuous_batching import generate_continuous
+from .flamingo_lm import PrefixState, VisionConditioning
+from .media_cache import MediaCache
+from .profiler import FlamingoProfiler
+from .speculative import generate_speculative
+from .streaming import END_OF_STREAM, IncrementalDecoder, start_generation_thread
+from .utils import apply_with_stopping_condition, get_position_ids
 
 
 class Flamingo(nn.Module):
@@ -24,6 +44,7 @@ class Flamingo(nn.Module):
         vis_dim: int,
         cross_attn_every_n_layers: int = 1,
         gradient_checkpointing: bool = False,
+        use_sdpa: bool = False,
     ):
         """
         Args:
@@ -34,6 +55,9 @@ class Flamingo(nn.Module):
             vis_dim (int): Dimension of the visual features.
                 Visual features are projected to match this shape along the last dimension.
             cross_attn_every_n_layers (int, optional): How often to apply cross attention after transformer layer. Defaults to 1.
+            gradient_checkpointing (bool, optional): Whether to use gradient checkpointing. Defaults to False.
+            use_sdpa (bool, optional): Whether the perceiver and cross attention layers should use
+                torch.nn.functional.scaled_dot_product_attention instead of the einsum implementation. Defaults to False.
         """
         super().__init__()
         self.eoc_token_id = eoc_token_id
@@ -45,7 +69,7 @@ class Flamingo(nn.Module):
             self.lang_dim = lang_encoder.config.hidden_size
 
         self.vision_encoder = vision_encoder.visual
-        self.perceiver = PerceiverResampler(dim=self.vis_dim)
+        self.perceiver = PerceiverResampler(dim=self.vis_dim, use_sdpa=use_sdpa)
         self.lang_encoder = lang_encoder
         self.lang_encoder.init_flamingo(
             media_token_id=media_token_id,
@@ -53,9 +77,16 @@ class Flamingo(nn.Module):
             vis_hidden_size=self.vis_dim,
             cross_attn_every_n_layers=cross_attn_every_n_layers,
             gradient_checkpointing=gradient_checkpointing,
+            use_sdpa=use_sdpa,
         )
         self._use_gradient_checkpointing = gradient_checkpointing
         self.perceiver._use_gradient_checkpointing = gradient_checkpointing
+        self.media_cache = None
+        # how num_latents budgets reduce the perceiver outputs: "pool" or "select"
+        self.latent_reduction = "pool"
+        # sizes that inputs are padded to once compiled, see compile()
+        self.prompt_length_buckets = None
+        self.num_images_buckets = None
 
     def forward(
         self,
@@ -66,6 +97,12 @@ class Flamingo(nn.Module):
         clear_conditioned_layers: bool = True,
         past_key_values=None,
         use_cache: bool = False,
+        media_ids=None,
+        conditioning: VisionConditioning = None,
+        prefix_state: PrefixState = None,
+        vision_x_mask: torch.Tensor = None,
+        num_latents=None,
+        prefill_chunk_size: int = None,
     ):
         """
         Forward pass of Flamingo.
@@ -86,14 +123,84 @@ class Flamingo(nn.Module):
                 CausalLM models.
             use_cache: whether to use cached key values. See use_cache
                 documentation in Hugging Face CausalLM models.
+            media_ids (list, optional): ids keying the images in vision_x in the media cache.
+                See _encode_vision_x().
+            conditioning (VisionConditioning, optional): vision conditioning returned by
+                get_vision_conditioning(), used instead of vision_x and of the layers' own
+                conditioning. It is not modified, so concurrent calls can share it. To decode
+                with past_key_values and lang_x without media tokens attending to the last
+                media of the previous call, make the calls within one
+                `with conditioning.activate():` block. Positions are then counted from the
+                attention mask, as in Hugging Face generate(), so padding (e.g. between a
+                prefix_state and left-padded queries) gets no positions.
+            prefix_state (PrefixState, optional): cached prefix returned by get_prefix_state().
+                If given, lang_x, vision_x and attention_mask only describe the text and
+                images that follow the prefix, and the returned past_key_values include it.
+            vision_x_mask (torch.Tensor, optional): marks the images of vision_x that are not
+                padding. See _encode_vision_x().
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
+            prefill_chunk_size (int, optional): run the language model on lang_x in chunks
+                of this many tokens, so that peak activation memory depends on the chunk size
+                rather than on the prompt length. The logits are the same. Only for inference:
+                labels are not supported. See _prefill_in_chunks().
         """
         assert (
             self.lang_encoder.initialized_flamingo
         ), "Flamingo layers are not initialized. Please call `init_flamingo` first."
 
+        if prefix_state is not None:
+            (
+                conditioning,
+                past_key_values,
+                attention_mask,
+            ) = self._get_prefix_conditioning(
+                prefix_state, vision_x, lang_x, attention_mask, media_ids, num_latents
+            )
+            vision_x = None
+
+        if prefill_chunk_size is not None and lang_x.shape[1] > prefill_chunk_size:
+            assert labels is None, "Chunked prefill does not support labels."
+            if conditioning is None:
+                assert (
+                    not self.lang_encoder._use_cached_vision_x
+                ), "Chunked prefill does not support media cached with cache_media()."
+                conditioning = self.get_vision_conditioning(
+                    vision_x, media_ids, vision_x_mask, num_latents
+                )
+            else:
+                assert (
+                    vision_x is None
+                ), "Expect vision_x to be None when passing a conditioning."
+            logits, past_key_values, _ = self._prefill_in_chunks(
+                conditioning,
+                lang_x,
+                attention_mask,
+                past_key_values,
+                prefill_chunk_size,
+            )
+            return CausalLMOutputWithPast(
+                logits=logits, past_key_values=past_key_values if use_cache else None
+            )
+
+        if conditioning is not None:
+            assert (
+                vision_x is None
+            ), "Expect vision_x to be None when passing a conditioning."
+            with conditioning.activate():
+                return self.lang_encoder(
+                    input_ids=lang_x,
+                    attention_mask=attention_mask,
+                    labels=labels,
+                    past_key_values=past_key_values,
+                    use_cache=use_cache,
+                    **self._get_position_kwargs(attention_mask, lang_x.shape[1]),
+                )
+
         assert (
             self.lang_encoder._use_cached_vision_x or vision_x is not None
         ), "Must provide either vision_x or have precached media using cache_media()."
+        num_pad_tokens = 0
 
         if self.lang_encoder._use_cached_vision_x:
             # Case: use cached; vision_x should be cached and other
@@ -105,7 +212,24 @@ class Flamingo(nn.Module):
 
         else:
             # Case: do not use caching (i.e. this is a standard forward pass);
-            self._encode_vision_x(vision_x=vision_x)
+            if past_key_values is None and not use_cache:
+                (
+                    vision_x,
+                    lang_x,
+                    attention_mask,
+                    vision_x_mask,
+                    media_ids,
+                    labels,
+                    num_pad_tokens,
+                ) = self._pad_to_compile_buckets(
+                    vision_x, lang_x, attention_mask, vision_x_mask, media_ids, labels
+                )
+            self._encode_vision_x(
+                vision_x=vision_x,
+                media_ids=media_ids,
+                vision_x_mask=vision_x_mask,
+                num_latents=num_latents,
+            )
             self._condition_media_locations(input_ids=lang_x)
 
         output = self.lang_encoder(
@@ -115,6 +239,8 @@ class Flamingo(nn.Module):
             past_key_values=past_key_values,
             use_cache=use_cache,
         )
+        if num_pad_tokens > 0:
+            output.logits = output.logits[:, num_pad_tokens:]
 
         if clear_conditioned_layers:
             self.lang_encoder.clear_conditioned_layers()
@@ -126,6 +252,16 @@ class Flamingo(nn.Module):
         vision_x: torch.Tensor,
         lang_x: torch.Tensor,
         attention_mask: torch.Tensor = None,
+        media_ids=None,
+        conditioning: VisionConditioning = None,
+        prefix_state: PrefixState = None,
+        vision_x_mask: torch.Tensor = None,
+        num_latents=None,
+        draft_model=None,
+        num_draft_tokens: int = 4,
+        speculative_stats=None,
+        share_prompt_across_beams: bool = False,
+        prefill_chunk_size: int = None,
         **kwargs,
     ):
         """
@@ -138,6 +274,30 @@ class Flamingo(nn.Module):
                 currently only F=1 is supported (single-frame videos)
             lang_x (torch.Tensor): Language input
                 shape (B, T_txt)
+            media_ids (list, optional): ids keying the images in vision_x in the media cache.
+                See _encode_vision_x().
+            conditioning (VisionConditioning, optional): vision conditioning returned by
+                get_vision_conditioning(), used instead of vision_x. The model's layers are
+                not conditioned, so concurrent calls can share the model (and the conditioning).
+            prefix_state (PrefixState, optional): cached prefix returned by get_prefix_state().
+                If given, lang_x, vision_x (which may be None) and attention_mask only describe
+                the query that follows the prefix. The prefix is not re-encoded.
+            vision_x_mask (torch.Tensor, optional): marks the images of vision_x that are not
+                padding. See _encode_vision_x().
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
+            draft_model (Flamingo, optional): smaller Flamingo with the same vision encoder
+                and tokenizer. If given, decode greedily with speculative decoding: the draft
+                model proposes num_draft_tokens tokens that this model verifies in a single
+                forward pass. See _generate_speculative().
+            num_draft_tokens (int, optional): tokens proposed by draft_model per step.
+            speculative_stats (speculative.SpeculativeDecodingStats, optional): accumulates
+                the draft acceptance statistics of speculative decoding.
+            share_prompt_across_beams (bool, optional): with num_beams > 1, keep a single copy
+                of each prompt's keys / values and media for all of its beams, instead of one
+                per beam. See _generate_beam_search().
+            prefill_chunk_size (int, optional): prefill the prompt in chunks of this many
+                tokens, to bound peak activation memory. See _prefill_in_chunks().
             **kwargs: see generate documentation in Hugging Face CausalLM models. Some notable kwargs:
                 max_length (int, optional): Maximum length of the output. Defaults to None.
                 attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
@@ -155,26 +315,798 @@ class Flamingo(nn.Module):
             torch.Tensor: lang_x with generated tokens appended to it
         """
         num_beams = kwargs.pop("num_beams", 1)
-        if num_beams > 1:
-            vision_x = vision_x.repeat_interleave(num_beams, dim=0)
 
-        self.lang_encoder._use_cached_vision_x = True
-        self._encode_vision_x(vision_x=vision_x)
+        if draft_model is not None:
+            assert (
+                num_beams == 1 and prefix_state is None and conditioning is None
+            ), "Speculative decoding does not support beam search, prefix_state or conditioning."
+            return self._generate_speculative(
+                draft_model,
+                vision_x,
+                lang_x,
+                attention_mask,
+                vision_x_mask=vision_x_mask,
+                num_latents=num_latents,
+                num_draft_tokens=num_draft_tokens,
+                speculative_stats=speculative_stats,
+                **kwargs,
+            )
+
+        # a prompt of a single token has no keys / values to share
+        if share_prompt_across_beams and num_beams > 1 and lang_x.shape[1] > 1:
+            assert (
+                prefix_state is None and prefill_chunk_size is None
+            ), "Sharing the prompt across beams does not support prefix_state or prefill_chunk_size."
+            return self._generate_beam_search(
+                vision_x,
+                lang_x,
+                attention_mask,
+                num_beams,
+                media_ids=media_ids,
+                conditioning=conditioning,
+                vision_x_mask=vision_x_mask,
+                num_latents=num_latents,
+                **kwargs,
+            )
+
+        if prefix_state is not None:
+            return self._generate_with_prefix(
+                prefix_state,
+                vision_x,
+                lang_x,
+                attention_mask,
+                media_ids=media_ids,
+                num_beams=num_beams,
+                num_latents=num_latents,
+                prefill_chunk_size=prefill_chunk_size,
+                **kwargs,
+            )
+
+        if prefill_chunk_size is not None:
+            if conditioning is None:
+                with torch.no_grad():
+                    conditioning = self.get_vision_conditioning(
+                        vision_x, media_ids, vision_x_mask, num_latents
+                    )
+            else:
+                assert (
+                    vision_x is None
+                ), "Expect vision_x to be None when passing a conditioning."
+            return self._generate_from_past(
+                conditioning,
+                lang_x,
+                attention_mask,
+                num_beams=num_beams,
+                prefill_chunk_size=prefill_chunk_size,
+                **kwargs,
+            )
+
+        num_pad_tokens = 0
+        if conditioning is None:
+            (
+                vision_x,
+                lang_x,
+                attention_mask,
+                vision_x_mask,
+                media_ids,
+                _,
+                num_pad_tokens,
+            ) = self._pad_to_compile_buckets(
+                vision_x, lang_x, attention_mask, vision_x_mask, media_ids
+            )
+            # encode each example's images once and share them across its beams
+            self.lang_encoder._use_cached_vision_x = True
+            self._encode_vision_x(
+                vision_x=vision_x,
+                media_ids=media_ids,
+                num_repeats=num_beams,
+                vision_x_mask=vision_x_mask,
+                num_latents=num_latents,
+            )
+            context = contextlib.nullcontext()
+        else:
+            assert (
+                vision_x is None
+            ), "Expect vision_x to be None when passing a conditioning."
+            # use a fresh copy so that the passed conditioning is never modified
+            context = conditioning.repeat_interleave(num_beams).activate()
 
         eos_token_id = kwargs.pop("eos_token_id", self.eoc_token_id)
-        output = self.lang_encoder.generate(
-            input_ids=lang_x,
+        try:
+            with context:
+                output = self.lang_encoder.generate(
+                    input_ids=lang_x,
+                    attention_mask=attention_mask,
+                    eos_token_id=eos_token_id,
+                    num_beams=num_beams,
+                    **kwargs,
+                )
+        finally:
+            if conditioning is None:
+                self.lang_encoder.clear_conditioned_layers()
+                self.lang_encoder._use_cached_vision_x = False
+        if num_pad_tokens > 0:
+            # drop the padding added by _pad_to_compile_buckets()
+            if isinstance(output, torch.Tensor):
+                output = output[:, num_pad_tokens:]
+            else:
+                output.sequences = output.sequences[:, num_pad_tokens:]
+        return output
+
+    def get_vision_conditioning(
+        self,
+        vision_x: torch.Tensor,
+        media_ids=None,
+        vision_x_mask: torch.Tensor = None,
+        num_latents=None,
+    ) -> VisionConditioning:
+        """
+        Encode vision_x into a VisionConditioning that can be passed to forward() / generate()
+        instead of conditioning the model's layers. This does not modify the model, so
+        several threads or asyncio tasks can encode and generate on one model concurrently.
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (B, T_img, F, C, H, W)
+            media_ids (list, optional): ids keying the images in vision_x in the media cache.
+                See _encode_vision_x().
+            vision_x_mask (torch.Tensor, optional): marks the images of vision_x that are not
+                padding. See _encode_vision_x().
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
+        """
+        vis_x, media_time = self._reduce_vision_latents(
+            self._get_vision_latents(vision_x, media_ids, vision_x_mask),
+            num_latents,
+            vision_x_mask,
+        )
+        return VisionConditioning(
+            vis_x, self._get_media_kv(vis_x), media_time=media_time
+        )
+
+    def get_vision_conditioning_from_latents(
+        self, vis_x: torch.Tensor, vision_x_mask: torch.Tensor = None, num_latents=None
+    ) -> VisionConditioning:
+        """
+        Like get_vision_conditioning(), but from perceiver outputs computed elsewhere,
+        e.g. by a vision encoder exported with vision_export.export_vision_encoder().
+        Args:
+            vis_x (torch.Tensor): perceiver outputs
+                shape (B, T_img, n, D)
+            vision_x_mask (torch.Tensor, optional): marks the images that are not padding.
+                Only used to find the query images for num_latents.
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
+        """
+        param = self.perceiver.latents
+        vis_x = vis_x.to(device=param.device, dtype=param.dtype)
+        vis_x, media_time = self._reduce_vision_latents(
+            vis_x, num_latents, vision_x_mask
+        )
+        return VisionConditioning(
+            vis_x, self._get_media_kv(vis_x), media_time=media_time
+        )
+
+    def _get_media_kv(self, vis_x):
+        """
+        Map the index of each decoder layer with cross attention to its keys and values
+        for vis_x.
+        """
+        media_kv = {}
+        for layer in self.lang_encoder._get_decoder_layers():
+            kv = layer.get_media_kv(vis_x)
+            if kv is not None:
+                media_kv[layer.layer_idx] = kv
+        return media_kv
+
+    def get_prefix_state(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        media_ids=None,
+        num_latents=None,
+    ) -> PrefixState:
+        """
+        Encode a prompt prefix shared by many queries (e.g. few-shot demonstrations) once,
+        so that forward() / generate() with prefix_state=... only process the query.
+        Args:
+            vision_x (torch.Tensor): Vision input for the prefix
+                shape (B, T_img, F, C, H, W), typically with B=1
+            lang_x (torch.Tensor): Language input for the prefix, containing one <image>
+                token per image in vision_x
+                shape (B, T_txt)
+            attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
+            media_ids (list, optional): ids keying the images in vision_x in the media cache.
+                See _encode_vision_x().
+            num_latents (int or tuple, optional): visual token budget per image. All prefix
+                images are demonstrations. Queries appended to the prefix must use the same
+                num_latents. See _reduce_vision_latents().
+        """
+        assert (
+            (lang_x == self.media_token_id).sum(dim=1) == vision_x.shape[1]
+        ).all(), "Each prefix must contain one <image> token per image in vision_x."
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x, dtype=torch.bool)
+        vis_x, media_time = self._reduce_vision_latents(
+            self._get_vision_latents(vision_x, media_ids),
+            num_latents,
+            has_query=False,
+        )
+        conditioning = VisionConditioning(
+            vis_x, self._get_media_kv(vis_x), media_time=media_time
+        )
+        output = self.forward(
+            vision_x=None,
+            lang_x=lang_x,
+            attention_mask=attention_mask,
+            use_cache=True,
+            conditioning=conditioning,
+        )
+        return PrefixState(
+            past_key_values=output.past_key_values,
             attention_mask=attention_mask,
-            eos_token_id=eos_token_id,
+            vis_x=conditioning.vis_x,
+            media_kv=conditioning.media_kv,
+            media_time=media_time,
+        )
+
+    def _get_prefix_conditioning(
+        self,
+        prefix_state,
+        vision_x,
+        lang_x,
+        attention_mask=None,
+        media_ids=None,
+        num_latents=None,
+    ):
+        """
+        Append the query vision_x / lang_x to prefix_state.
+        Returns:
+            VisionConditioning for the query, whose media timeline continues after the
+                prefix media
+            past_key_values of the prefix, repeated for each query if needed
+            attention_mask for the prefix and the query
+        """
+        batch_size = lang_x.shape[0]
+        (
+            past_key_values,
+            prefix_attention_mask,
+            vis_x,
+            media_kv,
+            media_time,
+        ) = prefix_state.expand(batch_size)
+        media_kv = dict(media_kv)
+        if vision_x is not None:
+            query_vis_x, query_media_time = self._reduce_vision_latents(
+                self._get_vision_latents(vision_x, media_ids), num_latents
+            )
+            assert (
+                query_vis_x.shape[2] == vis_x.shape[2]
+            ), "Queries must use the num_latents of the prefix."
+            if media_time is not None or query_media_time is not None:
+                # the query media continue the media timeline of the prefix
+                media_time = torch.cat(
+                    [
+                        self._get_media_time(vis_x, media_time),
+                        self._get_media_time(query_vis_x, query_media_time)
+                        + prefix_state.num_media,
+                    ],
+                    dim=1,
+                )
+            for layer in self.lang_encoder._get_decoder_layers():
+                kv = layer.get_media_kv(query_vis_x)
+                if kv is not None:
+                    # keys / values are laid out as (B, h, T_img * n, d)
+                    media_kv[layer.layer_idx] = tuple(
+                        torch.cat([prefix_t, t], dim=2)
+                        for prefix_t, t in zip(media_kv[layer.layer_idx], kv)
+                    )
+            vis_x = torch.cat([vis_x, query_vis_x], dim=1)
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x, dtype=torch.bool)
+        attention_mask = torch.cat(
+            [prefix_attention_mask.to(attention_mask.dtype), attention_mask], dim=1
+        )
+        media_offset = torch.full(
+            (batch_size,), prefix_state.num_media, device=lang_x.device
+        )
+        conditioning = VisionConditioning(
+            vis_x, media_kv, media_offset=media_offset, media_time=media_time
+        )
+        return conditioning, past_key_values, attention_mask
+
+    @staticmethod
+    def _get_media_time(vis_x, media_time=None):
+        """
+        Return media_time, or if None the media time of vis_x with one slot per image.
+        See _reduce_vision_latents().
+        """
+        if media_time is not None:
+            return media_time
+        B, T_img = vis_x.shape[:2]
+        return repeat(torch.arange(T_img, device=vis_x.device) + 1, "t -> b t", b=B)
+
+    def _generate_with_prefix(
+        self,
+        prefix_state,
+        vision_x,
+        lang_x,
+        attention_mask=None,
+        media_ids=None,
+        num_beams=1,
+        num_latents=None,
+        prefill_chunk_size=None,
+        **kwargs,
+    ):
+        """
+        Generate for queries appended to prefix_state. See generate().
+        Returns:
+            torch.Tensor: lang_x with generated tokens appended to it
+        """
+        conditioning, past_key_values, attention_mask = self._get_prefix_conditioning(
+            prefix_state, vision_x, lang_x, attention_mask, media_ids, num_latents
+        )
+        return self._generate_from_past(
+            conditioning,
+            lang_x,
+            attention_mask,
+            past_key_values,
             num_beams=num_beams,
+            prefill_chunk_size=prefill_chunk_size,
             **kwargs,
         )
 
-        self.lang_encoder.clear_conditioned_layers()
-        self.lang_encoder._use_cached_vision_x = False
-        return output
+    def _generate_from_past(
+        self,
+        conditioning,
+        lang_x,
+        attention_mask=None,
+        past_key_values=None,
+        num_beams=1,
+        prefill_chunk_size=None,
+        **kwargs,
+    ):
+        """
+        Generate for lang_x, which follows past_key_values (if any) and whose media are in
+        conditioning. When given past_key_values, Hugging Face generate() only feeds the
+        last input token, so all other tokens of lang_x are prefilled first, in chunks of
+        prefill_chunk_size tokens if given. The model's layers are not conditioned.
+        Args:
+            attention_mask (torch.Tensor, optional): attention mask of past_key_values
+                and lang_x
+        Returns:
+            torch.Tensor: lang_x with generated tokens appended to it
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(lang_x, dtype=torch.bool)
+        media_offset = conditioning.media_offset
+        if lang_x.shape[1] > 1:
+            with torch.no_grad():
+                _, past_key_values, media_offset = self._prefill_in_chunks(
+                    conditioning,
+                    lang_x[:, :-1],
+                    attention_mask[:, :-1],
+                    past_key_values,
+                    prefill_chunk_size or lang_x.shape[1],
+                    keep_logits=False,
+                )
+        # the last token continues the media timeline of the prefilled text, and the
+        # generated tokens attend to the last media, as in generate()
+        conditioning = VisionConditioning(
+            conditioning.vis_x,
+            conditioning.media_kv,
+            media_offset=media_offset,
+            media_time=conditioning.media_time,
+        )
+        if num_beams > 1:
+            # Hugging Face generate() expands the inputs, but not past_key_values, per beam
+            conditioning = conditioning.repeat_interleave(num_beams)
+            if past_key_values is not None:
+                past_key_values = tuple(
+                    tuple(t.repeat_interleave(num_beams, dim=0) for t in layer_past)
+                    for layer_past in past_key_values
+                )
+
+        eos_token_id = kwargs.pop("eos_token_id", self.eoc_token_id)
+        with conditioning.activate():
+            return self.lang_encoder.generate(
+                input_ids=lang_x,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                eos_token_id=eos_token_id,
+                num_beams=num_beams,
+                **kwargs,
+            )
+
+    def _prefill_in_chunks(
+        self,
+        conditioning,
+        lang_x,
+        attention_mask,
+        past_key_values,
+        chunk_size,
+        keep_logits=True,
+    ):
+        """
+        Run the language model on lang_x in chunks of chunk_size tokens, so that peak
+        activation memory depends on chunk_size rather than on the length of lang_x.
+        Each chunk attends to the past_key_values of the previous ones, and continues their
+        media timeline: the media of the previous chunks are added to the media_offset of
+        its conditioning, so every token attends to the same media as in a single forward
+        pass, and the logits are the same. Positions are counted from the attention mask,
+        as in Hugging Face generate(), so padding gets no positions.
+        Args:
+            conditioning (VisionConditioning): media of lang_x, and of past_key_values if any
+            lang_x (torch.Tensor): shape (B, T_txt)
+            attention_mask (torch.Tensor): attention mask of past_key_values and lang_x,
+                or None
+            past_key_values: the language model's past_key_values for the text preceding
+                lang_x, or None
+            chunk_size (int): number of tokens per chunk
+            keep_logits (bool, optional): if False, the logits are not kept
+        Returns:
+            logits for lang_x (or None if not keep_logits)
+            past_key_values including lang_x
+            media_offset (torch.Tensor): number of media preceding the text after lang_x
+        """
+        B, T_txt = lang_x.shape
+        media_offset = conditioning.media_offset
+        if media_offset is None:
+            media_offset = torch.zeros(B, dtype=torch.long, device=lang_x.device)
+        logits = []
+        for start in range(0, T_txt, chunk_size):
+            chunk = lang_x[:, start : start + chunk_size]
+            chunk_attention_mask = None
+            if attention_mask is not None:
+                # the attention mask also covers past_key_values passed in
+                end = attention_mask.shape[1] - T_txt + start + chunk.shape[1]
+                chunk_attention_mask = attention_mask[:, :end]
+            chunk_conditioning = VisionConditioning(
+                conditioning.vis_x,
+                conditioning.media_kv,
+                use_cached_vision_x=False,
+                media_offset=media_offset,
+                media_time=conditioning.media_time,
+            )
+            with chunk_conditioning.activate():
+                output = self.lang_encoder(
+                    input_ids=chunk,
+                    attention_mask=chunk_attention_mask,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    **self._get_position_kwargs(chunk_attention_mask, chunk.shape[1]),
+                )
+            past_key_values = output.past_key_values
+            if keep_logits:
+                logits.append(output.logits)
+            media_offset = media_offset + (chunk == self.media_token_id).sum(dim=1)
+        logits = torch.cat(logits, dim=1) if keep_logits else None
+        return logits, past_key_values, media_offset
+
+    def _get_position_kwargs(self, attention_mask, num_positions):
+        """
+        position_ids of the last num_positions tokens of attention_mask, which may cover
+        past_key_values, as a kwarg of the language model. Left padding and padding
+        between a prefix and its queries get no positions, as in Hugging Face generate().
+        Empty for language models that derive the positions from the attention mask.
+        """
+        if attention_mask is None or not self.lang_encoder.accepts_position_ids():
+            return {}
+        return {"position_ids": get_position_ids(attention_mask, num_positions)}
+
+    def _generate_speculative(
+        self,
+        draft_model,
+        vision_x,
+        lang_x,
+        attention_mask=None,
+        vision_x_mask=None,
+        num_latents=None,
+        num_draft_tokens=4,
+        speculative_stats=None,
+        **kwargs,
+    ):
+        """
+        Greedy generation with speculative decoding. See generate() and
+        speculative.generate_speculative(). The images are passed through this model's
+        vision encoder once, and the features are resampled by the perceivers of both
+        models; draft_model's vision encoder is not used. Neither model's layers are
+        conditioned, and the media cache is not used.
+        Supported kwargs: max_new_tokens (required), min_new_tokens, eos_token_id and
+        pad_token_id. length_penalty is ignored, as it only applies to beam search.
+        Returns:
+            torch.Tensor: lang_x with generated tokens appended to it
+        """
+        assert (
+            draft_model.media_token_id == self.media_token_id
+            and draft_model.vis_dim == self.vis_dim
+        ), "The draft model must use the same tokenizer and vision encoder."
+        assert not kwargs.pop(
+            "do_sample", False
+        ), "Speculative decoding only supports greedy decoding."
+        max_new_tokens = kwargs.pop("max_new_tokens", None)
+        assert max_new_tokens is not None, "Pass max_new_tokens."
+        min_new_tokens = kwargs.pop("min_new_tokens", 0) or 0
+        eos_token_id = kwargs.pop("eos_token_id", self.eoc_token_id)
+        pad_token_id = kwargs.pop(
+            "pad_token_id", self.lang_encoder.generation_config.pad_token_id
+        )
+        kwargs.pop("length_penalty", None)
+        if kwargs:
+            raise ValueError(
+                f"Speculative decoding does not support the arguments {sorted(kwargs)}"
+            )
+
+        with torch.no_grad():
+            features = self._get_vision_features(vision_x)
+            conditioning = self.get_vision_conditioning_from_latents(
+                self.perceiver(features), vision_x_mask, num_latents
+            )
+            draft_conditioning = draft_model.get_vision_conditioning_from_latents(
+                draft_model.perceiver(features), vision_x_mask, num_latents
+            )
+        # one activation for the whole generation, so that the decoding steps attend to
+        # the last media of the prompt
+        with conditioning.activate(), draft_conditioning.activate():
+            return generate_speculative(
+                self.lang_encoder,
+                draft_model.lang_encoder,
+                conditioning,
+                draft_conditioning,
+                lang_x,
+                attention_mask,
+                max_new_tokens,
+                num_draft_tokens=num_draft_tokens,
+                min_new_tokens=min_new_tokens,
+                eos_token_id=eos_token_id,
+                pad_token_id=pad_token_id,
+                stats=speculative_stats,
+            )
+
+    def _generate_beam_search(
+        self,
+        vision_x,
+        lang_x,
+        attention_mask,
+        num_beams,
+        media_ids=None,
+        conditioning=None,
+        vision_x_mask=None,
+        num_latents=None,
+        **kwargs,
+    ):
+        """
+        Beam search that stores each prompt's keys / values and media once, rather than
+        once per beam: only the keys / values of the generated tokens are stored per beam.
+        See generate() and beam_search.generate_beam_search(). The model's layers are not
+        conditioned.
+        Supported kwargs: max_new_tokens (required), min_new_tokens, eos_token_id,
+        pad_token_id, length_penalty, early_stopping and num_return_sequences.
+        Returns:
+            torch.Tensor: lang_x with generated tokens appended to it
+        """
+        generation_config = self.lang_encoder.generation_config
+        assert not kwargs.pop(
+            "do_sample", False
+        ), "Sharing the prompt across beams only supports beam search without sampling."
+        max_new_tokens = kwargs.pop("max_new_tokens", None)
+        assert max_new_tokens is not None, "Pass max_new_tokens."
+        min_new_tokens = kwargs.pop("min_new_tokens", 0) or 0
+        eos_token_id = kwargs.pop("eos_token_id", self.eoc_token_id)
+        pad_token_id = kwargs.pop("pad_token_id", generation_config.pad_token_id)
+        length_penalty = kwargs.pop("length_penalty", generation_config.length_penalty)
+        early_stopping = kwargs.pop("early_stopping", generation_config.early_stopping)
+        num_return_sequences = kwargs.pop(
+            "num_return_sequences", generation_config.num_return_sequences
+        )
+        if kwargs:
+            raise ValueError(
+                f"Sharing the prompt across beams does not support the arguments {sorted(kwargs)}"
+            )
+
+        if conditioning is None:
+            with torch.no_grad():
+                conditioning = self.get_vision_conditioning(
+                    vision_x, media_ids, vision_x_mask, num_latents
+                )
+        else:
+            assert (
+                vision_x is None
+            ), "Expect vision_x to be None when passing a conditioning."
+            # use a fresh copy so that the passed conditioning is never modified
+            conditioning = VisionConditioning(
+                conditioning.vis_x,
+                conditioning.media_kv,
+                use_cached_vision_x=conditioning.use_cached_vision_x,
+                media_offset=conditioning.media_offset,
+                media_time=conditioning.media_time,
+            )
+        # one activation for the whole generation, so that the decoding steps attend to
+        # the last media of the prompt
+        with conditioning.activate():
+            return generate_beam_search(
+                self.lang_encoder,
+                conditioning,
+                lang_x,
+                attention_mask,
+                num_beams,
+                max_new_tokens,
+                min_new_tokens=min_new_tokens,
+                eos_token_id=eos_token_id,
+                pad_token_id=pad_token_id,
+                length_penalty=length_penalty,
+                early_stopping=early_stopping,
+                num_return_sequences=num_return_sequences,
+            )
+
+    def generate_continuous(
+        self,
+        requests,
+        batch_size: int,
+        max_new_tokens: int,
+        min_new_tokens: int = 0,
+        eos_token_id: int = None,
+        num_latents=None,
+    ):
+        """
+        Greedy generation for a stream of prompts with continuous batching: up to
+        batch_size prompts are decoded together, finished rows leave the batch after every
+        step (shrinking the cached keys / values and media), and the next prompts are
+        prefilled to take their place. This avoids decoding finished rows until the
+        longest one ends, as batched generate() does.
+        The model's layers are not conditioned, and no padding is needed in the prompts.
+
+        Args:
+            requests (iterable): (vision_x, lang_x) pairs for one prompt each, of shapes
+                (1, T_img, F, C, H, W) and (1, T_txt). Read lazily, e.g. from a queue.
+            batch_size (int): maximum number of prompts decoded together
+            max_new_tokens (int): maximum number of tokens generated per prompt
+            min_new_tokens (int, optional): minimum number of tokens generated per prompt
+            eos_token_id (int, optional): Defaults to <|endofchunk|>.
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
+        Yields:
+            (index, output) as each prompt finishes, where index is the position of the
+            prompt in requests and output is its lang_x with the generated tokens appended
+        """
+        return generate_continuous(
+            self,
+            requests,
+            batch_size,
+            max_new_tokens,
+            min_new_tokens=min_new_tokens,
+            eos_token_id=eos_token_id
+            if eos_token_id is not None
+            else self.eoc_token_id,
+            num_latents=num_latents,
+        )
+
+    def generate_stream(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        tokenizer=None,
+        **kwargs,
+    ):
+        """
+        Like generate(), but yields the generated tokens as soon as they are produced.
+        Generation runs in a background thread, which keeps the model conditioned on
+        vision_x until the stream ends; do not use the model for anything else meanwhile.
+        If the stream is closed early, e.g. by breaking out of the loop, generation stops
+        at the next token and the stream waits for the thread to finish.
+        Only supports batch size 1 and num_beams=1.
 
-    def _encode_vision_x(self, vision_x: torch.Tensor):
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (1, T_img, F, C, H, W)
+            lang_x (torch.Tensor): Language input
+                shape (1, T_txt)
+            attention_mask (torch.Tensor, optional): Attention mask. Defaults to None.
+            tokenizer (optional): if given, yield increments of decoded text
+                instead of token ids.
+            **kwargs: see generate()
+        Yields:
+            int: generated token ids (including the final <|endofchunk|>), or
+            str: decoded text increments if tokenizer is given
+        """
+        self._check_stream_args(lang_x, kwargs)
+        stopping_criteria = kwargs.pop("stopping_criteria", None)
+        token_queue = queue.Queue()
+        thread, stop_event = start_generation_thread(
+            lambda streamer, stopping_criteria: self.generate(
+                vision_x,
+                lang_x,
+                attention_mask,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+                **kwargs,
+            ),
+            token_queue.put,
+            stopping_criteria=stopping_criteria,
+        )
+        decoder = IncrementalDecoder(tokenizer) if tokenizer is not None else None
+        try:
+            while True:
+                item = token_queue.get()
+                if item is END_OF_STREAM:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if decoder is None:
+                    yield item
+                else:
+                    text = decoder.step(item)
+                    if text:
+                        yield text
+        finally:
+            # also runs if the consumer stops early (GeneratorExit): stop generating at
+            # the next token and wait for generate() to release the model's layers
+            stop_event.set()
+            thread.join()
+
+    async def agenerate_stream(
+        self,
+        vision_x: torch.Tensor,
+        lang_x: torch.Tensor,
+        attention_mask: torch.Tensor = None,
+        tokenizer=None,
+        **kwargs,
+    ):
+        """
+        Async iterator variant of generate_stream(). Generation runs in a background
+        thread, so the event loop is not blocked while tokens are produced.
+        """
+        self._check_stream_args(lang_x, kwargs)
+        loop = asyncio.get_running_loop()
+        stopping_criteria = kwargs.pop("stopping_criteria", None)
+        token_queue = asyncio.Queue()
+        thread, stop_event = start_generation_thread(
+            lambda streamer, stopping_criteria: self.generate(
+                vision_x,
+                lang_x,
+                attention_mask,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+                **kwargs,
+            ),
+            lambda item: loop.call_soon_threadsafe(token_queue.put_nowait, item),
+            stopping_criteria=stopping_criteria,
+        )
+        decoder = IncrementalDecoder(tokenizer) if tokenizer is not None else None
+        try:
+            while True:
+                item = await token_queue.get()
+                if item is END_OF_STREAM:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if decoder is None:
+                    yield item
+                else:
+                    text = decoder.step(item)
+                    if text:
+                        yield text
+        finally:
+            # also runs if the consumer stops early or the task is cancelled
+            stop_event.set()
+            await loop.run_in_executor(None, thread.join)
+
+    def _check_stream_args(self, lang_x, generate_kwargs):
+        assert lang_x.shape[0] == 1, "Streaming only supports batch size 1."
+        assert (
+            generate_kwargs.get("num_beams", 1) == 1
+        ), "Streaming does not support beam search."
+
+    def _encode_vision_x(
+        self,
+        vision_x: torch.Tensor,
+        media_ids=None,
+        num_repeats: int = 1,
+        vision_x_mask: torch.Tensor = None,
+        num_latents=None,
+    ):
         """
         Compute media tokens from vision input by passing it through vision encoder and conditioning language model.
         Args:
@@ -182,22 +1114,499 @@ class Flamingo(nn.Module):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+            media_ids (list, optional): nested list of shape (B, T_img) with a hashable id
+                for each image, used as its key in the media cache instead of hashing the
+                image tensor. Entries may be None. Ignored if the media cache is disabled.
+            num_repeats (int, optional): number of times to repeat each example's media
+                along the batch dimension when conditioning the language model
+                (e.g. once per beam). The images themselves are only encoded once.
+            vision_x_mask (torch.Tensor, optional): True for the images of vision_x that are
+                not padding. Padding images are not passed through the vision encoder and the
+                perceiver, and their latents are zeros. Padding images must not be referenced
+                by an <image> token, so that text never attends to them.
+                shape (B, T_img)
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
 
         rearrange code based on https://github.com/dhansmair/flamingo-mini
         """
 
+        vision_x, media_time = self._reduce_vision_latents(
+            self._get_vision_latents(vision_x, media_ids, vision_x_mask),
+            num_latents,
+            vision_x_mask,
+        )
+        for layer in self.lang_encoder._get_decoder_layers():
+            layer.condition_vis_x(
+                vision_x, num_repeats=num_repeats, media_time=media_time
+            )
+
+    def _get_vision_latents(
+        self,
+        vision_x: torch.Tensor,
+        media_ids=None,
+        vision_x_mask=None,
+    ):
+        """
+        Compute the perceiver outputs for vision_x, using the media cache if it is enabled.
+        The media cache holds the full perceiver outputs, so it is shared by all budgets
+        (see _reduce_vision_latents()).
+        Returns:
+            shape (B, T_img, n, D) where n is the number of perceiver latents
+        """
         assert vision_x.ndim == 6, "vision_x should be of shape (b, T_img, F, C, H, W)"
         b, T, F = vision_x.shape[:3]
         assert F == 1, "Only single frame supported"
 
+        if vision_x_mask is not None and not vision_x_mask.all():
+            return self._get_masked_media_latents(vision_x, vision_x_mask, media_ids)
+        if self.media_cache is not None and not self.training:
+            return self._get_cached_media_latents(vision_x, media_ids)
+        return self._get_media_latents(vision_x)
+
+    def _reduce_vision_latents(
+        self, vis_x, num_latents=None, vision_x_mask=None, has_query=True
+    ):
+        """
+        Reduce the perceiver outputs to fewer visual tokens per image, at inference.
+        Fewer latents shrink the cross attention keys / values of every layer.
+        Args:
+            vis_x (torch.Tensor): perceiver outputs
+                shape (B, T_img, n, D)
+            num_latents (int or tuple, optional): number of latents to keep per image, or a
+                (num_demo_latents, num_query_latents) tuple with one budget for the
+                demonstration images and another for the query image, the last (non-padding)
+                image of each example. The larger budget must be a multiple of the smaller
+                one. Latents are reduced with self.latent_reduction (see reduce_latents()).
+                If None, all n latents are kept.
+            vision_x_mask (torch.Tensor, optional): marks the images of vision_x that are not
+                padding. See _encode_vision_x().
+            has_query (bool, optional): if False, all images are demonstrations.
+        Returns:
+            vis_x: shape (B, T_img, num_latents, D). For a tuple of different budgets, the
+                images are instead split into slots of s = min(num_latents) latents, and
+                each image takes as many consecutive slots as its budget needs, so that
+                demonstrations contribute fewer keys / values to the cross attention:
+                shape (B, S, s, D), with S the largest number of slots of a row.
+            media_time: None, or for a tuple of different budgets the (1-based) image of
+                each slot, or MediaAttentionMask.PADDING_MEDIA_TIME for the slots that pad
+                the rows with fewer slots.
+                shape (B, S)
+        """
+        if num_latents is None:
+            return vis_x, None
+        if isinstance(num_latents, int):
+            return reduce_latents(vis_x, num_latents, self.latent_reduction), None
+
+        num_demo_latents, num_query_latents = num_latents
+        if num_demo_latents == num_query_latents:
+            return self._reduce_vision_latents(vis_x, num_demo_latents)
+        s = min(num_latents)
+        assert (
+            num_demo_latents % s == 0 and num_query_latents % s == 0
+        ), f"The larger of the latent budgets {num_latents} must be a multiple of the smaller."
+        B, T_img = vis_x.shape[:2]
+        demo_slots = rearrange(
+            reduce_latents(vis_x, num_demo_latents, self.latent_reduction),
+            "b t (k s) d -> b (t k) s d",
+            s=s,
+        )
+        if not has_query:
+            media_time = torch.arange(T_img, device=vis_x.device) + 1
+            media_time = repeat(
+                media_time, "t -> b (t k)", b=B, k=num_demo_latents // s
+            )
+            return demo_slots, media_time
+        query_slots = rearrange(
+            reduce_latents(vis_x, num_query_latents, self.latent_reduction),
+            "b t (k s) d -> b (t k) s d",
+            s=s,
+        )
+
+        if vision_x_mask is not None:
+            num_images = vision_x_mask.to(device=vis_x.device).sum(dim=1)
+        else:
+            num_images = torch.full((B,), T_img, device=vis_x.device)
+        is_query = torch.arange(T_img, device=vis_x.device) == (num_images - 1)[:, None]
+        # lay out the slots of each image after the slots of the previous ones
+        num_slots = torch.where(is_query, num_query_latents // s, num_demo_latents // s)
+        slot_ends = num_slots.cumsum(dim=1)
+        S = slot_ends[:, -1].max().item()
+        slot = repeat(
+            torch.arange(S, device=vis_x.device), "j -> b j", b=B
+        ).contiguous()
+        image = torch.searchsorted(slot_ends, slot, right=True)
+        is_padding = image == T_img
+        image = image.clamp(max=T_img - 1)
+        position = slot - (slot_ends - num_slots).gather(1, image)
+        batch = torch.arange(B, device=vis_x.device)[:, None]
+        slots = torch.where(
+            rearrange(is_query.gather(1, image), "b j -> b j 1 1"),
+            query_slots[
+                batch,
+                (image * (num_query_latents // s) + position).clamp(
+                    max=query_slots.shape[1] - 1
+                ),
+            ],
+            demo_slots[
+                batch,
+                (image * (num_demo_latents // s) + position).clamp(
+                    max=demo_slots.shape[1] - 1
+                ),
+            ],
+        )
+        slots = slots.masked_fill(rearrange(is_padding, "b j -> b j 1 1"), 0.0)
+        media_time = torch.where(
+            is_padding, MediaAttentionMask.PADDING_MEDIA_TIME, image + 1
+        )
+        return slots, media_time
+
+    def _get_media_latents(self, vision_x: torch.Tensor):
+        """
+        Pass vision input through the vision encoder and the perceiver.
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (B, T_img, F, C, H, W)
+        Returns:
+            shape (B, T_img, n, D) where n is the number of perceiver latents
+        """
+        return self.perceiver(self._get_vision_features(vision_x))
+
+    def _get_vision_features(self, vision_x: torch.Tensor):
+        """
+        Pass vision input through the vision encoder.
+        Args:
+            vision_x (torch.Tensor): Vision input
+                shape (B, T_img, F, C, H, W)
+        Returns:
+            shape (B, T_img, F, v, d) where v is the number of vision tokens per frame
+        """
+        b, T, F = vision_x.shape[:3]
         vision_x = rearrange(vision_x, "b T F c h w -> (b T F) c h w")
         with torch.no_grad():
             vision_x = self.vision_encoder(vision_x)[1]
-        vision_x = rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
-        vision_x = self.perceiver(vision_x)
+        return rearrange(vision_x, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
 
-        for layer in self.lang_encoder._get_decoder_layers():
-            layer.condition_vis_x(vision_x)
+    def _get_masked_media_latents(self, vision_x, vision_x_mask, media_ids=None):
+        """
+        Like _get_vision_latents(), but only encodes the images where vision_x_mask is True.
+        The latents of the other images are zeros.
+        """
+        b, T, F = vision_x.shape[:3]
+        n, d = self.perceiver.latents.shape
+        is_valid = vision_x_mask.reshape(-1).to(
+            device=vision_x.device, dtype=torch.bool
+        )
+        images = rearrange(vision_x, "b T F c h w -> (b T) F c h w")[is_valid]
+        if len(images) == 0:
+            return self.perceiver.latents.new_zeros((b, T, n, d))
+
+        if self.perceiver.media_time_embs is None:
+            # the perceiver encodes each image independently
+            valid_media_ids = None
+            if media_ids is not None:
+                valid_media_ids = [
+                    [media_id]
+                    for media_id, valid in zip(
+                        (media_id for row in media_ids for media_id in row),
+                        is_valid.tolist(),
+                    )
+                    if valid
+                ]
+            valid_latents = self._get_vision_latents(
+                rearrange(images, "m F c h w -> m 1 F c h w"), valid_media_ids
+            )[:, 0]
+            latents = valid_latents.new_zeros((b * T, n, d))
+            latents[is_valid] = valid_latents
+            return rearrange(latents, "(b T) n d -> b T n d", b=b, T=T)
+
+        # the perceiver embeds the position of each image, so it sees all of them
+        with torch.no_grad():
+            valid_features = self.vision_encoder(
+                rearrange(images, "m F c h w -> (m F) c h w")
+            )[1]
+        features = valid_features.new_zeros((b * T * F,) + valid_features.shape[1:])
+        features[is_valid.repeat_interleave(F)] = valid_features
+        features = rearrange(features, "(b T F) v d -> b T F v d", b=b, T=T, F=F)
+        return self.perceiver(features)
+
+    def _get_cached_media_latents(self, vision_x: torch.Tensor, media_ids=None):
+        """
+        Like _get_media_latents(), but looks images up in the media cache first and only
+        encodes each distinct missing image once.
+        """
+        b, T = vision_x.shape[:2]
+        images = rearrange(vision_x, "b T F c h w -> (b T) F c h w")
+        keys = [
+            MediaCache.get_key(
+                image, media_ids[i // T][i % T] if media_ids is not None else None
+            )
+            for i, image in enumerate(images)
+        ]
+
+        latents = {}
+        missing = {}  # key -> index of the first image with that key
+        for i, key in enumerate(keys):
+            if key in latents or key in missing:
+                continue
+            cached = self.media_cache.get(key)
+            if cached is None:
+                missing[key] = i
+            else:
+                latents[key] = cached
+
+        if len(missing) > 0:
+            new_latents = self._get_media_latents(
+                rearrange(images[list(missing.values())], "m F c h w -> m 1 F c h w")
+            )
+            for key, new in zip(missing, new_latents[:, 0]):
+                self.media_cache.put(key, new)
+                latents[key] = new
+
+        vision_x = torch.stack([latents[key] for key in keys])
+        return rearrange(vision_x, "(b T) n d -> b T n d", b=b, T=T)
+
+    def get_cross_attn_gates(self):
+        """
+        tanh of the attention and feed-forward gates of each gated cross attention layer.
+        The gates scale what the layer adds to the residual stream, so layers with
+        near-zero gates barely change the language model's outputs.
+        Returns:
+            dict mapping decoder layer indices to (attn_gate, ff_gate) tuples
+        """
+        assert all(
+            layer is None or layer.attn_gate is not None
+            for layer in self.lang_encoder.gated_cross_attn_layers
+        ), "The gates were folded into the weights by freeze_for_inference()."
+        return {
+            layer_idx: (layer.attn_gate.tanh().item(), layer.ff_gate.tanh().item())
+            for layer_idx, layer in enumerate(self.lang_encoder.gated_cross_attn_layers)
+            if layer is not None
+        }
+
+    def skip_cross_attn_layers(self, threshold=None, num_layers=None):
+        """
+        Remove the gated cross attention layers with the smallest gates, for inference.
+        Their FlamingoLayers are rebuilt without cross attention, so they skip both the
+        attention and the feed-forward and no longer project the media to keys / values.
+        A layer's magnitude is the larger of |tanh(attn_gate)| and |tanh(ff_gate)|.
+        The skipped layers' weights are dropped from the state dict, so load checkpoints
+        before calling this. VisionConditionings and PrefixStates created before stay
+        valid, but media cached with cache_media() are cleared.
+        Args:
+            threshold (float, optional): skip the layers whose magnitude is below threshold
+            num_layers (int, optional): keep only the num_layers layers with the largest
+                magnitudes
+        Returns:
+            list of the decoder layer indices whose cross attention was skipped
+        """
+        assert (threshold is None) != (
+            num_layers is None
+        ), "Pass exactly one of threshold and num_layers."
+        magnitudes = {
+            layer_idx: max(abs(attn_gate), abs(ff_gate))
+            for layer_idx, (attn_gate, ff_gate) in self.get_cross_attn_gates().items()
+        }
+        if threshold is not None:
+            skipped = [
+                i for i, magnitude in magnitudes.items() if magnitude < threshold
+            ]
+        else:
+            num_skipped = max(len(magnitudes) - num_layers, 0)
+            skipped = sorted(magnitudes, key=magnitudes.get)[:num_skipped]
+
+        for layer_idx in skipped:
+            self.lang_encoder.gated_cross_attn_layers[layer_idx] = None
+        self.lang_encoder.init_flamingo_layers(self._use_gradient_checkpointing)
+        return sorted(skipped)
+
+    def freeze_for_inference(self):
+        """
+        Turn the model into an inference-only module, in place. Outputs match the original
+        model up to floating point rounding.
+        - Activation checkpointing wrappers (see train.py) are removed and gradient
+          checkpointing is disabled.
+        - tanh of each cross attention gate is folded into the output projection of the
+          attention / feed-forward it scales, and the gates are removed.
+        - The affine transforms of the layer norms that feed a single linear (the cross
+          attention's query norm and the feed-forward norms) are folded into that linear.
+        - With the einsum attention implementation (use_sdpa=False), the attention scale is
+          folded into the query projections.
+        The state dict no longer matches the trainable model, so load checkpoints and skip
+        layers (skip_cross_attn_layers()) before calling this, and quantize (quantize_model())
+        after.
+        Returns:
+            Flamingo: the frozen model
+        """
+        self.eval()
+        self.requires_grad_(False)
+        if self.media_cache is not None:
+            # cached latents were computed by the unfolded perceiver
+            self.media_cache.clear()
+
+        for module in list(self.modules()):
+            for name, child in module.named_children():
+                if isinstance(child, CheckpointWrapper):
+                    setattr(module, name, child._checkpoint_wrapped_module)
+        for module in self.modules():
+            if hasattr(module, "_use_gradient_checkpointing"):
+                module._use_gradient_checkpointing = False
+        if getattr(self.lang_encoder, "is_gradient_checkpointing", False):
+            self.lang_encoder.gradient_checkpointing_disable()
+
+        for attn, ff in self.perceiver.layers:
+            attn.freeze_for_inference()
+            fold_layer_norm_into_linear(ff[0], ff[1])
+        for layer in self.lang_encoder.gated_cross_attn_layers:
+            if layer is not None:
+                layer.freeze_for_inference()
+        return self
+
+    def profile(self, synchronize: bool = True) -> FlamingoProfiler:
+        """
+        Return a profiler recording the time, FLOPs and activation bytes of the vision
+        encoder, the perceiver, and each layer's gated cross attention and decoder layer.
+        Nothing is recorded until the profiler is started, e.g. with
+        `with model.profile() as profiler: ...`. See profiler.FlamingoProfiler.
+        """
+        return FlamingoProfiler(self, synchronize=synchronize)
+
+    def compile(
+        self,
+        prompt_length_buckets=(32, 64, 128, 256, 512, 1024, 2048),
+        num_images_buckets=(1, 2, 4, 8, 16, 32),
+        **compile_kwargs,
+    ):
+        """
+        Compile the language model's cross attention and decoder layers with torch.compile
+        for inference, in place.
+        The media locations are still analyzed eagerly, once per forward pass, and each
+        FlamingoLayer passes its conditioning to its compiled step as tensors, so the
+        compiled graphs neither break on nor specialize to the conditioning state (see
+        FlamingoLayer.compile()).
+        Note that the compiled cross attention always uses the dense implementation, whose
+        shapes do not depend on where the media tokens are: every text token scores the
+        latents of all images, which are then masked. The eager path instead attends only
+        to the immediately preceding image (MaskedCrossAttention._immediate_media_attention()),
+        whose shapes depend on the media locations and would recompile for every prompt.
+        The outputs are the same, but for prompts with many images the eager cross
+        attention does less work, so measure both (see
+        open_flamingo/scripts/benchmark_compile.py).
+        To bound the number of compiled shapes, forward() (without past_key_values or
+        use_cache) and generate() left-pad lang_x with masked tokens to the next prompt
+        length bucket, and pad vision_x with masked images (see vision_x_mask) to the next
+        image count bucket. Sizes beyond the largest bucket are not padded.
+        Skip layers, freeze_for_inference() and quantize before calling this.
+        torch._dynamo compiles one graph per layer and bucket, more than its default
+        cache_size_limit allows, so the limit is raised while the compiled layers run
+        (with torch._dynamo.config.patch); the global setting is not changed.
+        Args:
+            prompt_length_buckets (tuple of int, optional): prompt lengths to pad lang_x to.
+                None disables padding the text.
+            num_images_buckets (tuple of int, optional): image counts to pad vision_x to.
+                None disables padding the images.
+            **compile_kwargs: passed to torch.compile, e.g. mode="max-autotune"
+        Returns:
+            Flamingo: the compiled model
+        """
+        assert not self.training, "compile() is only meant for inference."
+        self.prompt_length_buckets = (
+            sorted(prompt_length_buckets) if prompt_length_buckets is not None else None
+        )
+        self.num_images_buckets = (
+            sorted(num_images_buckets) if num_images_buckets is not None else None
+        )
+
+        # all layers share the code objects that torch.compile caches graphs for, and
+        # each layer needs one graph per bucket for prefill and one for decoding
+        layers = self.lang_encoder._get_decoder_layers()
+        num_graphs = len(layers) * (
+            len(self.prompt_length_buckets or [None])
+            * len(self.num_images_buckets or [None])
+            + 1
+        )
+        cache_size_limit = max(torch._dynamo.config.cache_size_limit, num_graphs)
+        for layer in layers:
+            layer.compile(cache_size_limit=cache_size_limit, **compile_kwargs)
+        return self
+
+    def _pad_to_compile_buckets(
+        self,
+        vision_x,
+        lang_x,
+        attention_mask=None,
+        vision_x_mask=None,
+        media_ids=None,
+        labels=None,
+    ):
+        """
+        Pad the inputs to the bucket sizes set by compile(). Does nothing if the model
+        is not compiled.
+        Returns:
+            the padded vision_x, lang_x, attention_mask, vision_x_mask, media_ids and labels,
+            and the number of padding tokens prepended to lang_x
+        """
+        B, T_txt = lang_x.shape
+        num_pad_tokens = _get_bucket(T_txt, self.prompt_length_buckets) - T_txt
+        if num_pad_tokens > 0:
+            if attention_mask is None:
+                attention_mask = torch.ones_like(lang_x)
+            lang_x = nn.functional.pad(
+                lang_x, (num_pad_tokens, 0), value=self.eoc_token_id
+            )
+            attention_mask = nn.functional.pad(
+                attention_mask, (num_pad_tokens, 0), value=0
+            )
+            if labels is not None:
+                labels = nn.functional.pad(labels, (num_pad_tokens, 0), value=-100)
+
+        if vision_x is not None:
+            T_img = vision_x.shape[1]
+            num_pad_images = _get_bucket(T_img, self.num_images_buckets) - T_img
+            if num_pad_images > 0:
+                if vision_x_mask is None:
+                    vision_x_mask = torch.ones(
+                        B, T_img, dtype=torch.bool, device=vision_x.device
+                    )
+                vision_x = torch.cat(
+                    [
+                        vision_x,
+                        vision_x.new_zeros((B, num_pad_images) + vision_x.shape[2:]),
+                    ],
+                    dim=1,
+                )
+                vision_x_mask = torch.cat(
+                    [vision_x_mask, vision_x_mask.new_zeros(B, num_pad_images)], dim=1
+                )
+                if media_ids is not None:
+                    media_ids = [
+                        list(row) + [None] * num_pad_images for row in media_ids
+                    ]
+        return (
+            vision_x,
+            lang_x,
+            attention_mask,
+            vision_x_mask,
+            media_ids,
+            labels,
+            num_pad_tokens,
+        )
+
+    def enable_media_cache(self, max_bytes: int):
+        """
+        Cache perceiver outputs across calls, keyed by image content or caller-provided ids
+        (see _encode_vision_x()). Only used at inference, i.e. when the model is in eval mode.
+        The cache must be cleared if the vision encoder or perceiver weights change.
+        Args:
+            max_bytes (int): budget for the total size of the cached latents, in bytes
+        """
+        assert (
+            self.perceiver.media_time_embs is None
+        ), "The media cache requires the perceiver to encode each image independently."
+        self.media_cache = MediaCache(max_bytes)
+
+    def disable_media_cache(self):
+        self.media_cache = None
 
     def wrap_fsdp(self, wrapper_kwargs, device_id):
         """
@@ -312,7 +1721,14 @@ class Flamingo(nn.Module):
         for layer in self.lang_encoder._get_decoder_layers():
             layer.condition_media_locations(media_locations)
 
-    def cache_media(self, input_ids: torch.Tensor, vision_x: torch.Tensor):
+    def cache_media(
+        self,
+        input_ids: torch.Tensor,
+        vision_x: torch.Tensor,
+        media_ids=None,
+        vision_x_mask: torch.Tensor = None,
+        num_latents=None,
+    ):
         """
         Pre-cache a prompt/sequence of images / text for log-likelihood evaluations.
         All subsequent calls to forward() will generate attending to the LAST
@@ -325,8 +1741,19 @@ class Flamingo(nn.Module):
                 shape (B, T_img, F, C, H, W)
                 Images in the same chunk are collated along T_img, and frames are collated along F
                 Currently only F=1 is supported (single-frame videos)
+            media_ids (list, optional): ids keying the images in vision_x in the media cache.
+                See _encode_vision_x().
+            vision_x_mask (torch.Tensor, optional): marks the images of vision_x that are not
+                padding. See _encode_vision_x().
+            num_latents (int or tuple, optional): visual token budget per image.
+                See _reduce_vision_latents().
         """
-        self._encode_vision_x(vision_x=vision_x)
+        self._encode_vision_x(
+            vision_x=vision_x,
+            media_ids=media_ids,
+            vision_x_mask=vision_x_mask,
+            num_latents=num_latents,
+        )
         self._condition_media_locations(input_ids=input_ids)
         self.lang_encoder._use_cached_vision_x = True
 
@@ -336,3 +1763,10 @@ class Flamingo(nn.Module):
         """
         self.lang_encoder.clear_conditioned_layers()
         self.lang_encoder._use_cached_vision_x = False
+
+
+def _get_bucket(size, buckets):
+    """The smallest of the sorted buckets that fits size, or size if there is none."""
+    if buckets is None:
+        return size
+    return next((bucket for bucket in buckets if bucket >= size), size)
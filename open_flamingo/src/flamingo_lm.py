@@ -1,7 +1,238 @@
+import copy
+import inspect
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+import torch
+import torch._dynamo
 import torch.nn as nn
-from .helpers import GatedCrossAttentionBlock
+from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
+from .helpers import GatedCrossAttentionBlock, MediaAttentionMask
 from .utils import getattr_recursive, setattr_recursive
 
+_active_vision_conditioning = ContextVar("active_vision_conditioning", default=None)
+
+
+class VisionConditioning:
+    """
+    Vision conditioning for a single call, held outside of the model.
+    While a VisionConditioning is active, the FlamingoLayers read the media and media
+    locations from it instead of from their own (shared, mutable) state, so one model
+    can serve concurrent requests from several threads or asyncio tasks.
+    Activation is tracked with a context variable, which is local to each thread / task.
+    A VisionConditioning is never modified: each forward pass conditions a copy on its
+    media locations, which the next forward passes of the same activation build on.
+    Only meant for inference: the conditioning is not active during backward passes.
+    """
+
+    def __init__(
+        self,
+        vis_x,
+        media_kv=None,
+        use_cached_vision_x=True,
+        media_offset=None,
+        media_time=None,
+    ):
+        """
+        Args:
+            vis_x (torch.Tensor): perceiver outputs
+                shape (B, T_img, n, D), where T_img counts slots of n latents if
+                media_time is given
+            media_kv (dict, optional): maps the index of each decoder layer with cross
+                attention to its precomputed keys and values for vis_x
+            use_cached_vision_x (bool, optional): if True, forward passes without media
+                tokens attend to the last media seen in a previous forward pass of the same
+                activation (e.g. when decoding with past_key_values). Defaults to True.
+            media_offset (torch.Tensor, optional): number of media in vis_x that precede
+                the text passed to forward(), e.g. the media of a cached prefix.
+                shape (B,)
+            media_time (torch.Tensor, optional): media of each slot of vis_x, for media
+                with different numbers of latents. See MediaAttentionMask.
+                shape (B, T_img)
+        """
+        self.vis_x = vis_x
+        self.media_kv = media_kv if media_kv is not None else {}
+        self.use_cached_vision_x = use_cached_vision_x
+        self.media_offset = media_offset
+        self.media_time = media_time
+        self.media_locations = None
+        self.use_cached_media = False
+        self.media_attention_mask = None
+
+    def is_conditioned(self) -> bool:
+        return self.vis_x is not None and self.media_locations is not None
+
+    def condition_media_locations(self, media_locations, previous=None):
+        """
+        Return a copy of this conditioning for a forward pass on text with these
+        media_locations.
+        Args:
+            media_locations: boolean mask identifying the media tokens in the text
+                shape (B, T_txt)
+            previous (VisionConditioning, optional): the copy returned for the previous
+                forward pass of the same call, if any
+        """
+        # see FlamingoLMMixin.forward for why we keep the previous media locations
+        use_cached_media_locations = (
+            self.use_cached_vision_x
+            and previous is not None
+            and previous.is_conditioned()
+            and not media_locations.any()
+        )
+        conditioned = copy.copy(self)
+        conditioned.media_locations = (
+            previous.media_locations if use_cached_media_locations else media_locations
+        )
+        conditioned.use_cached_media = use_cached_media_locations
+
+        _, T_img, n = self.vis_x.shape[:3]
+        conditioned.media_attention_mask = MediaAttentionMask(
+            conditioned.media_locations,
+            T_img=T_img,
+            n=n,
+            use_cached_media=use_cached_media_locations,
+            T_txt=media_locations.shape[1],
+            media_offset=self.media_offset,
+            media_time=self.media_time,
+        )
+        return conditioned
+
+    def repeat_interleave(self, num_repeats):
+        """
+        Return a new VisionConditioning, not yet conditioned on any media locations,
+        with each example repeated num_repeats times along the batch dimension.
+        """
+        expand = (
+            lambda t: t.repeat_interleave(num_repeats, dim=0) if t is not None else None
+        )
+        return VisionConditioning(
+            expand(self.vis_x),
+            {
+                layer_idx: tuple(expand(t) for t in kv)
+                for layer_idx, kv in self.media_kv.items()
+            },
+            use_cached_vision_x=self.use_cached_vision_x,
+            media_offset=expand(self.media_offset),
+            media_time=expand(self.media_time),
+        )
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this the conditioning used by FlamingoLayers in the current thread / task.
+        The copies conditioned on media locations by the forward passes are kept until
+        the outermost activation exits, so nested activations (e.g. one per forward pass)
+        continue the media timeline of the enclosing one.
+        """
+        active = _active_vision_conditioning.get()
+        conditioned = active[1] if active is not None else {}
+        token = _active_vision_conditioning.set((self, conditioned))
+        try:
+            yield self
+        finally:
+            _active_vision_conditioning.reset(token)
+
+    @staticmethod
+    def get_active():
+        """
+        Return the active VisionConditioning, or None. Once a forward pass of the current
+        activation has conditioned it on media locations, this is the conditioned copy.
+        """
+        active = _active_vision_conditioning.get()
+        if active is None:
+            return None
+        conditioning, conditioned = active
+        return conditioned.get(conditioning, conditioning)
+
+    @staticmethod
+    def condition_active_media_locations(media_locations):
+        """
+        Condition the active VisionConditioning on media_locations for the next forward
+        pass. Returns the conditioned copy, or None if no conditioning is active.
+        """
+        active = _active_vision_conditioning.get()
+        if active is None:
+            return None
+        conditioning, conditioned = active
+        conditioned[conditioning] = conditioning.condition_media_locations(
+            media_locations, previous=conditioned.get(conditioning)
+        )
+        return conditioned[conditioning]
+
+
+class PrefixState:
+    """
+    Cached state of a shared prompt prefix (e.g. few-shot demonstrations): the language
+    model's past_key_values and the prefix media, to which queries can be appended
+    without re-encoding the prefix. See Flamingo.get_prefix_state().
+    The state is never modified, so it can be shared by concurrent calls.
+    """
+
+    def __init__(
+        self, past_key_values, attention_mask, vis_x, media_kv, media_time=None
+    ):
+        """
+        Args:
+            past_key_values: the language model's past_key_values for the prefix
+            attention_mask (torch.Tensor): attention mask of the prefix
+                shape (B, T_txt)
+            vis_x (torch.Tensor): perceiver outputs for the prefix media
+                shape (B, T_img, n, D)
+            media_kv (dict): maps the index of each decoder layer with cross attention
+                to its keys and values for vis_x
+            media_time (torch.Tensor, optional): media of each slot of vis_x.
+                See VisionConditioning.
+                shape (B, T_img)
+        """
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.vis_x = vis_x
+        self.media_kv = media_kv
+        self.media_time = media_time
+
+    @property
+    def batch_size(self):
+        return self.vis_x.shape[0]
+
+    @property
+    def num_media(self):
+        if self.media_time is None:
+            return self.vis_x.shape[1]
+        # the prefix media have no padding slots
+        return self.media_time[0, -1].item()
+
+    def expand(self, batch_size):
+        """
+        Return (past_key_values, attention_mask, vis_x, media_kv, media_time) for a batch
+        of batch_size queries, repeating a prefix of batch size 1 for every query.
+        """
+        if self.batch_size == batch_size:
+            return (
+                self.past_key_values,
+                self.attention_mask,
+                self.vis_x,
+                self.media_kv,
+                self.media_time,
+            )
+        assert (
+            self.batch_size == 1
+        ), f"Cannot expand a prefix of batch size {self.batch_size} to {batch_size} queries."
+        expand = lambda t: t.repeat_interleave(batch_size, dim=0)
+        past_key_values = tuple(
+            tuple(expand(t) for t in layer_past) for layer_past in self.past_key_values
+        )
+        media_kv = {
+            layer_idx: tuple(expand(t) for t in kv)
+            for layer_idx, kv in self.media_kv.items()
+        }
+        return (
+            past_key_values,
+            expand(self.attention_mask),
+            expand(self.vis_x),
+            media_kv,
+            expand(self.media_time) if self.media_time is not None else None,
+        )
+
 
 class FlamingoLayer(nn.Module):
     """
@@ -9,13 +240,25 @@ class FlamingoLayer(nn.Module):
     """
 
     def __init__(
-        self, gated_cross_attn_layer, decoder_layer, gradient_checkpointing=False
+        self,
+        gated_cross_attn_layer,
+        decoder_layer,
+        gradient_checkpointing=False,
+        layer_idx=None,
     ):
         super().__init__()
         self.gated_cross_attn_layer = gated_cross_attn_layer
         self.decoder_layer = decoder_layer
+        # index among the decoder layers, keying this layer's media keys / values in a
+        # VisionConditioning, which stays valid when the FlamingoLayers are rebuilt
+        self.layer_idx = layer_idx
         self.vis_x = None
+        self.media_kv = None
+        self.media_time = None
         self.media_locations = None
+        self.media_attention_mask = None
+        self.compiled = False
+        self.compile_cache_size_limit = None
         if self.gated_cross_attn_layer is not None:
             self.gated_cross_attn_layer._use_gradient_checkpointing = (
                 gradient_checkpointing
@@ -27,8 +270,46 @@ class FlamingoLayer(nn.Module):
         return self.vis_x is not None and self.media_locations is not None
 
     # Used this great idea from this implementation of Flamingo (https://github.com/dhansmair/flamingo-mini/)
-    def condition_vis_x(self, vis_x):
+    def condition_vis_x(self, vis_x, num_repeats=1, media_time=None):
+        """
+        Args:
+            vis_x (torch.Tensor): perceiver outputs
+                shape (B, T_img, n, D)
+            num_repeats (int, optional): number of times to repeat each example along
+                the batch dimension (e.g. once per beam). Keys / values are projected
+                before repeating.
+            media_time (torch.Tensor, optional): media of each slot of vis_x.
+                See VisionConditioning.
+                shape (B, T_img)
+        """
+        self.media_kv = None
+        if vis_x is not None:
+            self.media_kv = self.get_media_kv(vis_x, num_repeats=num_repeats)
+        if vis_x is not None and num_repeats > 1:
+            vis_x = vis_x.repeat_interleave(num_repeats, dim=0)
+        if media_time is not None and num_repeats > 1:
+            media_time = media_time.repeat_interleave(num_repeats, dim=0)
         self.vis_x = vis_x
+        self.media_time = media_time
+
+    def get_media_kv(self, vis_x, num_repeats=1):
+        """
+        Project vis_x to the cross attention keys / values, repeating each example
+        num_repeats times along the batch dimension.
+        Returns None if the layer has no cross attention, is training or is wrapped by
+        FSDP, in which case the keys / values are computed during the forward pass.
+        """
+        if self.gated_cross_attn_layer is None or self.training:
+            return None
+        if isinstance(self.gated_cross_attn_layer, FSDP):
+            # FSDP only gathers a wrapped layer's parameters inside its forward pass
+            return None
+        # at inference, project the media to keys / values once so that
+        # repeated forward passes (e.g. generate()) reuse them until cleared
+        media_kv = self.gated_cross_attn_layer.attn.get_media_kv(vis_x)
+        if num_repeats > 1:
+            media_kv = tuple(t.repeat_interleave(num_repeats, dim=0) for t in media_kv)
+        return media_kv
 
     def condition_media_locations(self, media_locations):
         self.media_locations = media_locations
@@ -36,34 +317,130 @@ class FlamingoLayer(nn.Module):
     def condition_use_cached_media(self, use_cached_media):
         self.use_cached_media = use_cached_media
 
+    def condition_media_attention_mask(self, media_attention_mask):
+        self.media_attention_mask = media_attention_mask
+
+    def compile(self, cache_size_limit=None, **compile_kwargs):
+        """
+        Run the cross attention and decoder layer with torch.compile. The conditioning is
+        still resolved eagerly in forward(), which passes it to the compiled steps as
+        tensors: the media, their keys / values and a DenseMediaAttentionMask, so the
+        cross attention always uses its dense implementation.
+        Forward passes without past_key_value (prefill) are compiled for static shapes,
+        the others (decoding) for dynamic shapes, since the past grows at every step.
+        See Flamingo.compile().
+        Args:
+            cache_size_limit (int, optional): torch._dynamo's cache_size_limit (the number
+                of graphs compiled per code object) while the compiled steps run. The
+                global setting is left untouched.
+        """
+        self._compiled_prefill_step = torch.compile(
+            self._prefill_step, dynamic=False, **compile_kwargs
+        )
+        self._compiled_decode_step = torch.compile(
+            self._decode_step, dynamic=True, **compile_kwargs
+        )
+        self.compile_cache_size_limit = cache_size_limit
+        self.compiled = True
+
     def forward(
         self,
         lang_x,
         attention_mask=None,
         **decoder_layer_kwargs,
     ):
-        # Cross attention
+        # read the conditioning from the active VisionConditioning if there is one
+        conditioning = VisionConditioning.get_active()
+        vis_x, media_kv, media_attention_mask = None, None, None
         if self.gated_cross_attn_layer is not None:
-            if self.vis_x is None:
+            state = self if conditioning is None else conditioning
+            media_kv = (
+                self.media_kv
+                if conditioning is None
+                else conditioning.media_kv.get(self.layer_idx)
+            )
+
+            if state.vis_x is None:
                 raise ValueError("vis_x must be conditioned before forward pass")
 
-            if self.media_locations is None:
+            if state.media_locations is None:
                 raise ValueError(
                     "media_locations must be conditioned before forward pass"
                 )
 
+            vis_x = state.vis_x
+            media_attention_mask = state.media_attention_mask
+            if not self.compiled:
+                lang_x = self.gated_cross_attn_layer(
+                    lang_x,
+                    vis_x,
+                    media_locations=state.media_locations,
+                    use_cached_media=state.use_cached_media,
+                    media_kv=media_kv,
+                    media_attention_mask=media_attention_mask,
+                )
+
+        if self.compiled:
+            if media_attention_mask is not None:
+                media_attention_mask = media_attention_mask.to_dense(
+                    self.gated_cross_attn_layer.attn.only_attend_immediate_media
+                )
+            step = (
+                self._compiled_prefill_step
+                if decoder_layer_kwargs.get("past_key_value") is None
+                else self._compiled_decode_step
+            )
+            config = (
+                torch._dynamo.config.patch(
+                    cache_size_limit=self.compile_cache_size_limit
+                )
+                if self.compile_cache_size_limit is not None
+                else nullcontext()
+            )
+            with config:
+                output = step(
+                    lang_x,
+                    vis_x,
+                    media_kv,
+                    media_attention_mask,
+                    attention_mask=attention_mask,
+                    **decoder_layer_kwargs,
+                )
+        else:
+            # Normal decoder layer
+            output = self.decoder_layer(
+                lang_x, attention_mask=attention_mask, **decoder_layer_kwargs
+            )
+
+        return output
+
+    def _step(
+        self,
+        lang_x,
+        vis_x,
+        media_kv,
+        media_attention_mask,
+        attention_mask=None,
+        **decoder_layer_kwargs,
+    ):
+        """Cross attention and decoder layer, given the conditioning as tensors."""
+        if self.gated_cross_attn_layer is not None:
             lang_x = self.gated_cross_attn_layer(
                 lang_x,
-                self.vis_x,
-                media_locations=self.media_locations,
-                use_cached_media=self.use_cached_media,
+                vis_x,
+                media_kv=media_kv,
+                media_attention_mask=media_attention_mask,
             )
-
-        # Normal decoder layer
-        lang_x = self.decoder_layer(
+        return self.decoder_layer(
             lang_x, attention_mask=attention_mask, **decoder_layer_kwargs
         )
-        return lang_x
+
+    # torch.compile caches graphs per code object, so prefill and decode get their own
+    def _prefill_step(self, *args, **kwargs):
+        return self._step(*args, **kwargs)
+
+    def _decode_step(self, *args, **kwargs):
+        return self._step(*args, **kwargs)
 
 
 class FlamingoLMMixin(nn.Module):
@@ -87,6 +464,7 @@ class FlamingoLMMixin(nn.Module):
         vis_hidden_size,
         cross_attn_every_n_layers,
         gradient_checkpointing,
+        use_sdpa=False,
     ):
         """
         Initialize Flamingo by adding a new gated cross attn to the decoder. Store the media token id for computing the media locations.
@@ -95,7 +473,7 @@ class FlamingoLMMixin(nn.Module):
         self.gated_cross_attn_layers = nn.ModuleList(
             [
                 GatedCrossAttentionBlock(
-                    dim=lang_hidden_size, dim_visual=vis_hidden_size
+                    dim=lang_hidden_size, dim_visual=vis_hidden_size, use_sdpa=use_sdpa
                 )
                 if (layer_idx + 1) % cross_attn_every_n_layers == 0
                 else None
@@ -116,10 +494,13 @@ class FlamingoLMMixin(nn.Module):
             nn.ModuleList(
                 [
                     FlamingoLayer(
-                        gated_cross_attn_layer, decoder_layer, gradient_checkpointing
+                        gated_cross_attn_layer,
+                        decoder_layer,
+                        gradient_checkpointing,
+                        layer_idx=layer_idx,
                     )
-                    for gated_cross_attn_layer, decoder_layer in zip(
-                        self.gated_cross_attn_layers, self.old_decoder_blocks
+                    for layer_idx, (gated_cross_attn_layer, decoder_layer) in enumerate(
+                        zip(self.gated_cross_attn_layers, self.old_decoder_blocks)
                     )
                 ]
             )
@@ -134,6 +515,15 @@ class FlamingoLMMixin(nn.Module):
 
         media_locations = input_ids == self.media_token_id
 
+        conditioning = VisionConditioning.condition_active_media_locations(
+            media_locations
+        )
+        if conditioning is not None:
+            # the conditioning travels with the call; leave the layers' state untouched
+            kwargs["input_ids"] = input_ids
+            kwargs["attention_mask"] = attention_mask
+            return super().forward(**kwargs)
+
         # if there are media already cached and we're generating and there are no media tokens in the input,
         # we'll assume that ALL input tokens should attend to the last previous media that is cached.
         # this is especially important for HF generate() compatibility, since generate() calls forward()
@@ -150,12 +540,35 @@ class FlamingoLMMixin(nn.Module):
                 layer.condition_media_locations(media_locations)
             layer.condition_use_cached_media(use_cached_media_locations)
 
+        # compute which media each text token attends to once, and share it across layers
+        media_attention_mask = None
+        if self.is_conditioned():
+            conditioned_layer = self._get_decoder_layers()[0]
+            _, T_img, n = conditioned_layer.vis_x.shape[:3]
+            media_attention_mask = MediaAttentionMask(
+                conditioned_layer.media_locations,
+                T_img=T_img,
+                n=n,
+                use_cached_media=use_cached_media_locations,
+                T_txt=input_ids.shape[1],
+                media_time=conditioned_layer.media_time,
+            )
+        for layer in self._get_decoder_layers():
+            layer.condition_media_attention_mask(media_attention_mask)
+
         # package arguments for the other parent's forward. since we don't know the order of the arguments,
         # make them all kwargs
         kwargs["input_ids"] = input_ids
         kwargs["attention_mask"] = attention_mask
         return super().forward(**kwargs)  # Call the other parent's forward method
 
+    def accepts_position_ids(self) -> bool:
+        """
+        Check whether the language model's forward() takes position_ids (e.g. for rotary
+        embeddings). Those that do not derive the positions from the attention mask.
+        """
+        return "position_ids" in inspect.signature(super().forward).parameters
+
     def is_conditioned(self) -> bool:
         """Check whether all decoder layers are already conditioned."""
         return all(l.is_conditioned() for l in self._get_decoder_layers())
@@ -165,3 +578,4 @@ class FlamingoLMMixin(nn.Module):
             layer.condition_vis_x(None)
             layer.condition_media_locations(None)
             layer.condition_use_cached_media(None)
+            layer.condition_media_attention_mask(None)
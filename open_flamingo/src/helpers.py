@@ -2,12 +2,20 @@
 Based on: https://github.com/lucidrains/flamingo-pytorch
 """
 
+from functools import cached_property
+from typing import NamedTuple
+
 import torch
+import torch.nn.functional as F
 from einops import rearrange, repeat
 from einops_exts import rearrange_many
 from torch import einsum, nn
 
 
+# int8 weight matmul kernel, in newer versions of torch
+_HAS_WEIGHT_INT8PACK_MM = hasattr(torch, "_weight_int8pack_mm")
+
+
 def exists(val):
     return val is not None
 
@@ -22,13 +30,80 @@ def FeedForward(dim, mult=4):
     )
 
 
+def reduce_latents(latents, num_latents, method="pool"):
+    """
+    Reduce the perceiver latents of each media to fewer visual tokens, at inference.
+    Args:
+        latents (torch.Tensor): perceiver outputs
+            shape (..., n, D)
+        num_latents (int): number of latents to keep, at most n
+        method (str): "pool" to average groups of consecutive latents, or "select"
+            to keep num_latents evenly spaced latents
+    Returns:
+        shape (..., num_latents, D)
+    """
+    n = latents.shape[-2]
+    assert 0 < num_latents <= n, f"num_latents must be in [1, {n}], got {num_latents}"
+    if num_latents == n:
+        return latents
+    if method == "pool":
+        d = latents.shape[-1]
+        pooled = F.adaptive_avg_pool1d(
+            latents.reshape(-1, n, d).transpose(1, 2), num_latents
+        )
+        return pooled.transpose(1, 2).reshape(latents.shape[:-2] + (num_latents, d))
+    if method == "select":
+        indices = torch.linspace(0, n - 1, num_latents, device=latents.device)
+        return latents.index_select(-2, indices.round().long())
+    raise ValueError(f"Unknown latent reduction method: {method}")
+
+
+@torch.no_grad()
+def fold_layer_norm_into_linear(norm: nn.LayerNorm, linear: nn.Linear):
+    """
+    Fold the elementwise affine transform of norm into linear, which must be the only
+    consumer of norm's output. linear(norm(x)) is unchanged, but norm no longer scales
+    and shifts its output, and linear gains a bias.
+    """
+    assert type(linear) is nn.Linear, "Fold layer norms before quantizing the model."
+    if not norm.elementwise_affine:
+        return
+    weight = linear.weight.float()
+    bias = weight @ norm.bias.float()
+    if linear.bias is not None:
+        bias = bias + linear.bias.float()
+    linear.weight.copy_(weight * norm.weight.float())
+    linear.bias = nn.Parameter(bias.to(linear.weight.dtype), requires_grad=False)
+    norm.weight, norm.bias = None, None
+    norm.elementwise_affine = False
+
+
+@torch.no_grad()
+def prescale_queries(attn):
+    """
+    Fold the attention scale of attn (a PerceiverAttention or MaskedCrossAttention)
+    into its query projection. Only for the einsum implementation: the fused
+    scaled_dot_product_attention kernels always apply the scale themselves.
+    """
+    if attn.use_sdpa or not exists(attn.scale):
+        return
+    assert type(attn.to_q) is nn.Linear, "Prescale queries before quantizing the model."
+    attn.to_q.weight.mul_(attn.scale)
+    if exists(attn.to_q.bias):
+        attn.to_q.bias.mul_(attn.scale)
+    attn.scale = None
+
+
 class PerceiverAttention(nn.Module):
-    def __init__(self, *, dim, dim_head=64, heads=8):
+    def __init__(self, *, dim, dim_head=64, heads=8, use_sdpa=False):
         super().__init__()
         self.scale = dim_head**-0.5
         self.heads = heads
         inner_dim = dim_head * heads
 
+        # whether to use torch's fused scaled_dot_product_attention kernels
+        self.use_sdpa = use_sdpa
+
         self.norm_media = nn.LayerNorm(dim)
         self.norm_latents = nn.LayerNorm(dim)
 
@@ -52,8 +127,17 @@ class PerceiverAttention(nn.Module):
         q = self.to_q(latents)
         kv_input = torch.cat((x, latents), dim=-2)
         k, v = self.to_kv(kv_input).chunk(2, dim=-1)
+
+        if self.use_sdpa:
+            b = q.shape[0]
+            q, k, v = rearrange_many((q, k, v), "b t n (h d) -> (b t) h n d", h=h)
+            out = F.scaled_dot_product_attention(q, k, v)
+            out = rearrange(out, "(b t) h n d -> b t n (h d)", b=b)
+            return self.to_out(out)
+
         q, k, v = rearrange_many((q, k, v), "b t n (h d) -> b h t n d", h=h)
-        q = q * self.scale
+        if exists(self.scale):
+            q = q * self.scale
 
         # attention
         sim = einsum("... i d, ... j d  -> ... i j", q, k)
@@ -64,6 +148,10 @@ class PerceiverAttention(nn.Module):
         out = rearrange(out, "b h t n d -> b t n (h d)", h=h)
         return self.to_out(out)
 
+    def freeze_for_inference(self):
+        """Fold the attention scale into to_q. See Flamingo.freeze_for_inference()."""
+        prescale_queries(self)
+
 
 class PerceiverResampler(nn.Module):
     def __init__(
@@ -77,6 +165,7 @@ class PerceiverResampler(nn.Module):
         max_num_media=None,
         max_num_frames=None,
         ff_mult=4,
+        use_sdpa=False,
     ):
         super().__init__()
         self.latents = nn.Parameter(torch.randn(num_latents, dim))
@@ -96,7 +185,9 @@ class PerceiverResampler(nn.Module):
             self.layers.append(
                 nn.ModuleList(
                     [
-                        PerceiverAttention(dim=dim, dim_head=dim_head, heads=heads),
+                        PerceiverAttention(
+                            dim=dim, dim_head=dim_head, heads=heads, use_sdpa=use_sdpa
+                        ),
                         FeedForward(dim=dim, mult=ff_mult),
                     ]
                 )
@@ -132,6 +223,208 @@ class PerceiverResampler(nn.Module):
         return self.norm(latents)
 
 
+class MediaAttentionMask:
+    """
+    Which media each text token may attend to in MaskedCrossAttention.
+    These only depend on the media locations, so they are built once per
+    forward pass and shared by all cross attention layers. Each mask is
+    computed lazily the first time a layer asks for it.
+    """
+
+    # media_time of padding slots, which no text token attends to
+    PADDING_MEDIA_TIME = torch.iinfo(torch.long).max
+
+    def __init__(
+        self,
+        media_locations,
+        T_img,
+        n,
+        use_cached_media=False,
+        T_txt=None,
+        media_offset=None,
+        media_time=None,
+    ):
+        """
+        Args:
+            media_locations: boolean mask identifying the media tokens in the text
+                shape (B, T_txt)
+            T_img (int): number of media slots of n latents each: the number of media,
+                unless media_time is given
+            n (int): number of latents per slot
+            use_cached_media (bool): if True, treat all T_txt text tokens as if they
+                occur after the last media registered in media_locations
+            T_txt (int, optional): number of text tokens. Required if use_cached_media.
+            media_offset (torch.Tensor, optional): number of media that precede the text,
+                e.g. in a cached prefix, and are not marked in media_locations.
+                shape (B,)
+            media_time (torch.Tensor, optional): 1-based index of the media each slot
+                belongs to, non-decreasing along each row, so that media can span different
+                numbers of consecutive slots (see Flamingo._reduce_vision_latents()). Padding
+                slots are PADDING_MEDIA_TIME. Defaults to one slot per media.
+                shape (B, T_img), or (B', T_img) where B is a multiple of B' and each row
+                is shared by B // B' consecutive rows of text (e.g. the beams of a prompt)
+        """
+        if use_cached_media:
+            # text time is set to the last cached media location
+            self.text_time = repeat(
+                torch.count_nonzero(media_locations, dim=1),
+                "b -> b i",
+                i=T_txt,
+            )
+        else:
+            # at each boolean of True, increment the time counter (relative to media time)
+            self.text_time = media_locations.cumsum(dim=-1)
+        if exists(media_offset):
+            self.text_time = self.text_time + rearrange(media_offset, "b -> b 1")
+        if exists(media_time):
+            B = self.text_time.shape[0]
+            if media_time.shape[0] != B:
+                media_time = media_time.repeat_interleave(
+                    B // media_time.shape[0], dim=0
+                )
+        else:
+            media_time = rearrange(
+                torch.arange(T_img, device=self.text_time.device) + 1, "j -> 1 j"
+            )
+        self.media_time = media_time
+        self.T_img = T_img
+        self.n = n
+        self._dense_masks = {}
+
+    @cached_property
+    def text_without_media(self):
+        """Boolean mask of the text tokens without a preceding media. shape (B, 1, T_txt, 1)"""
+        return rearrange(self.text_time == 0, "b i -> b 1 i 1")
+
+    @cached_property
+    def immediate_media_groups(self):
+        """
+        The text tokens that have a preceding media, grouped by that media, so that each
+        group attends to the latents of one media only. Groups are runs of consecutive
+        tokens of a row with the same media.
+        Returns:
+            batch_idx, token_idx: batch and position of each such text token
+                shape (N,)
+            group_idx: group of each such text token
+                shape (N,)
+            group_position: position of each such text token within its group
+                shape (N,)
+            group_batch_idx, group_slot_start, group_num_slots: batch, first slot and
+                number of slots of the media of each group. Groups whose media has no
+                slots (e.g. text referencing more media than given) attend to nothing.
+                shape (G,)
+            max_group_size (int): number of tokens in the largest group
+            num_slots (list of int): the distinct positive values of group_num_slots
+        """
+        batch_idx, token_idx = torch.nonzero(self.text_time > 0, as_tuple=True)
+        groups, group_idx, group_sizes = torch.unique_consecutive(
+            torch.stack([batch_idx, self.text_time[batch_idx, token_idx]], dim=1),
+            dim=0,
+            return_inverse=True,
+            return_counts=True,
+        )
+        group_starts = group_sizes.cumsum(dim=0) - group_sizes
+        group_position = (
+            torch.arange(len(batch_idx), device=batch_idx.device)
+            - group_starts[group_idx]
+        )
+        group_batch_idx, group_time = groups.unbind(dim=1)
+        # the slots of each media are consecutive, since media_time is sorted
+        media_time = self.media_time.expand(self.text_time.shape[0], -1)[
+            group_batch_idx
+        ]
+        group_time = rearrange(group_time, "g -> g 1").contiguous()
+        group_slot_start = torch.searchsorted(media_time, group_time)[:, 0]
+        group_num_slots = (
+            torch.searchsorted(media_time, group_time, right=True)[:, 0]
+            - group_slot_start
+        )
+        return (
+            batch_idx,
+            token_idx,
+            group_idx,
+            group_position,
+            group_batch_idx,
+            group_slot_start,
+            group_num_slots,
+            group_sizes.max().item() if len(group_sizes) > 0 else 0,
+            [c for c in group_num_slots.unique().tolist() if c > 0],
+        )
+
+    def get_dense_mask(self, only_attend_immediate_media):
+        """
+        Returns:
+            text_to_media_mask: True where a text token may attend to a latent
+                shape (B, 1, T_txt, T_img * n)
+            fully_masked: True for text tokens that may not attend to any latent
+                shape (B, 1, T_txt, 1)
+        """
+        if only_attend_immediate_media not in self._dense_masks:
+            # text time must equal media time if only attending to most immediate image
+            # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
+            mask_op = torch.eq if only_attend_immediate_media else torch.ge
+
+            text_to_media_mask = mask_op(
+                rearrange(self.text_time, "b i -> b 1 i 1"),
+                repeat(self.media_time, "b j -> b 1 1 (j n)", n=self.n),
+            )
+            fully_masked = ~text_to_media_mask.any(dim=-1, keepdim=True)
+            self._dense_masks[only_attend_immediate_media] = (
+                text_to_media_mask,
+                fully_masked,
+            )
+        return self._dense_masks[only_attend_immediate_media]
+
+    def to_dense(self, only_attend_immediate_media):
+        """Precompute the masks used by _dense_attention(). See DenseMediaAttentionMask."""
+        text_to_media_mask, fully_masked = self.get_dense_mask(
+            only_attend_immediate_media
+        )
+        return DenseMediaAttentionMask(
+            text_to_media_mask,
+            fully_masked,
+            self.text_without_media,
+            only_attend_immediate_media,
+        )
+
+
+class DenseMediaAttentionMask(NamedTuple):
+    """
+    The dense masks of a MediaAttentionMask, computed ahead of time. MaskedCrossAttention
+    always uses dense attention with these, whose shapes do not depend on the media
+    locations, so compiled layers (see Flamingo.compile()) take them as plain inputs.
+    """
+
+    text_to_media_mask: torch.Tensor
+    fully_masked: torch.Tensor
+    text_without_media: torch.Tensor
+    only_attend_immediate_media: bool
+
+    def get_dense_mask(self, only_attend_immediate_media):
+        assert only_attend_immediate_media == self.only_attend_immediate_media
+        return self.text_to_media_mask, self.fully_masked
+
+    def fold_repeats(self, batch_size, num_repeats):
+        """
+        Masks for queries folded from (B * num_repeats, T_txt) to (B, num_repeats * T_txt),
+        where groups of num_repeats consecutive rows share their media.
+        Masks of batch size B, where all the rows of a group share their text timeline,
+        are repeated instead.
+        """
+
+        def fold(mask):
+            if mask.shape[0] == batch_size:
+                return repeat(mask, "b 1 i j -> b 1 (r i) j", r=num_repeats)
+            return rearrange(mask, "(b r) 1 i j -> b 1 (r i) j", r=num_repeats)
+
+        return DenseMediaAttentionMask(
+            fold(self.text_to_media_mask),
+            fold(self.fully_masked),
+            fold(self.text_without_media),
+            self.only_attend_immediate_media,
+        )
+
+
 # gated cross attention
 class MaskedCrossAttention(nn.Module):
     def __init__(
@@ -142,6 +435,7 @@ class MaskedCrossAttention(nn.Module):
         dim_head=64,
         heads=8,
         only_attend_immediate_media=True,
+        use_sdpa=False,
     ):
         super().__init__()
         self.scale = dim_head**-0.5
@@ -157,7 +451,32 @@ class MaskedCrossAttention(nn.Module):
         # whether for text to only attend to immediate preceding image, or all previous images
         self.only_attend_immediate_media = only_attend_immediate_media
 
-    def forward(self, x, media, media_locations=None, use_cached_media=False):
+        # whether to use torch's fused scaled_dot_product_attention kernels
+        self.use_sdpa = use_sdpa
+
+    def get_media_kv(self, media):
+        """
+        Project media features to attention keys and values.
+        Args:
+            media (torch.Tensor): image features
+                shape (B, T_img, n, D_img) where n is the dim of the latents
+        Returns:
+            tuple of keys and values, each of shape (B, h, T_img * n, dim_head)
+        """
+        media = rearrange(media, "b t n d -> b (t n) d")
+        k, v = self.to_kv(media).chunk(2, dim=-1)
+        k, v = rearrange_many((k, v), "b n (h d) -> b h n d", h=self.heads)
+        return k, v
+
+    def forward(
+        self,
+        x,
+        media,
+        media_locations=None,
+        use_cached_media=False,
+        media_kv=None,
+        media_attention_mask=None,
+    ):
         """
         Args:
             x (torch.Tensor): text features
@@ -170,9 +489,18 @@ class MaskedCrossAttention(nn.Module):
                 If true, treat all of x as if they occur after the last media
                 registered in media_locations. T_txt does not need to exactly
                 equal media_locations.shape[1] in this case
+            media_kv: optional tuple of precomputed keys and values for media,
+                as returned by get_media_kv(). If None, they are computed from media.
+            media_attention_mask (MediaAttentionMask, optional): precomputed masks
+                for media_locations, shared across layers. If None, they are
+                computed from media_locations and use_cached_media.
+                A DenseMediaAttentionMask selects the dense attention implementation.
+                If media has a smaller batch size than x, each example of media is shared by
+                consecutive rows of x (e.g. the beams of a beam search), whose queries are
+                folded together so that the keys / values are never repeated.
         """
 
-        if not use_cached_media:
+        if not use_cached_media and exists(media_locations):
             assert (
                 media_locations.shape[1] == x.shape[1]
             ), f"media_location.shape is {media_locations.shape} but x.shape is {x.shape}"
@@ -184,53 +512,186 @@ class MaskedCrossAttention(nn.Module):
         x = self.norm(x)
 
         q = self.to_q(x)
-        media = rearrange(media, "b t n d -> b (t n) d")
-
-        k, v = self.to_kv(media).chunk(2, dim=-1)
-        q, k, v = rearrange_many((q, k, v), "b n (h d) -> b h n d", h=h)
+        q = rearrange(q, "b n (h d) -> b h n d", h=h)
+        k, v = media_kv if exists(media_kv) else self.get_media_kv(media)
+
+        if not exists(media_attention_mask) and exists(media_locations):
+            media_attention_mask = MediaAttentionMask(
+                media_locations,
+                T_img=T_img,
+                n=n,
+                use_cached_media=use_cached_media,
+                T_txt=T_txt,
+            )
 
-        q = q * self.scale
+        if k.shape[0] != q.shape[0]:
+            out = self._shared_media_attention(q, k, v, media_attention_mask)
+        elif (
+            isinstance(media_attention_mask, MediaAttentionMask)
+            and self.only_attend_immediate_media
+        ):
+            out = self._immediate_media_attention(q, k, v, media_attention_mask)
+        else:
+            out = self._dense_attention(q, k, v, media_attention_mask)
 
-        sim = einsum("... i d, ... j d -> ... i j", q, k)
+        out = rearrange(out, "b h n d -> b n (h d)")
+        return self.to_out(out)
 
-        if exists(media_locations):
-            media_time = torch.arange(T_img, device=x.device) + 1
+    def freeze_for_inference(self):
+        """
+        Fold the layer norm's affine transform and the attention scale into to_q.
+        See Flamingo.freeze_for_inference().
+        """
+        fold_layer_norm_into_linear(self.norm, self.to_q)
+        prescale_queries(self)
 
-            if use_cached_media:
-                # text time is set to the last cached media location
-                text_time = repeat(
-                    torch.count_nonzero(media_locations, dim=1),
-                    "b -> b i",
-                    i=T_txt,
-                )
-            else:
-                # at each boolean of True, increment the time counter (relative to media time)
-                text_time = media_locations.cumsum(dim=-1)
+    def _dense_attention(self, q, k, v, media_attention_mask):
+        """
+        Attend from every text token to the latents of all images, masking out
+        the images a token is not allowed to see.
+        Args:
+            q (torch.Tensor): shape (B, h, T_txt, d)
+            k, v (torch.Tensor): shape (B, h, T_img * n, d)
+            media_attention_mask (MediaAttentionMask or DenseMediaAttentionMask): or None
+                to attend to all media
+        Returns:
+            shape (B, h, T_txt, d)
+        """
+        text_to_media_mask, fully_masked = None, None
+        if exists(media_attention_mask):
+            text_to_media_mask, fully_masked = media_attention_mask.get_dense_mask(
+                self.only_attend_immediate_media
+            )
+        zero_text_without_media = (
+            exists(media_attention_mask) and self.only_attend_immediate_media
+        )
 
-            # text time must equal media time if only attending to most immediate image
-            # otherwise, as long as text time is greater than media time (if attending to all previous images / media)
-            mask_op = torch.eq if self.only_attend_immediate_media else torch.ge
+        if self.use_sdpa:
+            if exists(text_to_media_mask):
+                # scaled_dot_product_attention returns NaNs for fully masked rows;
+                # unmask them and then attend uniformly, as in the einsum path
+                text_to_media_mask = text_to_media_mask | fully_masked
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=text_to_media_mask)
+            if exists(fully_masked):
+                out = torch.where(fully_masked, v.mean(dim=-2, keepdim=True), out)
+            if zero_text_without_media:
+                # any text without a preceding media needs to have attention zeroed out
+                out = out.masked_fill(media_attention_mask.text_without_media, 0.0)
+            return out
+
+        if exists(self.scale):
+            q = q * self.scale
+        sim = einsum("... i d, ... j d -> ... i j", q, k)
 
-            text_to_media_mask = mask_op(
-                rearrange(text_time, "b i -> b 1 i 1"),
-                repeat(media_time, "j -> 1 1 1 (j n)", n=n),
-            )
+        if exists(text_to_media_mask):
             sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
 
         sim = sim - sim.amax(dim=-1, keepdim=True).detach()
         attn = sim.softmax(dim=-1)
 
-        if exists(media_locations) and self.only_attend_immediate_media:
+        if zero_text_without_media:
             # any text without a preceding media needs to have attention zeroed out
-            text_without_media_mask = text_time == 0
-            text_without_media_mask = rearrange(
-                text_without_media_mask, "b i -> b 1 i 1"
-            )
-            attn = attn.masked_fill(text_without_media_mask, 0.0)
+            attn = attn.masked_fill(media_attention_mask.text_without_media, 0.0)
 
-        out = einsum("... i j, ... j d -> ... i d", attn, v)
-        out = rearrange(out, "b h n d -> b n (h d)")
-        return self.to_out(out)
+        return einsum("... i j, ... j d -> ... i d", attn, v)
+
+    def _immediate_media_attention(self, q, k, v, media_attention_mask):
+        """
+        Attend from each text token only to the latents of its immediately
+        preceding image. Equivalent to _dense_attention with
+        only_attend_immediate_media=True, but the text tokens are grouped by image
+        (see MediaAttentionMask.immediate_media_groups) and each group attends to its
+        image's keys / values only, instead of scoring and masking all T_img images.
+        The keys / values are gathered once per group, not per token, and groups are
+        batched by the number of slots of their image, so images with fewer latents
+        contribute fewer keys.
+        Text tokens without a preceding image are skipped and output zeros.
+        Args:
+            q (torch.Tensor): shape (B, h, T_txt, d)
+            k, v (torch.Tensor): shape (B, h, T_img * n, d)
+            media_attention_mask (MediaAttentionMask)
+        Returns:
+            shape (B, h, T_txt, d)
+        """
+        B, h, T_txt, d = q.shape
+        (
+            batch_idx,
+            token_idx,
+            group_idx,
+            group_position,
+            group_batch_idx,
+            group_slot_start,
+            group_num_slots,
+            max_group_size,
+            num_slots,
+        ) = media_attention_mask.immediate_media_groups
+        full_out = q.new_zeros(B, T_txt, h, d)
+        if max_group_size == 0:
+            return rearrange(full_out, "b i h d -> b h i d")
+
+        # queries of each group, padded to the size of the largest group
+        group_q = q.new_zeros(len(group_batch_idx), max_group_size, h, d)
+        group_q[group_idx, group_position] = rearrange(q, "b h i d -> b i h d")[
+            batch_idx, token_idx
+        ]
+        group_q = rearrange(group_q, "g i h d -> g h i d")
+        k, v = rearrange_many(
+            (k, v), "b h (t n) d -> b t h n d", t=media_attention_mask.T_img
+        )
+
+        group_out = torch.zeros_like(group_q)
+        for c in num_slots:
+            groups = torch.nonzero(group_num_slots == c, as_tuple=True)[0]
+            batch = rearrange(group_batch_idx[groups], "g -> g 1")
+            slots = rearrange(group_slot_start[groups], "g -> g 1") + torch.arange(
+                c, device=q.device
+            )
+            group_k, group_v = rearrange_many(
+                (k[batch, slots], v[batch, slots]), "g c h n d -> g h (c n) d"
+            )
+            if self.use_sdpa:
+                out = F.scaled_dot_product_attention(group_q[groups], group_k, group_v)
+            else:
+                scaled_q = group_q[groups]
+                if exists(self.scale):
+                    scaled_q = scaled_q * self.scale
+                sim = einsum("... i d, ... j d -> ... i j", scaled_q, group_k)
+                attn = sim.softmax(dim=-1)
+                out = einsum("... i j, ... j d -> ... i d", attn, group_v)
+            group_out[groups] = out
+
+        full_out[batch_idx, token_idx] = rearrange(group_out, "g h i d -> g i h d")[
+            group_idx, group_position
+        ]
+        return rearrange(full_out, "b i h d -> b h i d")
+
+    def _shared_media_attention(self, q, k, v, media_attention_mask):
+        """
+        Dense attention for rows of q that share their media in groups of consecutive rows:
+        the rows of a group are folded into one row of longer text, which attends to the
+        group's keys / values.
+        Args:
+            q (torch.Tensor): shape (B * r, h, T_txt, d)
+            k, v (torch.Tensor): shape (B, h, T_img * n, d)
+            media_attention_mask (MediaAttentionMask or DenseMediaAttentionMask): or None
+                to attend to all media
+        Returns:
+            shape (B * r, h, T_txt, d)
+        """
+        B = k.shape[0]
+        num_repeats = q.shape[0] // B
+        assert (
+            q.shape[0] == B * num_repeats
+        ), f"Cannot share media of batch size {B} across {q.shape[0]} rows of text."
+        if isinstance(media_attention_mask, MediaAttentionMask):
+            media_attention_mask = media_attention_mask.to_dense(
+                self.only_attend_immediate_media
+            )
+        if exists(media_attention_mask):
+            media_attention_mask = media_attention_mask.fold_repeats(B, num_repeats)
+        q = rearrange(q, "(b r) h i d -> b h (r i) d", r=num_repeats)
+        out = self._dense_attention(q, k, v, media_attention_mask)
+        return rearrange(out, "b h (r i) d -> (b r) h i d", r=num_repeats)
 
 
 class GatedCrossAttentionBlock(nn.Module):
@@ -243,6 +704,7 @@ class GatedCrossAttentionBlock(nn.Module):
         heads=8,
         ff_mult=4,
         only_attend_immediate_media=True,
+        use_sdpa=False,
     ):
         super().__init__()
         self.attn = MaskedCrossAttention(
@@ -251,6 +713,7 @@ class GatedCrossAttentionBlock(nn.Module):
             dim_head=dim_head,
             heads=heads,
             only_attend_immediate_media=only_attend_immediate_media,
+            use_sdpa=use_sdpa,
         )
         self.attn_gate = nn.Parameter(torch.tensor([0.0]))
 
@@ -263,17 +726,108 @@ class GatedCrossAttentionBlock(nn.Module):
         media,
         media_locations=None,
         use_cached_media=False,
+        media_kv=None,
+        media_attention_mask=None,
     ):
-        x = (
-            self.attn(
-                x,
-                media,
-                media_locations=media_locations,
-                use_cached_media=use_cached_media,
-            )
-            * self.attn_gate.tanh()
-            + x
+        attn_out = self.attn(
+            x,
+            media,
+            media_locations=media_locations,
+            use_cached_media=use_cached_media,
+            media_kv=media_kv,
+            media_attention_mask=media_attention_mask,
         )
-        x = self.ff(x) * self.ff_gate.tanh() + x
+        # the gates are None once folded into the weights by freeze_for_inference()
+        if exists(self.attn_gate):
+            attn_out = attn_out * self.attn_gate.tanh()
+        x = attn_out + x
+        ff_out = self.ff(x)
+        if exists(self.ff_gate):
+            ff_out = ff_out * self.ff_gate.tanh()
+        x = ff_out + x
 
         return x
+
+    @torch.no_grad()
+    def freeze_for_inference(self):
+        """
+        Fold tanh of the gates into the output projections of the attention and the
+        feed-forward, which have no bias, and the feed-forward's layer norm into its first
+        linear. The gates are removed. See Flamingo.freeze_for_inference().
+        """
+        self.attn.freeze_for_inference()
+        fold_layer_norm_into_linear(self.ff[0], self.ff[1])
+        if exists(self.attn_gate):
+            self.attn.to_out.weight.mul_(
+                self.attn_gate.tanh().to(self.attn.to_out.weight.dtype)
+            )
+            self.attn_gate = None
+        if exists(self.ff_gate):
+            self.ff[3].weight.mul_(self.ff_gate.tanh().to(self.ff[3].weight.dtype))
+            self.ff_gate = None
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """
+    Linear layer storing its weight as int8 with one scale per output channel.
+    The weight is dequantized to the input dtype on the fly, so activations keep
+    full precision. Used to shrink the memory footprint of frozen linears for inference.
+    Where torch provides an int8 weight matmul kernel (torch._weight_int8pack_mm, on CPU)
+    it is used instead, and the weight is never dequantized.
+    """
+
+    # number of weight elements dequantized at a time: larger weights are dequantized
+    # one block of output channels after the other
+    dequant_block_numel = 2**22
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer(
+            "weight", torch.zeros(out_features, in_features, dtype=torch.int8)
+        )
+        self.register_buffer("weight_scale", torch.ones(out_features, 1))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear):
+        """Quantize the weight of linear symmetrically per output channel."""
+        weight = linear.weight.detach().float()
+        module = cls(
+            linear.in_features, linear.out_features, bias=linear.bias is not None
+        ).to(weight.device)
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        module.weight.copy_(torch.round(weight / scale).clamp(-127, 127))
+        module.weight_scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias = linear.bias.detach().clone()
+        return module
+
+    def forward(self, x):
+        if _HAS_WEIGHT_INT8PACK_MM and x.device.type == "cpu":
+            out = torch._weight_int8pack_mm(
+                x.reshape(-1, self.in_features),
+                self.weight,
+                self.weight_scale.view(-1).to(x.dtype),
+            ).view(*x.shape[:-1], self.out_features)
+        else:
+            # the per-channel scale is applied to the outputs rather than to the weight
+            scale = self.weight_scale.view(-1).to(x.dtype)
+            block_size = max(self.dequant_block_numel // self.in_features, 1)
+            if block_size >= self.out_features:
+                out = F.linear(x, self.weight.to(x.dtype)) * scale
+            else:
+                out = x.new_empty(*x.shape[:-1], self.out_features)
+                for start in range(0, self.out_features, block_size):
+                    end = min(start + block_size, self.out_features)
+                    out[..., start:end] = (
+                        F.linear(x, self.weight[start:end].to(x.dtype))
+                        * scale[start:end]
+                    )
+        if self.bias is not None:
+            out = out + self.bias.to(x.dtype)
+        return out
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
@@ -0,0 +1,98 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class MediaCache:
+    """
+    Content-addressed LRU cache of per-image perceiver outputs.
+    Images are keyed either by a caller-provided id or by a hash of the preprocessed
+    image tensor. Least recently used entries are evicted once the stored latents
+    exceed max_bytes. Safe to use from several threads.
+    """
+
+    def __init__(self, max_bytes: int):
+        """
+        Args:
+            max_bytes (int): budget for the total size of the cached latents, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @staticmethod
+    def get_key(image: torch.Tensor, media_id=None):
+        """
+        Args:
+            image (torch.Tensor): preprocessed image
+                shape (F, C, H, W)
+            media_id (hashable, optional): caller-provided id for the image.
+                If given, the image tensor is not hashed.
+        """
+        if media_id is not None:
+            return ("id", media_id)
+        image = image.detach().contiguous().cpu()
+        digest = hashlib.sha1(image.view(torch.uint8).numpy().tobytes()).hexdigest()
+        return ("hash", str(image.dtype), tuple(image.shape), digest)
+
+    def get(self, key):
+        """Return the cached latents for key, or None. Updates the hit / miss counters."""
+        with self._lock:
+            latents = self._entries.get(key)
+            if latents is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return latents
+
+    def put(self, key, latents: torch.Tensor):
+        """
+        Args:
+            key: key returned by get_key()
+            latents (torch.Tensor): perceiver output for a single image
+                shape (n, d)
+        """
+        size = self._size(latents)
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._size(self._entries.pop(key))
+            if size > self.max_bytes:
+                return
+            self._entries[key] = latents.detach()
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= self._size(evicted)
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    @staticmethod
+    def _size(latents):
+        return latents.numel() * latents.element_size()
@@ -0,0 +1,271 @@
+"""
+Opt-in profiler splitting Flamingo forward passes between the vision encoder, the perceiver,
+the gated cross attention layers and the language model's decoder layers.
+Hooks are only registered while the profiler is running, so a model that is not being
+profiled runs exactly as before.
+"""
+
+import json
+import time
+from collections import defaultdict
+
+import torch
+from torch import nn
+
+CATEGORIES = ("vision_encoder", "perceiver", "gated_cross_attn", "decoder_layer")
+
+
+class FlamingoProfiler:
+    """
+    Records the wall time, analytic FLOPs and output activation bytes of every call to the
+    vision encoder, the perceiver, and each FlamingoLayer's gated_cross_attn_layer and
+    decoder_layer. Calls are aggregated across the whole run.
+    Use as a context manager, or call start() / stop():
+
+        with model.profile() as profiler:
+            model.generate(...)
+        print(profiler.summary())
+        profiler.save_chrome_trace("trace.json")
+
+    FLOPs only count matrix multiplications: the linear layers, and the attention scores
+    and weighted values of the perceiver, cross attention and decoder self attention.
+    """
+
+    def __init__(self, model, synchronize=True):
+        """
+        Args:
+            model (Flamingo): model to profile
+            synchronize (bool, optional): synchronize CUDA before reading the clock, so that
+                times measure the kernels rather than their launch. Defaults to True.
+        """
+        self.model = model
+        self.synchronize = synchronize
+        self.events = []
+        self._handles = []
+        self._starts = {}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """Register the hooks. Events recorded by previous runs are kept."""
+        assert len(self._handles) == 0, "The profiler is already running."
+        if not self.events:
+            self._t0 = time.perf_counter()
+        modules = [
+            ("vision_encoder", "vision_encoder", self.model.vision_encoder),
+            ("perceiver", "perceiver", self.model.perceiver),
+        ]
+        for i, layer in enumerate(self.model.lang_encoder._get_decoder_layers()):
+            if layer.gated_cross_attn_layer is not None:
+                modules.append(
+                    (
+                        f"layers.{i}.gated_cross_attn_layer",
+                        "gated_cross_attn",
+                        layer.gated_cross_attn_layer,
+                    )
+                )
+            modules.append(
+                (f"layers.{i}.decoder_layer", "decoder_layer", layer.decoder_layer)
+            )
+
+        for name, category, module in modules:
+            matmul_params = _count_matmul_params(module)
+            self._handles.append(
+                module.register_forward_pre_hook(
+                    self._make_pre_hook(name), with_kwargs=True
+                )
+            )
+            self._handles.append(
+                module.register_forward_hook(
+                    self._make_hook(name, category, matmul_params), with_kwargs=True
+                )
+            )
+
+    def stop(self):
+        """Remove the hooks."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+        self._starts = {}
+
+    def reset(self):
+        """Drop the recorded events."""
+        self.events = []
+
+    def _now(self, tensors):
+        if self.synchronize and torch.cuda.is_available():
+            for t in tensors:
+                if isinstance(t, torch.Tensor) and t.is_cuda:
+                    torch.cuda.synchronize(t.device)
+                    break
+        return time.perf_counter()
+
+    def _make_pre_hook(self, name):
+        def hook(module, args, kwargs):
+            # modules may be re-entered (e.g. by activation checkpointing), so keep a stack
+            self._starts.setdefault(name, []).append(self._now(args))
+
+        return hook
+
+    def _make_hook(self, name, category, matmul_params):
+        def hook(module, args, kwargs, output):
+            end = self._now(_flatten_tensors(output))
+            start = self._starts[name].pop()
+            self.events.append(
+                {
+                    "name": name,
+                    "category": category,
+                    "start": start - self._t0,
+                    "duration": end - start,
+                    "flops": _estimate_flops(
+                        category, module, args, kwargs, output, matmul_params
+                    ),
+                    "activation_bytes": sum(
+                        t.numel() * t.element_size() for t in _flatten_tensors(output)
+                    ),
+                }
+            )
+
+        return hook
+
+    def summary(self):
+        """
+        Aggregate the events per category and per module.
+        Returns:
+            dict with "total" (summed over all profiled modules), "categories" and
+            "modules" entries, each with the number of calls, the total time in seconds,
+            FLOPs and output activation bytes, and the share of the profiled time
+        """
+
+        def aggregate(events):
+            return {
+                "calls": len(events),
+                "time": sum(e["duration"] for e in events),
+                "flops": sum(e["flops"] for e in events),
+                "activation_bytes": sum(e["activation_bytes"] for e in events),
+            }
+
+        by_category, by_module = defaultdict(list), defaultdict(list)
+        for event in self.events:
+            by_category[event["category"]].append(event)
+            by_module[event["name"]].append(event)
+
+        total = aggregate(self.events)
+        categories = {c: aggregate(by_category[c]) for c in CATEGORIES}
+        modules = {name: aggregate(events) for name, events in by_module.items()}
+        for stats in list(categories.values()) + list(modules.values()):
+            stats["time_share"] = (
+                stats["time"] / total["time"] if total["time"] else 0.0
+            )
+        return {"total": total, "categories": categories, "modules": modules}
+
+    def save_json(self, path):
+        """Save the summary and the raw events."""
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "events": self.events}, f, indent=4)
+
+    def save_chrome_trace(self, path):
+        """Save the events in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        trace = [
+            {
+                "name": event["name"],
+                "cat": event["category"],
+                "ph": "X",
+                "ts": event["start"] * 1e6,
+                "dur": event["duration"] * 1e6,
+                "pid": 0,
+                "tid": CATEGORIES.index(event["category"]),
+                "args": {
+                    "flops": event["flops"],
+                    "activation_bytes": event["activation_bytes"],
+                },
+            }
+            for event in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+
+def _flatten_tensors(x):
+    if isinstance(x, torch.Tensor):
+        return [x]
+    if isinstance(x, (tuple, list)):
+        return [t for item in x for t in _flatten_tensors(item)]
+    if isinstance(x, dict):
+        return [t for item in x.values() for t in _flatten_tensors(item)]
+    if hasattr(x, "to_tuple"):
+        # Hugging Face ModelOutput
+        return _flatten_tensors(x.to_tuple())
+    return []
+
+
+def _count_matmul_params(module):
+    """
+    Number of weights used in matrix multiplications: linear layers (including quantized
+    ones), convolutions and the input projections of nn.MultiheadAttention.
+    """
+    num_params = 0
+    for m in module.modules():
+        if isinstance(m, nn.Conv2d):
+            num_params += m.weight.numel()
+        elif hasattr(m, "in_features") and hasattr(m, "out_features"):
+            num_params += m.in_features * m.out_features
+        elif isinstance(m, nn.MultiheadAttention) and m.in_proj_weight is not None:
+            num_params += m.in_proj_weight.numel()
+    return num_params
+
+
+def _get_arg(args, kwargs, index, name):
+    if len(args) > index:
+        return args[index]
+    return kwargs.get(name)
+
+
+def _estimate_flops(category, module, args, kwargs, output, matmul_params):
+    """
+    Analytic FLOPs of one call, counting 2 FLOPs per multiply-accumulate.
+    Every weight of a linear layer is used once per token that goes through the module.
+    """
+    if category == "vision_encoder":
+        # ViT: every token of every image goes through all the blocks
+        images = args[0]
+        tokens = _flatten_tensors(output)[-1]
+        num_tokens = tokens.shape[1] + 1  # patch tokens and the class token
+        return 2 * images.shape[0] * num_tokens * matmul_params
+
+    if category == "perceiver":
+        b, T, F, v = args[0].shape[:4]
+        n = module.latents.shape[0]
+        attn = module.layers[0][0]
+        inner_dim = attn.to_q.out_features
+        # latents attend to the media features and themselves
+        linear = 2 * b * T * (F * v + n) * matmul_params
+        scores = 4 * b * T * n * (F * v + n) * inner_dim * len(module.layers)
+        return linear + scores
+
+    if category == "gated_cross_attn":
+        x = args[0]
+        media = _get_arg(args, kwargs, 1, "media")
+        B, T_txt = x.shape[:2]
+        _, T_img, n = media.shape[:3]
+        kv_params = module.attn.to_kv.in_features * module.attn.to_kv.out_features
+        flops = 2 * B * T_txt * (matmul_params - kv_params)
+        if _get_arg(args, kwargs, 4, "media_kv") is None:
+            flops += 2 * B * T_img * n * kv_params
+        attended = n if module.attn.only_attend_immediate_media else T_img * n
+        flops += 4 * B * T_txt * attended * module.attn.to_q.out_features
+        return flops
+
+    # decoder layer: self attention over the past and current tokens
+    hidden_states = args[0] if len(args) > 0 else kwargs.get("hidden_states")
+    B, T_txt, d = hidden_states.shape
+    T_ctx = T_txt
+    attention_mask = kwargs.get("attention_mask")
+    if isinstance(attention_mask, torch.Tensor) and attention_mask.dim() >= 2:
+        T_ctx = attention_mask.shape[-1]
+    return 2 * B * T_txt * matmul_params + 4 * B * T_txt * T_ctx * d
@@ -0,0 +1,237 @@
+"""
+Greedy speculative decoding: a small draft model proposes a few tokens, which the target
+model verifies in a single forward pass. See Flamingo.generate(draft_model=...).
+"""
+
+import torch
+
+from .utils import get_past_position_dims, narrow_past_key_values
+
+
+class SpeculativeDecodingStats:
+    """
+    Acceptance statistics of speculative decoding, accumulated over all the generate()
+    calls it is passed to.
+    """
+
+    def __init__(self):
+        # forward passes of the target model, including the prompt's
+        self.num_steps = 0
+        # tokens proposed by the draft model, and accepted by the target model
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        # tokens appended to the batch
+        self.num_generated_tokens = 0
+
+    @property
+    def acceptance_rate(self):
+        """Fraction of the draft tokens that were accepted."""
+        if self.num_draft_tokens == 0:
+            return 0.0
+        return self.num_accepted_tokens / self.num_draft_tokens
+
+    @property
+    def tokens_per_step(self):
+        """Generated tokens per forward pass of the target model (1 without a draft model)."""
+        if self.num_steps == 0:
+            return 0.0
+        return self.num_generated_tokens / self.num_steps
+
+    def __repr__(self):
+        return (
+            f"SpeculativeDecodingStats(acceptance_rate={self.acceptance_rate:.3f}, "
+            f"tokens_per_step={self.tokens_per_step:.2f}, "
+            f"num_draft_tokens={self.num_draft_tokens}, "
+            f"num_accepted_tokens={self.num_accepted_tokens})"
+        )
+
+
+@torch.no_grad()
+def generate_speculative(
+    lang_encoder,
+    draft_lang_encoder,
+    conditioning,
+    draft_conditioning,
+    input_ids,
+    attention_mask,
+    max_new_tokens,
+    num_draft_tokens=4,
+    min_new_tokens=0,
+    eos_token_id=None,
+    pad_token_id=None,
+    stats=None,
+):
+    """
+    Greedy decoding with lang_encoder, accelerated by draft_lang_encoder.
+    At every step, the draft model greedily proposes num_draft_tokens tokens one at a
+    time, and the target model scores all of them in a single forward pass. The longest
+    prefix of the proposal that matches the target model's own greedy choices is accepted,
+    followed by the target model's token at the first mismatch, so the output is the same
+    as greedy decoding with the target model alone.
+    Rows of a batch advance together: only the tokens accepted by all unfinished rows are
+    kept. Like Hugging Face generate(), finished rows are padded with pad_token_id.
+
+    Args:
+        lang_encoder: target language model, with the Flamingo layers
+        draft_lang_encoder: draft language model, with the same tokenizer
+        conditioning (VisionConditioning): vision conditioning of the target model
+        draft_conditioning (VisionConditioning): vision conditioning of the draft model.
+            Both must be activated around the call, so that the decoding steps attend to
+            the last media of the prompt.
+        input_ids (torch.Tensor): prompt
+            shape (B, T_txt)
+        attention_mask (torch.Tensor): attention mask of the prompt, or None
+        max_new_tokens (int): maximum number of generated tokens
+        num_draft_tokens (int, optional): tokens proposed by the draft model per step
+        min_new_tokens (int, optional): eos_token_id is not generated before this many tokens
+        eos_token_id (int, optional): token that ends a row
+        pad_token_id (int, optional): token appended to finished rows. Defaults to eos_token_id.
+        stats (SpeculativeDecodingStats, optional): statistics to update
+    Returns:
+        torch.Tensor: input_ids with the generated tokens appended to it
+    """
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    if pad_token_id is None:
+        pad_token_id = eos_token_id
+
+    def forward(model, model_conditioning, ids, past_key_values, total_length):
+        """Forward pass on ids, the last of total_length tokens."""
+        mask = torch.cat(
+            [
+                attention_mask,
+                attention_mask.new_ones(
+                    attention_mask.shape[0], total_length - attention_mask.shape[1]
+                ),
+            ],
+            dim=1,
+        )
+        with model_conditioning.activate():
+            output = model(
+                input_ids=ids,
+                attention_mask=mask,
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+        return output.logits, output.past_key_values
+
+    def greedy(logits, num_generated):
+        """Greedy tokens for logits of shape (B, T, V), the first being new token num_generated."""
+        if eos_token_id is not None and num_generated < min_new_tokens:
+            positions = torch.arange(logits.shape[1], device=logits.device)
+            suppress_eos = positions + num_generated < min_new_tokens
+            logits = logits.clone()
+            logits[:, suppress_eos, eos_token_id] = -float("inf")
+        return logits.argmax(dim=-1)
+
+    # prefill both models on the prompt
+    prompt_length = input_ids.shape[1]
+    logits, past_key_values = forward(
+        lang_encoder, conditioning, input_ids, None, prompt_length
+    )
+    _, draft_past_key_values = forward(
+        draft_lang_encoder, draft_conditioning, input_ids, None, prompt_length
+    )
+    # the last token of the sequence is always the target model's greedy token, which
+    # neither model has processed yet
+    sequence = torch.cat([input_ids, greedy(logits[:, -1:], 0)], dim=1)
+    attention_mask = torch.cat(
+        [attention_mask, attention_mask.new_ones(attention_mask.shape[0], 1)], dim=1
+    )
+    finished = (
+        sequence[:, -1] == eos_token_id
+        if eos_token_id is not None
+        else torch.zeros_like(sequence[:, -1], dtype=torch.bool)
+    )
+    num_generated = 1
+    target_length = draft_length = prompt_length
+    if stats is not None:
+        stats.num_steps += 1
+        stats.num_generated_tokens += 1
+
+    while num_generated < max_new_tokens and not finished.all():
+        length = sequence.shape[1]
+        num_proposed = min(num_draft_tokens, max_new_tokens - num_generated - 1)
+
+        # the draft model proposes num_proposed tokens
+        draft_tokens = sequence.new_zeros(sequence.shape[0], 0)
+        if num_proposed > 0:
+            previous_draft_past_key_values = draft_past_key_values
+            ids = sequence[:, draft_length:]
+            for i in range(num_proposed):
+                draft_logits, draft_past_key_values = forward(
+                    draft_lang_encoder,
+                    draft_conditioning,
+                    ids,
+                    draft_past_key_values,
+                    length + i,
+                )
+                ids = greedy(draft_logits[:, -1:], num_generated + i)
+                draft_tokens = torch.cat([draft_tokens, ids], dim=1)
+
+        # the target model scores the last token and the proposal in one forward pass
+        previous_past_key_values = past_key_values
+        logits, past_key_values = forward(
+            lang_encoder,
+            conditioning,
+            torch.cat([sequence[:, target_length:], draft_tokens], dim=1),
+            past_key_values,
+            length + num_proposed,
+        )
+        target_tokens = greedy(logits, num_generated)
+        num_matches = (
+            (draft_tokens == target_tokens[:, :num_proposed]).long().cumprod(dim=1)
+        ).sum(dim=1)
+        num_accepted = num_matches[~finished].min().item()
+        new_tokens = target_tokens[:, : num_accepted + 1]
+
+        # pad finished rows and the tokens after each row's first eos_token_id
+        new_tokens = new_tokens.masked_fill(finished[:, None], pad_token_id)
+        if eos_token_id is not None:
+            is_eos = (new_tokens == eos_token_id) & ~finished[:, None]
+            after_eos = (is_eos.long().cumsum(dim=1) - is_eos.long()) > 0
+            new_tokens = new_tokens.masked_fill(after_eos, pad_token_id)
+            just_finished = is_eos.any(dim=1)
+            if (finished | just_finished).all():
+                # stop at the token that finishes the last row, like generate()
+                first_eos = is_eos.long().argmax(dim=1)
+                new_tokens = new_tokens[:, : first_eos[just_finished].max().item() + 1]
+            finished = finished | just_finished
+
+        sequence = torch.cat([sequence, new_tokens], dim=1)
+        attention_mask = torch.cat(
+            [
+                attention_mask,
+                attention_mask.new_ones(attention_mask.shape[0], new_tokens.shape[1]),
+            ],
+            dim=1,
+        )
+        num_generated += new_tokens.shape[1]
+
+        # drop the rejected tokens from the caches
+        target_length = length + num_accepted
+        past_key_values = narrow_past_key_values(
+            past_key_values,
+            get_past_position_dims(past_key_values, previous_past_key_values),
+            0,
+            target_length,
+        )
+        if num_proposed > 0:
+            # the draft model never processed its last proposed token
+            draft_length = length + min(num_accepted, num_proposed - 1)
+            draft_past_key_values = narrow_past_key_values(
+                draft_past_key_values,
+                get_past_position_dims(
+                    draft_past_key_values, previous_draft_past_key_values
+                ),
+                0,
+                draft_length,
+            )
+
+        if stats is not None:
+            stats.num_steps += 1
+            stats.num_draft_tokens += num_proposed
+            stats.num_accepted_tokens += num_accepted
+            stats.num_generated_tokens += new_tokens.shape[1]
+
+    return sequence
@@ -0,0 +1,113 @@
+import threading
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+
+END_OF_STREAM = object()
+
+
+class TokenStreamer(BaseStreamer):
+    """
+    Streamer for Hugging Face generate() that passes each newly generated token id to a callback.
+    generate() first calls put() with the prompt, which is skipped.
+    Only supports batch size 1, like the Hugging Face streamers.
+    """
+
+    def __init__(self, on_token, on_end):
+        self.on_token = on_token
+        self.on_end = on_end
+        self._skipped_prompt = False
+
+    def put(self, value):
+        if not self._skipped_prompt:
+            self._skipped_prompt = True
+            return
+        for token_id in value.reshape(-1).tolist():
+            self.on_token(token_id)
+
+    def end(self):
+        self.on_end()
+
+
+class StopOnEvent(StoppingCriteria):
+    """
+    Stopping criterion for Hugging Face generate() that stops generation once event is
+    set, e.g. by the consumer of a stream that no longer wants tokens.
+    """
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+class IncrementalDecoder:
+    """
+    Turns a stream of token ids into increments of decoded text.
+    Text is decoded from all tokens seen so far, so that tokens which only form
+    words / characters together with their neighbours are decoded correctly.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.num_decoded_chars = 0
+
+    def step(self, token_id):
+        """Add a token id and return the newly decoded text, possibly empty."""
+        self.token_ids.append(token_id)
+        text = self.tokenizer.decode(
+            self.token_ids, skip_special_tokens=self.skip_special_tokens
+        )
+        # wait for more tokens if the text ends with an incomplete character
+        if text.endswith("\ufffd"):
+            return ""
+        increment = text[self.num_decoded_chars :]
+        self.num_decoded_chars = len(text)
+        return increment
+
+
+def start_generation_thread(generate_fn, put, stopping_criteria=None):
+    """
+    Run generate_fn(streamer=..., stopping_criteria=...) in a background thread.
+    Each generated token id is passed to put(), followed by END_OF_STREAM once generation
+    finishes, or by the raised exception if generation fails.
+    Autocast state is thread-local, so the caller's CUDA and CPU autocast settings are
+    carried over to the generation thread.
+    Args:
+        generate_fn: callable running generation with the given streamer and stopping
+            criteria
+        put: callable receiving the stream items
+        stopping_criteria (StoppingCriteriaList, optional): criteria to pass on to
+            generate_fn, besides the returned stop event.
+    Returns:
+        thread (threading.Thread): the generation thread
+        stop_event (threading.Event): set it to stop generation at the next token
+    """
+    streamer = TokenStreamer(on_token=put, on_end=lambda: put(END_OF_STREAM))
+    stop_event = threading.Event()
+    stopping_criteria = StoppingCriteriaList(
+        list(stopping_criteria or []) + [StopOnEvent(stop_event)]
+    )
+    autocast_enabled = torch.is_autocast_enabled()
+    autocast_dtype = torch.get_autocast_gpu_dtype()
+    cpu_autocast_enabled = torch.is_autocast_cpu_enabled()
+    cpu_autocast_dtype = torch.get_autocast_cpu_dtype()
+
+    def run():
+        try:
+            with torch.no_grad(), torch.autocast(
+                "cuda", dtype=autocast_dtype, enabled=autocast_enabled
+            ), torch.autocast(
+                "cpu", dtype=cpu_autocast_dtype, enabled=cpu_autocast_enabled
+            ):
+                generate_fn(streamer=streamer, stopping_criteria=stopping_criteria)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, stop_event
@@ -1,3 +1,8 @@
+from itertools import chain
+
+from torch import nn
+
+
 def extend_instance(obj, mixin):
     """Apply mixins to a class instance after creation"""
     base_cls = obj.__class__
@@ -44,5 +49,83 @@ def apply_with_stopping_condition(
             apply_fn,
             apply_condition=apply_condition,
             stopping_condition=stopping_condition,
-            **other_args
+            **other_args,
+        )
+
+
+def assign_state_dict(module, state_dict):
+    """
+    Load state_dict into module by using its tensors as the module's parameters and buffers,
+    rather than copying them into the existing ones. This materialises modules built on the
+    meta device without allocating each tensor twice. Keys that do not match a parameter or
+    buffer of module are ignored, and their tensors are not read from state_dict.
+    Returns:
+        list of the names of the parameters and buffers still on the meta device
+    """
+    for name in state_dict:
+        module_name, _, tensor_name = name.rpartition(".")
+        try:
+            submodule = getattr_recursive(module, module_name)
+        except AttributeError:
+            continue
+        if not isinstance(submodule, nn.Module):
+            continue
+        for tensors in (submodule._parameters, submodule._buffers):
+            current = tensors.get(tensor_name, None)
+            if current is None:
+                continue
+            tensor = state_dict[name]
+            if current.shape != tensor.shape:
+                raise RuntimeError(
+                    f"size mismatch for {name}: copying a param with shape {tensor.shape}, the shape in current model is {current.shape}."
+                )
+            tensor = tensor.to(current.dtype)
+            if isinstance(current, nn.Parameter):
+                tensor = nn.Parameter(tensor, requires_grad=current.requires_grad)
+            tensors[tensor_name] = tensor
+    return [
+        name
+        for name, tensor in chain(module.named_parameters(), module.named_buffers())
+        if tensor.is_meta
+    ]
+
+
+def get_past_position_dims(past_key_values, other_past_key_values):
+    """
+    Find the position dimension of each tensor of a language model's past_key_values, as
+    the non-batch dimension whose size differs from the matching tensor of
+    other_past_key_values, which must cover a different number of positions.
+    This supports the different past layouts of Hugging Face and MPT models.
+    Returns:
+        nested tuples of ints, like past_key_values
+    """
+    return tuple(
+        tuple(
+            next(dim for dim in range(1, t.dim()) if t.shape[dim] != other.shape[dim])
+            for t, other in zip(layer_past, other_layer_past)
         )
+        for layer_past, other_layer_past in zip(past_key_values, other_past_key_values)
+    )
+
+
+def narrow_past_key_values(past_key_values, position_dims, start, length):
+    """Keep positions start to start + length of past_key_values."""
+    return tuple(
+        tuple(t.narrow(dim, start, length) for t, dim in zip(layer_past, layer_dims))
+        for layer_past, layer_dims in zip(past_key_values, position_dims)
+    )
+
+
+def get_position_ids(attention_mask, num_positions):
+    """
+    Positions of the last num_positions tokens of a left-padded batch, counting only the
+    tokens that are not padding, as Hugging Face generate() computes them.
+    Args:
+        attention_mask (torch.Tensor): attention mask of the past and the new tokens
+            shape (B, T)
+    Returns:
+        shape (B, num_positions)
+    """
+    position_ids = attention_mask.long().cumsum(dim=-1) - 1
+    position_ids = position_ids.masked_fill(attention_mask == 0, 1)
+    return position_ids[:, -num_positions:]
@@ -0,0 +1,167 @@
+"""
+Export of the image path of Flamingo (vision encoder -> perceiver) as a standalone graph,
+so that images can be encoded to perceiver latents in a separate service.
+The latents are passed back to the model with Flamingo.get_vision_conditioning_from_latents().
+"""
+
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from einops import rearrange
+from torch import nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class VisionEncoderWithPerceiver(nn.Module):
+    """
+    The computation of Flamingo._get_media_latents() for a batch of single images,
+    without conditioning the language model.
+    """
+
+    def __init__(self, vision_encoder, perceiver):
+        """
+        Args:
+            vision_encoder (nn.Module): Flamingo.vision_encoder
+            perceiver (PerceiverResampler): Flamingo.perceiver. Its media time embeddings
+                must be disabled, so that each image is encoded independently.
+        """
+        super().__init__()
+        assert (
+            perceiver.media_time_embs is None
+        ), "Exporting requires the perceiver to encode each image independently."
+        self.vision_encoder = vision_encoder
+        self.perceiver = perceiver
+
+    def forward(self, images):
+        """
+        Args:
+            images (torch.Tensor): preprocessed images
+                shape (N, C, H, W)
+        Returns:
+            perceiver latents
+                shape (N, n, D)
+        """
+        features = self.vision_encoder(images)[1]
+        latents = self.perceiver(rearrange(features, "N v d -> N 1 1 v d"))
+        return latents[:, 0]
+
+
+@contextmanager
+def _unit_layer_norm_affines(module):
+    """
+    Give the layer norms of module without an elementwise affine transform, e.g. after
+    freeze_for_inference(), a unit scale and zero shift while exporting to ONNX: the
+    exporter of some torch versions emits an invalid LayerNormalization node without them.
+    """
+    norms = [
+        norm
+        for norm in module.modules()
+        if isinstance(norm, nn.LayerNorm) and not norm.elementwise_affine
+    ]
+    param = next(module.parameters())
+    for norm in norms:
+        norm.weight = nn.Parameter(
+            torch.ones(norm.normalized_shape, dtype=param.dtype, device=param.device),
+            requires_grad=False,
+        )
+        norm.bias = nn.Parameter(torch.zeros_like(norm.weight), requires_grad=False)
+        norm.elementwise_affine = True
+    try:
+        yield
+    finally:
+        for norm in norms:
+            norm.weight, norm.bias = None, None
+            norm.elementwise_affine = False
+
+
+def export_vision_encoder(model, path, format="torchscript", image_size=224):
+    """
+    Trace the vision encoder and perceiver of model and save the graph to path.
+    Args:
+        model (Flamingo): model to export, on CPU, e.g. after freeze_for_inference()
+        path (str): output file
+        format (str): "torchscript" to save a traced TorchScript module, or "onnx"
+        image_size (int): height and width of the preprocessed images
+    Returns:
+        VisionEncoderWithPerceiver: the exported module
+    """
+    module = VisionEncoderWithPerceiver(model.vision_encoder, model.perceiver).eval()
+    example = torch.randn(
+        2,
+        3,
+        image_size,
+        image_size,
+        dtype=next(module.parameters()).dtype,
+        device=next(module.parameters()).device,
+    )
+    with torch.no_grad():
+        if format == "torchscript":
+            torch.jit.trace(module, example).save(path)
+        elif format == "onnx":
+            with _unit_layer_norm_affines(module):
+                torch.onnx.export(
+                    module,
+                    example,
+                    path,
+                    input_names=["images"],
+                    output_names=["latents"],
+                    dynamic_axes={
+                        "images": {0: "num_images"},
+                        "latents": {0: "num_images"},
+                    },
+                    opset_version=17,
+                )
+        else:
+            raise ValueError(f"Unknown export format: {format}")
+    return module
+
+
+class ExportedVisionEncoder:
+    """
+    Runs a graph saved by export_vision_encoder(). Calling it maps preprocessed images
+    of shape (N, C, H, W) to perceiver latents of shape (N, n, D).
+    """
+
+    def __init__(self, path, device="cpu"):
+        """
+        Args:
+            path (str): file written by export_vision_encoder(). .onnx files are run with
+                onnxruntime on CPU; other files are loaded as TorchScript on device.
+        """
+        self.device = device
+        self.is_onnx = path.endswith(".onnx")
+        if self.is_onnx:
+            assert onnxruntime is not None, "onnxruntime is not installed"
+            self.session = onnxruntime.InferenceSession(
+                path, providers=["CPUExecutionProvider"]
+            )
+        else:
+            self.module = torch.jit.load(path, map_location=device).eval()
+
+    def __call__(self, images: torch.Tensor) -> torch.Tensor:
+        if self.is_onnx:
+            (latents,) = self.session.run(
+                ["latents"], {"images": images.detach().cpu().numpy()}
+            )
+            return torch.from_numpy(np.asarray(latents))
+        with torch.no_grad():
+            return self.module(images.to(self.device))
+
+    def encode_vision_x(self, vision_x: torch.Tensor) -> torch.Tensor:
+        """
+        Encode a Flamingo vision input.
+        Args:
+            vision_x (torch.Tensor): shape (B, T_img, F, C, H, W) with F=1
+        Returns:
+            perceiver latents to pass to Flamingo.get_vision_conditioning_from_latents()
+                shape (B, T_img, n, D)
+        """
+        b, T, F = vision_x.shape[:3]
+        assert F == 1, "Only single frame supported"
+        latents = self(rearrange(vision_x, "b T F c h w -> (b T F) c h w"))
+        return rearrange(latents, "(b T) n d -> b T n d", b=b, T=T)
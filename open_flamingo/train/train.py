@@ -2,6 +2,7 @@
 
 import argparse
 import glob
+import importlib.util
 import os
 import random
 
@@ -40,6 +41,7 @@ from torch.distributed.distributed_c10d import _get_default_group
 import functools
 
 from open_flamingo import create_model_and_transforms
+from open_flamingo.src.checkpoint import get_safetensors_path, load_model_state_dict
 
 
 def random_seed(seed=42, rank=0):
@@ -80,6 +82,13 @@ def main():
         help="path to checkpoint to resume from, this should contain model, optimizer, and lr_scheduler states. if there exists a checkpoint in the dir named run_name, we will resume from that checkpoint by default",
         default=None,
     )
+    parser.add_argument(
+        "--checkpoint_format",
+        type=str,
+        choices=["pt", "safetensors"],
+        default="pt",
+        help="pt saves the model weights in the torch.save checkpoint; safetensors saves them to a separate, memory-mappable checkpoint_{epoch}.safetensors file (requires safetensors)",
+    )
     parser.add_argument(
         "--delete_previous_checkpoint",
         action="store_true",
@@ -111,6 +120,11 @@ def main():
         action="store_true",
         help="whether to train with gradient/activation checkpointing",
     )
+    parser.add_argument(
+        "--use_sdpa",
+        action="store_true",
+        help="whether to use torch's fused scaled_dot_product_attention in the perceiver and cross attention layers. Not yet validated with --fsdp and mixed precision",
+    )
     parser.add_argument(
         "--num_epochs",
         type=int,
@@ -228,6 +242,12 @@ def main():
     if args.save_checkpoints_to_wandb and not args.report_to_wandb:
         raise ValueError("save_checkpoints_to_wandb requires report_to_wandb")
 
+    if (
+        args.checkpoint_format == "safetensors"
+        and importlib.util.find_spec("safetensors") is None
+    ):
+        raise ValueError("checkpoint_format safetensors requires safetensors")
+
     if args.fsdp and not args.fsdp_use_orig_params:
         print(
             "Warning: FSDP is running without fsdp_use_orig_params flag. "
@@ -266,6 +286,7 @@ def main():
         use_local_files=args.offline,
         gradient_checkpointing=args.gradient_checkpointing,
         freeze_lm_embeddings=args.freeze_lm_embeddings,
+        use_sdpa=args.use_sdpa,
     )
     random_seed(args.seed, args.rank)
 
@@ -299,8 +320,14 @@ def main():
         if args.rank == 0:
             print(f"Loading checkpoint from {args.resume_from_checkpoint}")
         checkpoint = torch.load(args.resume_from_checkpoint, map_location="cpu")
-        msd = checkpoint["model_state_dict"]
-        msd = {k.replace("module.", ""): v for k, v in msd.items()}
+        if "model_state_dict" in checkpoint:
+            msd = checkpoint["model_state_dict"]
+            msd = {k.replace("module.", ""): v for k, v in msd.items()}
+        else:
+            # saved with --checkpoint_format safetensors
+            msd = load_model_state_dict(
+                get_safetensors_path(args.resume_from_checkpoint)
+            )
         resume_from_epoch = checkpoint["epoch"] + 1
 
         # for fsdp, only one rank needs to load the state dict
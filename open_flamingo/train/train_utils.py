@@ -12,6 +12,8 @@ import os
 import wandb
 from einops import rearrange
 
+from open_flamingo.src.checkpoint import save_safetensors_state_dict
+
 
 def get_cast_dtype(precision: str):
     cast_dtype = None
@@ -31,13 +33,20 @@ def get_mp_policy_dtype(precision: str):
         return torch.float32
 
 
-def get_autocast(precision, cache_enabled=True):
+def get_autocast(precision, cache_enabled=True, device_type="cuda"):
+    """
+    Returns a function creating the autocast context for precision on device_type.
+    On CPU, "amp" autocasts to bfloat16, the lower precision CPU kernels support.
+    """
     if precision == "amp":
-        return torch.cuda.amp.autocast(cache_enabled=cache_enabled)
+        dtype = torch.float16 if device_type == "cuda" else torch.bfloat16
+        return lambda: torch.autocast(
+            device_type, dtype=dtype, cache_enabled=cache_enabled
+        )
     elif precision == "amp_bfloat16" or precision == "amp_bf16":
         # amp_bfloat16 is more stable than amp float16 for clip training
-        return lambda: torch.cuda.amp.autocast(
-            dtype=torch.bfloat16, cache_enabled=cache_enabled
+        return lambda: torch.autocast(
+            device_type, dtype=torch.bfloat16, cache_enabled=cache_enabled
         )
     else:
         return suppress
@@ -65,8 +74,10 @@ def train_one_epoch(
     total_training_steps = num_batches_per_epoch * args.num_epochs
 
     autocast = get_autocast(
-        args.precision, cache_enabled=(not args.fsdp)
-    )  # if fsdp, disable cache to save memory
+        args.precision,
+        cache_enabled=(not args.fsdp),  # if fsdp, disable cache to save memory
+        device_type=torch.device(device_id).type,
+    )
     cast_dtype = get_cast_dtype(args.precision)
 
     # setup model
@@ -151,6 +162,11 @@ def train_one_epoch(
         labels[labels == media_token_id] = -100
         labels = labels.to(device_id)
 
+        # images are zero-padded to max_num_images, and images beyond the truncated text
+        # have no <image> token: only encode the images the text refers to
+        num_media = (input_ids == media_token_id).sum(dim=1)
+        vision_x_mask = torch.arange(images.shape[1]) < num_media[:, None]
+
         # gradient accumulation w/ fsdp cpu offloading requires a no_sync context manager
         with autocast():
             loss_mmc4 = model(
@@ -158,6 +174,7 @@ def train_one_epoch(
                 lang_x=input_ids,
                 attention_mask=attention_mask,
                 labels=labels,
+                vision_x_mask=vision_x_mask.to(device_id),
             )[0]
 
             # if loss is nan, skip this batch
@@ -362,16 +379,27 @@ def save_checkpoint(model, optimizer, lr_scheduler, epoch, args):
 
         checkpoint_dict = {
             "epoch": epoch,
-            "model_state_dict": model_state,
             "optimizer_state_dict": optim_state,
             "lr_scheduler_state_dict": lr_scheduler.state_dict(),
         }
+        checkpoint_files = [f"{args.run_name}/checkpoint_{epoch}.pt"]
+        if args.checkpoint_format == "safetensors":
+            # model weights go to a separate file that inference can memory-map
+            checkpoint_files.append(f"{args.run_name}/checkpoint_{epoch}.safetensors")
+            print(f"Saving model weights to {checkpoint_files[1]}")
+            save_safetensors_state_dict(
+                model_state, checkpoint_files[1], metadata={"epoch": str(epoch)}
+            )
+        else:
+            checkpoint_dict["model_state_dict"] = model_state
 
-        print(f"Saving checkpoint to {args.run_name}/checkpoint_{epoch}.pt")
-        torch.save(checkpoint_dict, f"{args.run_name}/checkpoint_{epoch}.pt")
+        print(f"Saving checkpoint to {checkpoint_files[0]}")
+        torch.save(checkpoint_dict, checkpoint_files[0])
         if args.report_to_wandb and args.save_checkpoints_to_wandb:
-            wandb.save(f"{args.run_name}/checkpoint_{epoch}.pt")
+            for checkpoint_file in checkpoint_files:
+                wandb.save(checkpoint_file)
 
         if args.delete_previous_checkpoint:
             if epoch > 0:
-                os.remove(f"{args.run_name}/checkpoint_{epoch-1}.pt")
+                for checkpoint_file in checkpoint_files:
+                    os.remove(checkpoint_file.replace(f"_{epoch}.", f"_{epoch-1}."))
@@ -0,0 +1,136 @@
+"""
+Tiny, randomly initialized Flamingo models for the tests, so that no pretrained weights
+need to be downloaded.
+"""
+import pytest
+import torch
+from torch import nn
+from transformers import (
+    GPTNeoXConfig,
+    GPTNeoXForCausalLM,
+    LlamaConfig,
+    LlamaForCausalLM,
+    OPTConfig,
+    OPTForCausalLM,
+)
+
+from open_flamingo.src.flamingo import Flamingo
+from open_flamingo.src.flamingo_lm import FlamingoLMMixin
+from open_flamingo.src.utils import extend_instance
+
+VOCAB_SIZE = 64
+MEDIA_TOKEN_ID = 62
+EOC_TOKEN_ID = 63
+PAD_TOKEN_ID = 1
+VIS_DIM = 32
+IMAGE_SIZE = 16
+
+
+class TinyVisionEncoder(nn.Module):
+    """Patch embedding that returns (pooled, tokens) like an open_clip visual tower."""
+
+    def __init__(self, dim=VIS_DIM, patch_size=8):
+        super().__init__()
+        self.conv = nn.Conv2d(3, dim, kernel_size=patch_size, stride=patch_size)
+
+    def forward(self, x):
+        tokens = self.conv(x).flatten(2).transpose(1, 2)
+        return tokens.mean(dim=1), tokens
+
+
+def _create_lang_encoder(lm):
+    kwargs = dict(vocab_size=VOCAB_SIZE, hidden_size=32, num_attention_heads=4)
+    if lm == "opt":
+        config = OPTConfig(
+            **kwargs,
+            num_hidden_layers=2,
+            ffn_dim=64,
+            word_embed_proj_dim=32,
+            pad_token_id=PAD_TOKEN_ID,
+            max_position_embeddings=256,
+        )
+        return OPTForCausalLM(config), "model.decoder.layers"
+    if lm == "llama":
+        config = LlamaConfig(
+            **kwargs,
+            num_hidden_layers=2,
+            intermediate_size=64,
+            pad_token_id=PAD_TOKEN_ID,
+            max_position_embeddings=256,
+        )
+        return LlamaForCausalLM(config), "model.layers"
+    if lm == "gpt_neox":
+        config = GPTNeoXConfig(
+            **kwargs,
+            num_hidden_layers=2,
+            intermediate_size=64,
+            pad_token_id=PAD_TOKEN_ID,
+            max_position_embeddings=256,
+        )
+        return GPTNeoXForCausalLM(config), "gpt_neox.layers"
+    raise ValueError(f"Unknown language model {lm}")
+
+
+def create_tiny_flamingo(lm="opt", seed=0, **flamingo_kwargs):
+    """
+    A Flamingo with a tiny vision encoder and language model, in eval mode. The cross
+    attention gates are opened, so that the media change the language model's outputs.
+    """
+    torch.manual_seed(seed)
+    lang_encoder, decoder_layers_attr_name = _create_lang_encoder(lm)
+    extend_instance(lang_encoder, FlamingoLMMixin)
+    lang_encoder.set_decoder_layers_attr_name(decoder_layers_attr_name)
+    model = Flamingo(
+        nn.ModuleDict({"visual": TinyVisionEncoder()}),
+        lang_encoder,
+        eoc_token_id=EOC_TOKEN_ID,
+        media_token_id=MEDIA_TOKEN_ID,
+        vis_dim=VIS_DIM,
+        **flamingo_kwargs,
+    )
+    with torch.no_grad():
+        for layer in model.lang_encoder.gated_cross_attn_layers:
+            if layer is not None:
+                layer.attn_gate.fill_(1.0)
+                layer.ff_gate.fill_(1.0)
+    return model.eval()
+
+
+def random_images(batch_size, num_images, seed=0):
+    """shape (B, T_img, 1, 3, H, W)"""
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(
+        batch_size, num_images, 1, 3, IMAGE_SIZE, IMAGE_SIZE, generator=generator
+    )
+
+
+def random_prompt(num_images, length, seed=0):
+    """
+    A prompt of length tokens that starts with an <image> token and contains num_images
+    of them, without special tokens elsewhere.
+    shape (length,)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    tokens = torch.randint(2, MEDIA_TOKEN_ID, (length,), generator=generator)
+    positions = torch.randperm(length - 1, generator=generator)[: num_images - 1] + 1
+    tokens[0] = MEDIA_TOKEN_ID
+    tokens[positions] = MEDIA_TOKEN_ID
+    return tokens
+
+
+def left_pad(prompts):
+    """Left-pad a list of 1D prompts. Returns lang_x and attention_mask."""
+    length = max(len(prompt) for prompt in prompts)
+    lang_x = torch.full((len(prompts), length), PAD_TOKEN_ID)
+    attention_mask = torch.zeros(len(prompts), length, dtype=torch.long)
+    for i, prompt in enumerate(prompts):
+        lang_x[i, length - len(prompt) :] = prompt
+        attention_mask[i, length - len(prompt) :] = 1
+    return lang_x, attention_mask
+
+
+@pytest.fixture(params=["opt", "llama", "gpt_neox"])
+def lm(request):
+    """Language model families: OPT derives positions from the attention mask, while
+    Llama and GPT-NeoX apply rotary embeddings at the positions they are given."""
+    return request.param
@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, left_pad, random_images, random_prompt
+from open_flamingo.src import beam_search
+
+NUM_BEAMS = 3
+GENERATE_KWARGS = dict(max_new_tokens=8, min_new_tokens=8, num_beams=NUM_BEAMS)
+
+
+def _inputs():
+    vision_x = random_images(2, 2)
+    lang_x, attention_mask = left_pad(
+        [random_prompt(2, 12, seed=1), random_prompt(2, 8, seed=2)]
+    )
+    return vision_x, lang_x, attention_mask
+
+
+def _generate(model, **kwargs):
+    vision_x, lang_x, attention_mask = _inputs()
+    with torch.no_grad():
+        return model.generate(
+            vision_x, lang_x, attention_mask=attention_mask, **GENERATE_KWARGS, **kwargs
+        )
+
+
+@pytest.mark.parametrize("num_return_sequences", [1, 2])
+def test_shared_prompt_matches_beam_search(lm, num_return_sequences):
+    model = create_tiny_flamingo(lm)
+    expected = _generate(model, num_return_sequences=num_return_sequences)
+    output = _generate(
+        model,
+        num_return_sequences=num_return_sequences,
+        share_prompt_across_beams=True,
+    )
+    assert torch.equal(output, expected)
+
+
+def test_prompt_past_is_not_repeated_per_beam(lm, monkeypatch):
+    model = create_tiny_flamingo(lm)
+    attend_shared_prompt = beam_search._attend_shared_prompt
+    prompt_batch_sizes = []
+
+    def record(q, k, v, layer_past, *args):
+        prompt_batch_sizes.append(layer_past.prompt[0].shape[0])
+        return attend_shared_prompt(q, k, v, layer_past, *args)
+
+    monkeypatch.setattr(beam_search, "_attend_shared_prompt", record)
+    _generate(model, share_prompt_across_beams=True)
+    # one call per decoder layer and decoding step, each on the 2 prompts' keys / values
+    assert prompt_batch_sizes and set(prompt_batch_sizes) == {2}
+    # the language model's attention modules are restored
+    assert not any("forward" in vars(module) for module in model.lang_encoder.modules())
+
+
+def test_unsupported_attention_repeats_prompt_past(lm, monkeypatch):
+    model = create_tiny_flamingo(lm)
+    expected = _generate(model)
+    monkeypatch.setattr(beam_search, "SHARED_PROMPT_ATTENTION_FORWARDS", {})
+    output = _generate(model, share_prompt_across_beams=True)
+    assert torch.equal(output, expected)
+    assert not any(
+        layer._forward_hooks for layer in model.lang_encoder._get_decoder_layers()
+    )
+
+
+def test_unsupported_transformers_version_fails(monkeypatch):
+    model = create_tiny_flamingo()
+    monkeypatch.setattr(beam_search.transformers, "__version__", "4.36.0")
+    with pytest.raises(RuntimeError, match="transformers"):
+        _generate(model, share_prompt_across_beams=True)
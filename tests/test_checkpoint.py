@@ -0,0 +1,66 @@
+"""
+Saving the model weights to safetensors and loading them back through the factory.
+"""
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src import checkpoint
+from open_flamingo.src.factory import _load_flamingo_checkpoint
+from open_flamingo.src.utils import assign_state_dict
+
+pytest.importorskip("safetensors")
+
+
+def _logits(model):
+    vision_x = random_images(1, 2)
+    lang_x = random_prompt(2, 12).unsqueeze(0)
+    with torch.no_grad():
+        return model(vision_x, lang_x).logits
+
+
+def test_safetensors_round_trip(tmp_path):
+    model = create_tiny_flamingo()
+    path = str(tmp_path / "checkpoint_0.safetensors")
+    checkpoint.save_safetensors_state_dict(model.state_dict(), path)
+
+    # as built by the factory: a pretrained language model, Flamingo modules on meta
+    loaded = create_tiny_flamingo(seed=1)
+    loaded.perceiver.to("meta")
+    loaded.lang_encoder.gated_cross_attn_layers.to("meta")
+    _load_flamingo_checkpoint(loaded, path)
+
+    assert not any(param.is_meta for param in loaded.parameters())
+    # the tied output embeddings, saved once, are tied again
+    assert (
+        loaded.lang_encoder.get_output_embeddings().weight
+        is loaded.lang_encoder.get_input_embeddings().weight
+    )
+    torch.testing.assert_close(_logits(loaded), _logits(model), atol=0, rtol=0)
+
+
+def test_safetensors_are_read_lazily(tmp_path):
+    perceiver_state_dict = create_tiny_flamingo().perceiver.state_dict()
+    path = str(tmp_path / "checkpoint_0.safetensors")
+    checkpoint.save_safetensors_state_dict(
+        {**perceiver_state_dict, "unused.weight": torch.zeros(1)}, path
+    )
+    # the weights of a torch.save checkpoint are read from the safetensors file next to it
+    state_dict = checkpoint.load_model_state_dict(str(tmp_path / "checkpoint_0.pt"))
+    assert isinstance(state_dict, checkpoint.SafetensorsStateDict)
+
+    read = []
+    file = state_dict._file
+
+    class RecordingFile:
+        def get_tensor(self, key):
+            read.append(key)
+            return file.get_tensor(key)
+
+    state_dict._file = RecordingFile()
+    perceiver = create_tiny_flamingo(seed=1).perceiver.to("meta")
+    assert assign_state_dict(perceiver, state_dict) == []
+    # only the tensors of the model are read
+    assert sorted(read) == sorted(perceiver_state_dict)
+    for name, tensor in perceiver.state_dict().items():
+        torch.testing.assert_close(tensor, perceiver_state_dict[name], atol=0, rtol=0)
@@ -0,0 +1,90 @@
+import pytest
+import torch
+import torch._dynamo
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+
+GENERATE_KWARGS = dict(max_new_tokens=6, min_new_tokens=6)
+
+
+def _dynamo_supported():
+    try:
+        torch._dynamo.eval_frame.check_if_dynamo_supported()
+    except RuntimeError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(
+    not _dynamo_supported(), reason="torch.compile is not supported here"
+)
+def test_compile_scopes_cache_size_limit():
+    cache_size_limits = []
+
+    def backend(gm, example_inputs):
+        cache_size_limits.append(torch._dynamo.config.cache_size_limit)
+        return gm.forward
+
+    torch._dynamo.reset()
+    global_limit = torch._dynamo.config.cache_size_limit
+    model = create_tiny_flamingo()
+    vision_x = random_images(1, 2)
+    lang_x = random_prompt(2, 10).unsqueeze(0)
+    with torch.no_grad():
+        expected = model.generate(vision_x, lang_x, **GENERATE_KWARGS)
+        model.compile(
+            prompt_length_buckets=(16, 32),
+            num_images_buckets=(2, 4),
+            backend=backend,
+        )
+        output = model.generate(vision_x, lang_x, **GENERATE_KWARGS)
+        dict_output = model.generate(
+            vision_x, lang_x, return_dict_in_generate=True, **GENERATE_KWARGS
+        )
+    torch._dynamo.reset()
+
+    assert torch.equal(output, expected)
+    assert torch.equal(dict_output.sequences, expected)
+    # 2 layers, with one graph per bucket for prefill and one for decoding
+    num_graphs = 2 * (2 * 2 + 1)
+    assert cache_size_limits and all(
+        limit == max(global_limit, num_graphs) for limit in cache_size_limits
+    )
+    assert torch._dynamo.config.cache_size_limit == global_limit
+
+
+def test_generate_returns_dict_in_generate():
+    model = create_tiny_flamingo()
+    vision_x = random_images(1, 2)
+    lang_x = random_prompt(2, 10).unsqueeze(0)
+    with torch.no_grad():
+        expected = model.generate(vision_x, lang_x, **GENERATE_KWARGS)
+        output = model.generate(
+            vision_x,
+            lang_x,
+            return_dict_in_generate=True,
+            output_scores=True,
+            **GENERATE_KWARGS,
+        )
+    assert torch.equal(output.sequences, expected)
+    assert len(output.scores) == GENERATE_KWARGS["max_new_tokens"]
+
+
+@pytest.mark.skipif(
+    not _dynamo_supported(), reason="torch.compile is not supported here"
+)
+@pytest.mark.parametrize("lm", ["opt", "llama", "gpt_neox"])
+def test_compiled_beam_search_shares_prompt(lm):
+    torch._dynamo.reset()
+    model = create_tiny_flamingo(lm)
+    vision_x = random_images(1, 2)
+    lang_x = random_prompt(2, 10).unsqueeze(0)
+    kwargs = dict(num_beams=2, **GENERATE_KWARGS)
+    with torch.no_grad():
+        expected = model.generate(vision_x, lang_x, **kwargs)
+        model.compile(backend="eager")
+        output = model.generate(
+            vision_x, lang_x, share_prompt_across_beams=True, **kwargs
+        )
+    torch._dynamo.reset()
+    assert torch.equal(output, expected)
@@ -0,0 +1,97 @@
+import torch
+
+from conftest import MEDIA_TOKEN_ID, create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src.continuous_batching import ContinuousBatch
+
+MAX_NEW_TOKENS = 8
+
+
+def _requests():
+    """Prompts of different lengths and numbers of images, so rows are left-padded."""
+    return [
+        (
+            random_images(1, num_images, seed=i),
+            random_prompt(num_images, length, seed=i).unsqueeze(0),
+        )
+        for i, (num_images, length) in enumerate([(2, 12), (1, 5), (3, 9), (1, 16)])
+    ]
+
+
+def test_continuous_batching_matches_generate(lm):
+    model = create_tiny_flamingo(lm)
+    requests = _requests()
+    with torch.no_grad():
+        expected = [
+            model.generate(vision_x, lang_x, max_new_tokens=MAX_NEW_TOKENS)
+            for vision_x, lang_x in requests
+        ]
+    outputs = dict(
+        model.generate_continuous(requests, batch_size=2, max_new_tokens=MAX_NEW_TOKENS)
+    )
+    assert sorted(outputs) == list(range(len(requests)))
+    for i, output in enumerate(expected):
+        assert torch.equal(outputs[i], output)
+
+
+class RecordLogits:
+    """Calls the language model and records the logits of the last token."""
+
+    def __init__(self, lang_encoder):
+        self.lang_encoder = lang_encoder
+        self.logits = None
+
+    def accepts_position_ids(self):
+        return self.lang_encoder.accepts_position_ids()
+
+    def __call__(self, **kwargs):
+        output = self.lang_encoder(**kwargs)
+        self.logits = output.logits[:, -1]
+        return output
+
+
+def test_decoding_step_matches_unpadded_forward(lm):
+    """A left-padded row decodes at the position of its own last token."""
+    model = create_tiny_flamingo(lm)
+    batch = ContinuousBatch()
+    expected = []
+    with torch.no_grad():
+        for i, (vision_x, lang_x) in enumerate(_requests()[:2]):
+            conditioning = model.get_vision_conditioning(vision_x)
+            attention_mask = torch.ones_like(lang_x)
+            with conditioning.activate():
+                output = model.lang_encoder(
+                    input_ids=lang_x, attention_mask=attention_mask, use_cache=True
+                )
+            token_id = output.logits[0, -1].argmax().item()
+            batch.add(
+                i,
+                token_id,
+                output.past_key_values,
+                attention_mask,
+                conditioning.vis_x,
+                conditioning.media_kv,
+                (lang_x == MEDIA_TOKEN_ID).sum().item(),
+            )
+            lang_x = torch.cat([lang_x, lang_x.new_tensor([[token_id]])], dim=1)
+            with conditioning.activate():
+                output = model.lang_encoder(
+                    input_ids=lang_x, attention_mask=torch.ones_like(lang_x)
+                )
+            expected.append(output.logits[:, -1])
+    recorder = RecordLogits(model.lang_encoder)
+    batch.step(recorder)
+    torch.testing.assert_close(recorder.logits, torch.cat(expected))
+
+
+def test_continuous_batching_prefill_records_no_graph(monkeypatch):
+    model = create_tiny_flamingo()
+    get_vision_conditioning = model.get_vision_conditioning
+    grad_enabled = []
+
+    def record(*args, **kwargs):
+        grad_enabled.append(torch.is_grad_enabled())
+        return get_vision_conditioning(*args, **kwargs)
+
+    monkeypatch.setattr(model, "get_vision_conditioning", record)
+    list(model.generate_continuous(_requests(), batch_size=2, max_new_tokens=2))
+    assert grad_enabled and not any(grad_enabled)
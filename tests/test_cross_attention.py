@@ -0,0 +1,162 @@
+"""
+MaskedCrossAttention's attention implementations must agree with each other.
+"""
+import pytest
+import torch
+
+from open_flamingo.src.helpers import MaskedCrossAttention, MediaAttentionMask
+
+B, T_TXT, T_IMG, N_LATENTS = 3, 12, 4, 5
+DIM, DIM_VISUAL = 32, 16
+
+
+def _create_cross_attention(use_sdpa, only_attend_immediate_media=True):
+    torch.manual_seed(0)
+    return MaskedCrossAttention(
+        dim=DIM,
+        dim_visual=DIM_VISUAL,
+        dim_head=8,
+        heads=4,
+        only_attend_immediate_media=only_attend_immediate_media,
+        use_sdpa=use_sdpa,
+    ).eval()
+
+
+def _media_locations():
+    """
+    Row 0: media spread over the text, with text before the first media.
+    Row 1: no media at all.
+    Row 2: a single media at the start; the other T_IMG - 1 media are padding.
+    """
+    media_locations = torch.zeros(B, T_TXT, dtype=torch.bool)
+    media_locations[0, [2, 3, 7, 10]] = True
+    media_locations[2, 0] = True
+    return media_locations
+
+
+def _inputs(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    x = torch.randn(B, T_TXT, DIM, generator=generator)
+    media = torch.randn(B, T_IMG, N_LATENTS, DIM_VISUAL, generator=generator)
+    return x, media
+
+
+@pytest.mark.parametrize("use_sdpa", [False, True])
+@pytest.mark.parametrize(
+    "use_cached_media,media_offset",
+    [(False, None), (True, None), (False, torch.tensor([0, 2, 1]))],
+)
+def test_immediate_media_attention_matches_dense(
+    use_sdpa, use_cached_media, media_offset
+):
+    attn = _create_cross_attention(use_sdpa)
+    x, media = _inputs()
+    mask = MediaAttentionMask(
+        _media_locations(),
+        T_IMG,
+        N_LATENTS,
+        use_cached_media=use_cached_media,
+        T_txt=T_TXT,
+        media_offset=media_offset,
+    )
+    with torch.no_grad():
+        immediate = attn(
+            x,
+            media,
+            use_cached_media=use_cached_media,
+            media_attention_mask=mask,
+        )
+        dense = attn(
+            x,
+            media,
+            use_cached_media=use_cached_media,
+            media_attention_mask=mask.to_dense(True),
+        )
+    torch.testing.assert_close(immediate, dense)
+    # the text without a preceding media is not attended
+    assert torch.all(immediate[1] == 0) == (media_offset is None)
+
+
+def test_immediate_media_groups_gather_each_media_once():
+    mask = MediaAttentionMask(_media_locations(), T_IMG, N_LATENTS)
+    (
+        batch_idx,
+        token_idx,
+        group_idx,
+        group_position,
+        group_batch_idx,
+        group_slot_start,
+        group_num_slots,
+        max_group_size,
+        num_slots,
+    ) = mask.immediate_media_groups
+    # row 0 attends to its 4 media, row 2 to its first media only
+    assert group_batch_idx.tolist() == [0, 0, 0, 0, 2]
+    assert group_slot_start.tolist() == [0, 1, 2, 3, 0]
+    assert group_num_slots.tolist() == [1] * 5
+    assert num_slots == [1]
+    assert max_group_size == T_TXT
+    assert len(batch_idx) == (T_TXT - 2) + T_TXT
+    # each token sits in its own slot of its group
+    slots = set(zip(group_idx.tolist(), group_position.tolist()))
+    assert len(slots) == len(batch_idx)
+
+
+def test_immediate_media_attention_without_media():
+    attn = _create_cross_attention(use_sdpa=False)
+    x, media = _inputs()
+    mask = MediaAttentionMask(torch.zeros(B, T_TXT, dtype=torch.bool), T_IMG, N_LATENTS)
+    with torch.no_grad():
+        out = attn(x, media, media_attention_mask=mask)
+    assert torch.all(out == 0)
+
+
+def _ragged_media_time():
+    """
+    Media spanning different numbers of slots of N_LATENTS latents each: in row 0, the
+    4 media take 1, 1, 2 and 3 slots; row 2 has a single media of 2 slots, and padding.
+    """
+    padding = MediaAttentionMask.PADDING_MEDIA_TIME
+    return torch.tensor(
+        [
+            [1, 2, 3, 3, 4, 4, 4],
+            [1, 2, 3, 3, 4, 4, 4],
+            [1, 1] + [padding] * 5,
+        ]
+    )
+
+
+@pytest.mark.parametrize("use_sdpa", [False, True])
+def test_ragged_immediate_media_attention_matches_dense(use_sdpa):
+    attn = _create_cross_attention(use_sdpa)
+    x, _ = _inputs()
+    media_time = _ragged_media_time()
+    media = torch.randn(B, media_time.shape[1], N_LATENTS, DIM_VISUAL)
+    mask = MediaAttentionMask(
+        _media_locations(), media_time.shape[1], N_LATENTS, media_time=media_time
+    )
+    with torch.no_grad():
+        immediate = attn(x, media, media_attention_mask=mask)
+        dense = attn(x, media, media_attention_mask=mask.to_dense(True))
+    torch.testing.assert_close(immediate, dense)
+    assert mask.immediate_media_groups[-1] == [1, 2, 3]
+
+
+@pytest.mark.parametrize("only_attend_immediate_media", [True, False])
+def test_padding_slots_are_not_attended(only_attend_immediate_media):
+    """Each row gives the same output as on its own, without the padding slots."""
+    attn = _create_cross_attention(False, only_attend_immediate_media)
+    x, _ = _inputs()
+    media_locations = _media_locations()
+    media_time = _ragged_media_time()
+    media = torch.randn(B, media_time.shape[1], N_LATENTS, DIM_VISUAL)
+    mask = MediaAttentionMask(
+        media_locations, media_time.shape[1], N_LATENTS, media_time=media_time
+    )
+    with torch.no_grad():
+        out = attn(x, media, media_attention_mask=mask)
+        row_mask = MediaAttentionMask(
+            media_locations[2:], 2, N_LATENTS, media_time=media_time[2:, :2]
+        )
+        row_out = attn(x[2:], media[2:, :2], media_attention_mask=row_mask)
+    torch.testing.assert_close(out[2:], row_out)
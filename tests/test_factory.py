@@ -0,0 +1,179 @@
+import json
+
+import numpy as np
+import open_clip
+import pytest
+import torch
+from PIL import Image
+from torch import nn
+
+from conftest import (
+    EOC_TOKEN_ID,
+    MEDIA_TOKEN_ID,
+    VIS_DIM,
+    TinyVisionEncoder,
+    _create_lang_encoder,
+    create_tiny_flamingo,
+    random_images,
+    random_prompt,
+)
+from open_flamingo.src.factory import (
+    _load_flamingo_checkpoint,
+    create_vision_encoder_and_transforms,
+)
+from open_flamingo.src.flamingo import Flamingo
+from open_flamingo.src.flamingo_lm import FlamingoLMMixin
+from open_flamingo.src.utils import extend_instance
+
+TINY_CLIP_CONFIG = {
+    "embed_dim": 16,
+    "vision_cfg": {
+        "image_size": 32,
+        "layers": 1,
+        "width": 32,
+        "head_width": 16,
+        "patch_size": 16,
+    },
+    "text_cfg": {
+        "context_length": 8,
+        "vocab_size": 100,
+        "width": 32,
+        "heads": 2,
+        "layers": 1,
+    },
+}
+
+
+# as stored with an hf-hub: model, with non-default interpolation and resize mode
+TINY_CLIP_PREPROCESS_CONFIG = {
+    "mean": [0.5, 0.5, 0.5],
+    "std": [0.25, 0.25, 0.25],
+    "interpolation": "bilinear",
+    "resize_mode": "squash",
+}
+
+
+def _random_pil_image():
+    """A non-square image, so that the resize mode matters."""
+    generator = np.random.default_rng(0)
+    return Image.fromarray(generator.integers(0, 256, (40, 56, 3), dtype=np.uint8))
+
+
+@pytest.fixture
+def tiny_clip_checkpoint(tmp_path):
+    """Registers the tiny-clip model config and saves a random CLIP checkpoint for it."""
+    config_dir = tmp_path / "configs"
+    config_dir.mkdir()
+    (config_dir / "tiny-clip.json").write_text(json.dumps(TINY_CLIP_CONFIG))
+    open_clip.add_model_config(config_dir)
+    torch.manual_seed(0)
+    clip = open_clip.create_model("tiny-clip")
+    checkpoint_path = tmp_path / "tiny-clip.pt"
+    torch.save(clip.state_dict(), checkpoint_path)
+    return clip, str(checkpoint_path)
+
+
+def test_vision_encoder_matches_clip_visual(tiny_clip_checkpoint):
+    clip, checkpoint_path = tiny_clip_checkpoint
+    visual, image_processor = create_vision_encoder_and_transforms(
+        "tiny-clip", checkpoint_path
+    )
+    assert all(p.device.type == "cpu" for p in visual.parameters())
+    assert visual.state_dict().keys() == clip.visual.state_dict().keys()
+    for name, tensor in clip.visual.state_dict().items():
+        assert torch.equal(visual.state_dict()[name], tensor), name
+
+    images = torch.randn(2, 3, 32, 32)
+    with torch.no_grad():
+        torch.testing.assert_close(visual(images), clip.visual(images))
+
+    _, _, clip_image_processor = open_clip.create_model_and_transforms(
+        "tiny-clip", pretrained=checkpoint_path
+    )
+    image = _random_pil_image()
+    assert torch.equal(image_processor(image), clip_image_processor(image))
+
+
+def test_hf_hub_vision_encoder_matches_clip(tmp_path, monkeypatch):
+    torch.manual_seed(0)
+    clip = open_clip.CLIP(**TINY_CLIP_CONFIG)
+    hub_dir = tmp_path / "hub"
+    hub_dir.mkdir()
+    (hub_dir / "open_clip_config.json").write_text(
+        json.dumps(
+            {
+                "model_cfg": TINY_CLIP_CONFIG,
+                "preprocess_cfg": TINY_CLIP_PREPROCESS_CONFIG,
+            }
+        )
+    )
+    torch.save(clip.state_dict(), hub_dir / "open_clip_pytorch_model.bin")
+
+    def hf_hub_download(repo_id, filename, revision=None, cache_dir=None):
+        assert repo_id == "org/tiny-clip"
+        if not (hub_dir / filename).exists():
+            raise FileNotFoundError(filename)
+        return str(hub_dir / filename)
+
+    monkeypatch.setattr(open_clip.pretrained, "hf_hub_download", hf_hub_download)
+    visual, image_processor = create_vision_encoder_and_transforms(
+        "hf-hub:org/tiny-clip", None
+    )
+    _, _, clip_image_processor = open_clip.create_model_and_transforms(
+        "hf-hub:org/tiny-clip"
+    )
+
+    for name, tensor in clip.visual.state_dict().items():
+        assert torch.equal(visual.state_dict()[name], tensor), name
+    image = _random_pil_image()
+    assert torch.equal(image_processor(image), clip_image_processor(image))
+    default_image_processor = open_clip.image_transform(32, is_train=False)
+    assert not torch.equal(image_processor(image), default_image_processor(image))
+
+
+def _create_meta_flamingo():
+    """A tiny Flamingo whose perceiver and cross attention layers are on the meta device."""
+    lang_encoder, decoder_layers_attr_name = _create_lang_encoder("opt")
+    extend_instance(lang_encoder, FlamingoLMMixin)
+    lang_encoder.set_decoder_layers_attr_name(decoder_layers_attr_name)
+    vision_encoder = nn.ModuleDict({"visual": TinyVisionEncoder()})
+    with torch.device("meta"):
+        return Flamingo(
+            vision_encoder,
+            lang_encoder,
+            eoc_token_id=EOC_TOKEN_ID,
+            media_token_id=MEDIA_TOKEN_ID,
+            vis_dim=VIS_DIM,
+        )
+
+
+def test_flamingo_checkpoint_with_missing_keys(tmp_path):
+    reference = create_tiny_flamingo()
+    missing = ("perceiver.latents", "attn_gate", "attn.to_q.weight", "ff.0.bias")
+    state_dict = {
+        k: v
+        for k, v in reference.state_dict().items()
+        if not k.endswith(missing) and not k.startswith("vision_encoder.")
+    }
+    checkpoint_path = tmp_path / "checkpoint.pt"
+    torch.save(state_dict, checkpoint_path)
+
+    model = _create_meta_flamingo()
+    with pytest.warns(UserWarning, match="missing from the Flamingo checkpoint"):
+        _load_flamingo_checkpoint(model, str(checkpoint_path))
+
+    assert not any(t.is_meta for t in model.state_dict().values())
+    loaded = model.state_dict()
+    for name, tensor in state_dict.items():
+        assert torch.equal(loaded[name], tensor), name
+    # the missing weights are initialized as in the constructors
+    assert loaded["perceiver.latents"].std() > 0
+    for layer in model.lang_encoder.gated_cross_attn_layers:
+        assert layer.attn_gate.item() == 0
+        assert torch.all(layer.ff[0].bias == 0)
+        assert layer.attn.to_q.weight.abs().max() <= layer.attn.to_q.in_features**-0.5
+
+    lang_x = random_prompt(2, 8).unsqueeze(0)
+    with torch.no_grad():
+        logits = model.eval()(random_images(1, 2), lang_x).logits
+    assert torch.isfinite(logits).all()
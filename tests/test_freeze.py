@@ -0,0 +1,38 @@
+"""
+freeze_for_inference() folds the gates, layer norms and attention scales into the weights
+without changing the outputs, with both attention implementations.
+"""
+import copy
+
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, left_pad, random_images, random_prompt
+
+
+@pytest.mark.parametrize("use_sdpa", [False, True])
+def test_frozen_model_matches_model(lm, use_sdpa):
+    model = create_tiny_flamingo(lm, use_sdpa=use_sdpa)
+    # gates other than 1, and non-trivial layer norms, so that folding them matters
+    generator = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if name.endswith("_gate") or "norm" in name:
+                param.add_(0.5 * torch.randn(param.shape, generator=generator))
+    frozen = copy.deepcopy(model).freeze_for_inference()
+
+    vision_x = random_images(2, 2)
+    lang_x, attention_mask = left_pad(
+        [random_prompt(2, 12, seed=1), random_prompt(2, 8, seed=2)]
+    )
+    with torch.no_grad():
+        expected = model(vision_x, lang_x, attention_mask=attention_mask).logits
+        output = frozen(vision_x, lang_x, attention_mask=attention_mask).logits
+    torch.testing.assert_close(output, expected, atol=1e-5, rtol=1e-5)
+
+    for layer in frozen.lang_encoder.gated_cross_attn_layers:
+        if layer is not None:
+            assert layer.attn_gate is None and layer.ff_gate is None
+            assert not layer.attn.norm.elementwise_affine
+            # the fused attention kernels apply the scale themselves
+            assert (layer.attn.scale is None) != use_sdpa
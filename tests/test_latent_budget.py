@@ -0,0 +1,160 @@
+"""
+Per-image visual token budgets (see Flamingo._reduce_vision_latents()): with a
+(num_demo_latents, num_query_latents) budget, demonstration images contribute fewer keys
+to the cross attention, but each text token attends to its image exactly as if the images
+with the smaller budget had each latent repeated to the larger one.
+"""
+import pytest
+import torch
+from einops import rearrange
+
+from conftest import (
+    create_tiny_flamingo,
+    left_pad,
+    random_images,
+    random_prompt,
+)
+from open_flamingo.src.flamingo_lm import VisionConditioning
+from open_flamingo.src.helpers import reduce_latents
+
+NUM_IMAGES = 3
+GENERATE_KWARGS = dict(max_new_tokens=6, min_new_tokens=6)
+
+
+def _inputs():
+    """Two prompts, the second with one image less: its last image is padding."""
+    vision_x = random_images(2, NUM_IMAGES)
+    vision_x_mask = torch.tensor([[True, True, True], [True, True, False]])
+    lang_x, attention_mask = left_pad(
+        [
+            random_prompt(NUM_IMAGES, 12, seed=1),
+            random_prompt(NUM_IMAGES - 1, 9, seed=2),
+        ]
+    )
+    return vision_x, vision_x_mask, lang_x, attention_mask
+
+
+def _repeated_latents_conditioning(model, vision_x, vision_x_mask, num_latents):
+    """Every image padded to the larger budget by repeating its latents."""
+    num_demo_latents, num_query_latents = num_latents
+    n = max(num_latents)
+    latents = model._get_vision_latents(vision_x, vision_x_mask=vision_x_mask)
+    demo = reduce_latents(latents, num_demo_latents).repeat_interleave(
+        n // num_demo_latents, dim=2
+    )
+    query = reduce_latents(latents, num_query_latents).repeat_interleave(
+        n // num_query_latents, dim=2
+    )
+    is_query = torch.zeros_like(vision_x_mask)
+    is_query[torch.arange(len(vision_x_mask)), vision_x_mask.sum(dim=1) - 1] = True
+    vis_x = torch.where(rearrange(is_query, "b t -> b t 1 1"), query, demo)
+    return VisionConditioning(vis_x, model._get_media_kv(vis_x))
+
+
+@pytest.mark.parametrize("num_latents", [(8, 32), (32, 8)])
+def test_ragged_budget_matches_repeated_latents(lm, num_latents):
+    model = create_tiny_flamingo(lm)
+    vision_x, vision_x_mask, lang_x, attention_mask = _inputs()
+    with torch.no_grad():
+        expected = model(
+            None,
+            lang_x,
+            attention_mask,
+            conditioning=_repeated_latents_conditioning(
+                model, vision_x, vision_x_mask, num_latents
+            ),
+        ).logits
+        conditioning = model.get_vision_conditioning(
+            vision_x, vision_x_mask=vision_x_mask, num_latents=num_latents
+        )
+        logits = model(None, lang_x, attention_mask, conditioning=conditioning).logits
+    torch.testing.assert_close(logits, expected)
+
+    # the demonstrations contribute fewer keys; the second row is padded to the first
+    num_demo_latents, num_query_latents = num_latents
+    slots, s = conditioning.vis_x.shape[1:3]
+    assert slots * s == (NUM_IMAGES - 1) * num_demo_latents + num_query_latents
+
+
+@pytest.mark.parametrize(
+    "generate_kwargs",
+    [{}, dict(num_beams=2), dict(num_beams=2, share_prompt_across_beams=True)],
+)
+def test_ragged_budget_generate_matches_repeated_latents(generate_kwargs):
+    model = create_tiny_flamingo()
+    vision_x, vision_x_mask, lang_x, attention_mask = _inputs()
+    num_latents = (8, 32)
+    with torch.no_grad():
+        expected = model.generate(
+            None,
+            lang_x,
+            attention_mask=attention_mask,
+            conditioning=_repeated_latents_conditioning(
+                model, vision_x, vision_x_mask, num_latents
+            ),
+            **generate_kwargs,
+            **GENERATE_KWARGS,
+        )
+        output = model.generate(
+            vision_x,
+            lang_x,
+            attention_mask=attention_mask,
+            vision_x_mask=vision_x_mask,
+            num_latents=num_latents,
+            **generate_kwargs,
+            **GENERATE_KWARGS,
+        )
+    assert torch.equal(output, expected)
+
+
+def test_ragged_budget_with_prefix_state(lm):
+    model = create_tiny_flamingo(lm)
+    prefix_vision_x = random_images(1, 2, seed=1)
+    prefix = random_prompt(2, 10, seed=1)
+    query_vision_x = random_images(1, 2, seed=2)
+    query = random_prompt(2, 7, seed=2)
+    num_latents = (8, 32)
+    with torch.no_grad():
+        expected = model(
+            torch.cat([prefix_vision_x, query_vision_x], dim=1),
+            torch.cat([prefix, query]).unsqueeze(0),
+            num_latents=num_latents,
+        ).logits[:, len(prefix) :]
+        prefix_state = model.get_prefix_state(
+            prefix_vision_x, prefix.unsqueeze(0), num_latents=num_latents
+        )
+        logits = model(
+            query_vision_x,
+            query.unsqueeze(0),
+            prefix_state=prefix_state,
+            num_latents=num_latents,
+        ).logits
+    torch.testing.assert_close(logits, expected)
+
+
+def test_ragged_budget_with_continuous_batching():
+    model = create_tiny_flamingo()
+    num_latents = (8, 32)
+    requests = [
+        (
+            random_images(1, num_images, seed=i),
+            random_prompt(num_images, 6 + i, seed=i).unsqueeze(0),
+        )
+        for i, num_images in enumerate([3, 1, 2, 3])
+    ]
+    with torch.no_grad():
+        expected = [
+            model.generate(vision_x, lang_x, num_latents=num_latents, **GENERATE_KWARGS)
+            for vision_x, lang_x in requests
+        ]
+    outputs = dict(
+        model.generate_continuous(
+            requests,
+            batch_size=3,
+            max_new_tokens=GENERATE_KWARGS["max_new_tokens"],
+            min_new_tokens=GENERATE_KWARGS["min_new_tokens"],
+            num_latents=num_latents,
+        )
+    )
+    for i, output in enumerate(expected):
+        assert torch.equal(outputs[i], output)
@@ -0,0 +1,125 @@
+"""
+The structured media attention masks (MediaAttentionMask, DenseMediaAttentionMask) must
+give the same cross attention as the dense mask that MaskedCrossAttention originally
+built in every forward pass.
+"""
+import pytest
+import torch
+from einops import rearrange, repeat
+from einops_exts import rearrange_many
+
+from open_flamingo.src.helpers import MaskedCrossAttention, MediaAttentionMask
+
+B, T_TXT, T_IMG, N_LATENTS = 4, 10, 3, 5
+DIM, DIM_VISUAL = 32, 16
+
+
+def reference_cross_attention(
+    attn, x, media, media_locations=None, use_cached_media=False
+):
+    """MaskedCrossAttention.forward() before the structured masks were introduced."""
+    T_txt = x.shape[1]
+    _, T_img, n = media.shape[:3]
+    h = attn.heads
+
+    x = attn.norm(x)
+    q = attn.to_q(x)
+    media = rearrange(media, "b t n d -> b (t n) d")
+    k, v = attn.to_kv(media).chunk(2, dim=-1)
+    q, k, v = rearrange_many((q, k, v), "b n (h d) -> b h n d", h=h)
+    q = q * attn.scale
+    sim = torch.einsum("... i d, ... j d -> ... i j", q, k)
+
+    if media_locations is not None:
+        media_time = torch.arange(T_img, device=x.device) + 1
+        if use_cached_media:
+            text_time = repeat(
+                torch.count_nonzero(media_locations, dim=1), "b -> b i", i=T_txt
+            )
+        else:
+            text_time = media_locations.cumsum(dim=-1)
+        mask_op = torch.eq if attn.only_attend_immediate_media else torch.ge
+        text_to_media_mask = mask_op(
+            rearrange(text_time, "b i -> b 1 i 1"),
+            repeat(media_time, "j -> 1 1 1 (j n)", n=n),
+        )
+        sim = sim.masked_fill(~text_to_media_mask, -torch.finfo(sim.dtype).max)
+
+    sim = sim - sim.amax(dim=-1, keepdim=True).detach()
+    attn_weights = sim.softmax(dim=-1)
+
+    if media_locations is not None and attn.only_attend_immediate_media:
+        text_without_media_mask = rearrange(text_time == 0, "b i -> b 1 i 1")
+        attn_weights = attn_weights.masked_fill(text_without_media_mask, 0.0)
+
+    out = torch.einsum("... i j, ... j d -> ... i d", attn_weights, v)
+    out = rearrange(out, "b h n d -> b n (h d)")
+    return attn.to_out(out)
+
+
+def _media_locations():
+    """
+    Row 0: all media used, with text before the first media.
+    Row 1: no media at all.
+    Row 2: one media; the other T_IMG - 1 media are padding.
+    Row 3: consecutive media tokens at the start.
+    """
+    media_locations = torch.zeros(B, T_TXT, dtype=torch.bool)
+    media_locations[0, [1, 4, 8]] = True
+    media_locations[2, 5] = True
+    media_locations[3, [0, 1]] = True
+    return media_locations
+
+
+@pytest.mark.parametrize("only_attend_immediate_media", [True, False])
+@pytest.mark.parametrize("use_sdpa", [False, True])
+@pytest.mark.parametrize("use_cached_media", [False, True])
+@pytest.mark.parametrize("mask_type", ["locations", "structured", "dense"])
+def test_matches_reference(
+    only_attend_immediate_media, use_sdpa, use_cached_media, mask_type
+):
+    torch.manual_seed(0)
+    attn = MaskedCrossAttention(
+        dim=DIM,
+        dim_visual=DIM_VISUAL,
+        dim_head=8,
+        heads=4,
+        only_attend_immediate_media=only_attend_immediate_media,
+        use_sdpa=use_sdpa,
+    ).eval()
+    x = torch.randn(B, T_TXT, DIM)
+    media = torch.randn(B, T_IMG, N_LATENTS, DIM_VISUAL)
+    media_locations = _media_locations()
+
+    kwargs = dict(media_locations=media_locations, use_cached_media=use_cached_media)
+    with torch.no_grad():
+        expected = reference_cross_attention(attn, x, media, **kwargs)
+    if mask_type != "locations":
+        mask = MediaAttentionMask(
+            media_locations,
+            T_IMG,
+            N_LATENTS,
+            use_cached_media=use_cached_media,
+            T_txt=T_TXT,
+        )
+        if mask_type == "dense":
+            mask = mask.to_dense(only_attend_immediate_media)
+        kwargs["media_attention_mask"] = mask
+
+    with torch.no_grad():
+        out = attn(x, media, **kwargs)
+    torch.testing.assert_close(out, expected)
+
+
+@pytest.mark.parametrize("use_sdpa", [False, True])
+def test_without_media_locations_matches_reference(use_sdpa):
+    torch.manual_seed(0)
+    attn = MaskedCrossAttention(
+        dim=DIM, dim_visual=DIM_VISUAL, dim_head=8, heads=4, use_sdpa=use_sdpa
+    ).eval()
+    x = torch.randn(B, T_TXT, DIM)
+    media = torch.randn(B, T_IMG, N_LATENTS, DIM_VISUAL)
+    with torch.no_grad():
+        torch.testing.assert_close(
+            attn(x, media), reference_cross_attention(attn, x, media)
+        )
@@ -0,0 +1,72 @@
+"""
+The media cache returns the perceiver outputs of an uncached forward, encodes each
+missing image once and evicts the least recently used images over its budget.
+"""
+import torch
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src.media_cache import MediaCache
+
+
+def _latent_bytes(model):
+    latents = model._get_media_latents(random_images(1, 1))[0, 0]
+    return latents.numel() * latents.element_size()
+
+
+def _forward(model, vision_x, **kwargs):
+    lang_x = random_prompt(vision_x.shape[1], 12).expand(vision_x.shape[0], -1)
+    with torch.no_grad():
+        return model(vision_x, lang_x, **kwargs).logits
+
+
+def test_cached_forward_matches_uncached():
+    model = create_tiny_flamingo()
+    images = random_images(2, 2)
+    # the first image of the second row repeats the first image of the batch
+    images[1, 0] = images[0, 0]
+    expected = _forward(model, images)
+
+    model.enable_media_cache(max_bytes=2**20)
+    torch.testing.assert_close(_forward(model, images), expected)
+    # 3 distinct images, each encoded once
+    assert model.media_cache.stats()["misses"] == 3
+    assert len(model.media_cache) == 3
+
+    torch.testing.assert_close(_forward(model, images), expected)
+    assert model.media_cache.hits == 3
+    assert model.media_cache.misses == 3
+
+
+def test_media_ids_key_the_cache():
+    model = create_tiny_flamingo()
+    images = random_images(1, 2)
+    expected = _forward(model, images)
+    model.enable_media_cache(max_bytes=2**20)
+    _forward(model, images, media_ids=[["a", "b"]])
+    # the ids, not the pixels, are looked up
+    output = _forward(model, random_images(1, 2, seed=1), media_ids=[["a", "b"]])
+    torch.testing.assert_close(output, expected)
+    assert ("id", "a") in model.media_cache and model.media_cache.hits == 2
+
+
+def test_least_recently_used_images_are_evicted():
+    model = create_tiny_flamingo()
+    model.enable_media_cache(max_bytes=2 * _latent_bytes(model))
+    a, b, c = (random_images(1, 1, seed=seed) for seed in range(3))
+    keys = {
+        name: MediaCache.get_key(image[0, 0]) for name, image in zip("abc", (a, b, c))
+    }
+    _forward(model, a)
+    _forward(model, b)
+    _forward(model, a)  # a is now more recently used than b
+    _forward(model, c)
+    assert keys["a"] in model.media_cache and keys["c"] in model.media_cache
+    assert keys["b"] not in model.media_cache
+    assert model.media_cache.num_bytes <= model.media_cache.max_bytes
+
+    # an evicted image is encoded again, to the outputs of an uncached forward
+    misses = model.media_cache.misses
+    output = _forward(model, b)
+    assert model.media_cache.misses == misses + 1
+    model.disable_media_cache()
+    torch.testing.assert_close(output, _forward(model, b))
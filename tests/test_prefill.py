@@ -0,0 +1,84 @@
+"""
+Chunked prefill and prefix states on left-padded batches: the padding gets no positions,
+so the scores of the generated tokens match plain generate() on the same prompts.
+"""
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, left_pad, random_images, random_prompt
+
+MAX_NEW_TOKENS = 6
+GENERATE_KWARGS = dict(
+    max_new_tokens=MAX_NEW_TOKENS,
+    min_new_tokens=MAX_NEW_TOKENS,
+    output_scores=True,
+    return_dict_in_generate=True,
+)
+
+
+def _assert_same_generation(output, expected, num_new_tokens=None):
+    if num_new_tokens is None:
+        assert torch.equal(output.sequences, expected.sequences)
+    else:
+        # with a prefix state, the sequences do not include the prefix
+        assert torch.equal(
+            output.sequences[:, -num_new_tokens:],
+            expected.sequences[:, -num_new_tokens:],
+        )
+    for scores, expected_scores in zip(output.scores, expected.scores):
+        torch.testing.assert_close(scores, expected_scores)
+
+
+@pytest.mark.parametrize("num_beams", [1, 2])
+def test_chunked_prefill_matches_generate(lm, num_beams):
+    model = create_tiny_flamingo(lm)
+    vision_x = random_images(2, 2)
+    lang_x, attention_mask = left_pad(
+        [random_prompt(2, 15, seed=1), random_prompt(2, 8, seed=2)]
+    )
+    with torch.no_grad():
+        expected = model.generate(
+            vision_x,
+            lang_x,
+            attention_mask=attention_mask,
+            num_beams=num_beams,
+            **GENERATE_KWARGS,
+        )
+        output = model.generate(
+            vision_x,
+            lang_x,
+            attention_mask=attention_mask,
+            num_beams=num_beams,
+            prefill_chunk_size=4,
+            **GENERATE_KWARGS,
+        )
+    _assert_same_generation(output, expected)
+
+
+def test_prefix_state_with_padded_queries_matches_generate(lm):
+    model = create_tiny_flamingo(lm)
+    prefix_vision_x = random_images(1, 2, seed=1)
+    prefix = random_prompt(2, 10, seed=1)
+    query_vision_x = random_images(2, 1, seed=2)
+    queries = [random_prompt(1, 7, seed=2), random_prompt(1, 4, seed=3)]
+    # the prefix followed by each query, left-padded
+    lang_x, attention_mask = left_pad([torch.cat([prefix, query]) for query in queries])
+    query_lang_x, query_attention_mask = left_pad(queries)
+    with torch.no_grad():
+        expected = model.generate(
+            torch.cat(
+                [prefix_vision_x.expand(2, -1, -1, -1, -1, -1), query_vision_x], 1
+            ),
+            lang_x,
+            attention_mask=attention_mask,
+            **GENERATE_KWARGS,
+        )
+        prefix_state = model.get_prefix_state(prefix_vision_x, prefix.unsqueeze(0))
+        output = model.generate(
+            query_vision_x,
+            query_lang_x,
+            attention_mask=query_attention_mask,
+            prefix_state=prefix_state,
+            **GENERATE_KWARGS,
+        )
+    _assert_same_generation(output, expected, num_new_tokens=MAX_NEW_TOKENS)
@@ -0,0 +1,45 @@
+"""
+Profiling records every profiled module without changing the model's outputs, and leaves
+no hooks behind.
+"""
+import json
+
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src.profiler import CATEGORIES
+
+
+def _generate(model):
+    vision_x = random_images(1, 2)
+    lang_x = random_prompt(2, 12).unsqueeze(0)
+    with torch.no_grad():
+        return model.generate(vision_x, lang_x, max_new_tokens=4, min_new_tokens=4)
+
+
+def test_profile_returns_summary_without_changing_outputs(lm, tmp_path):
+    model = create_tiny_flamingo(lm)
+    expected = _generate(model)
+    with model.profile() as profiler:
+        output = _generate(model)
+    assert torch.equal(output, expected)
+    assert not any(
+        module._forward_hooks or module._forward_pre_hooks for module in model.modules()
+    )
+
+    summary = profiler.summary()
+    assert set(summary["categories"]) == set(CATEGORIES)
+    num_layers = len(model.lang_encoder._get_decoder_layers())
+    # the prompt, then one forward pass per generated token but the last
+    assert summary["categories"]["decoder_layer"]["calls"] == 4 * num_layers
+    assert summary["categories"]["vision_encoder"]["calls"] == 1
+    for stats in summary["categories"].values():
+        assert stats["time"] >= 0 and stats["flops"] > 0
+    assert summary["total"]["calls"] == len(profiler.events)
+    time_shares = [stats["time_share"] for stats in summary["categories"].values()]
+    assert sum(time_shares) == pytest.approx(1.0)
+
+    profiler.save_chrome_trace(str(tmp_path / "trace.json"))
+    with open(tmp_path / "trace.json") as f:
+        assert len(json.load(f)["traceEvents"]) == len(profiler.events)
@@ -0,0 +1,80 @@
+import copy
+
+import pytest
+import torch
+from torch import nn
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src import helpers
+from open_flamingo.src.factory import quantize_model
+from open_flamingo.src.helpers import Int8WeightOnlyLinear
+
+
+def _reference_weight_int8pack_mm(x, weight, scales):
+    """torch._weight_int8pack_mm, for torch versions without it."""
+    return nn.functional.linear(x, weight.to(x.dtype)) * scales
+
+
+@pytest.mark.parametrize("bias", [True, False])
+@pytest.mark.parametrize("dequant_block_numel", [2**22, 24 * 16, 1])
+def test_int8_weight_only_linear_matches_dequantized_weight(bias, dequant_block_numel):
+    torch.manual_seed(0)
+    linear = nn.Linear(24, 40, bias=bias)
+    quantized = Int8WeightOnlyLinear.from_float(linear)
+    quantized.dequant_block_numel = dequant_block_numel
+    x = torch.randn(2, 3, 24)
+    weight = quantized.weight.float() * quantized.weight_scale
+    expected = nn.functional.linear(x, weight, quantized.bias)
+    with torch.no_grad():
+        torch.testing.assert_close(quantized(x), expected)
+        # quantization error is at most half a step per weight
+        torch.testing.assert_close(quantized(x), linear(x), atol=0.05, rtol=0)
+
+
+@pytest.mark.parametrize("branch", ["int8pack_mm", "dequantize", "blocked"])
+def test_int8_weight_only_linear_branches_match_linear(branch, monkeypatch):
+    torch.manual_seed(0)
+    linear = nn.Linear(32, 40)
+    quantized = Int8WeightOnlyLinear.from_float(linear)
+    if branch == "int8pack_mm":
+        monkeypatch.setattr(helpers, "_HAS_WEIGHT_INT8PACK_MM", True)
+        if not hasattr(torch, "_weight_int8pack_mm"):
+            monkeypatch.setattr(
+                torch,
+                "_weight_int8pack_mm",
+                _reference_weight_int8pack_mm,
+                raising=False,
+            )
+    else:
+        monkeypatch.setattr(helpers, "_HAS_WEIGHT_INT8PACK_MM", False)
+        if branch == "blocked":
+            # 3 blocks of 16, 16 and 8 output channels
+            quantized.dequant_block_numel = 16 * 32
+    x = torch.randn(2, 3, 32)
+    with torch.no_grad():
+        torch.testing.assert_close(quantized(x), linear(x), atol=0.05, rtol=0)
+
+
+@pytest.mark.parametrize("weight_only", [False, True])
+def test_quantized_model_matches_model(lm, weight_only):
+    model = create_tiny_flamingo(lm)
+    quantized = quantize_model(copy.deepcopy(model), weight_only=weight_only)
+
+    quantized_type = (
+        Int8WeightOnlyLinear if weight_only else torch.ao.nn.quantized.dynamic.Linear
+    )
+    # the tiny vision encoder has no linear layers
+    modules = [quantized.perceiver]
+    modules += list(quantized.lang_encoder._get_decoder_layers())
+    for module in modules:
+        assert not any(type(m) is nn.Linear for m in module.modules())
+        assert any(isinstance(m, quantized_type) for m in module.modules())
+    # the LM head is kept in full precision
+    assert type(quantized.lang_encoder.get_output_embeddings()) is nn.Linear
+
+    vision_x = random_images(1, 2)
+    lang_x = random_prompt(2, 12).unsqueeze(0)
+    with torch.no_grad():
+        expected = model(vision_x, lang_x).logits
+        output = quantized(vision_x, lang_x).logits
+    torch.testing.assert_close(output, expected, atol=0.05, rtol=0)
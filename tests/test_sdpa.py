@@ -0,0 +1,85 @@
+"""
+The scaled_dot_product_attention backend (use_sdpa=True) must match the einsum
+implementation in the perceiver, the cross attention and the whole model.
+"""
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, left_pad, random_images, random_prompt
+from open_flamingo.src.helpers import MaskedCrossAttention, PerceiverResampler
+
+B, T_TXT, T_IMG, N_LATENTS = 3, 12, 4, 5
+DIM, DIM_VISUAL = 32, 16
+
+
+def _set_use_sdpa(module, use_sdpa):
+    for submodule in module.modules():
+        if hasattr(submodule, "use_sdpa"):
+            submodule.use_sdpa = use_sdpa
+
+
+def _media_locations():
+    """
+    Row 0: media spread over the text, with text before the first media.
+    Row 1: no media at all.
+    Row 2: a single media at the start; the other T_IMG - 1 media are padding.
+    """
+    media_locations = torch.zeros(B, T_TXT, dtype=torch.bool)
+    media_locations[0, [2, 3, 7, 10]] = True
+    media_locations[2, 0] = True
+    return media_locations
+
+
+def test_perceiver_sdpa_matches_einsum():
+    torch.manual_seed(0)
+    perceiver = PerceiverResampler(
+        dim=DIM_VISUAL, depth=2, dim_head=8, heads=2, num_latents=N_LATENTS
+    ).eval()
+    x = torch.randn(2, T_IMG, 1, 7, DIM_VISUAL)
+    with torch.no_grad():
+        expected = perceiver(x)
+        _set_use_sdpa(perceiver, True)
+        output = perceiver(x)
+    torch.testing.assert_close(output, expected)
+
+
+@pytest.mark.parametrize("only_attend_immediate_media", [True, False])
+@pytest.mark.parametrize("use_cached_media", [False, True])
+def test_cross_attention_sdpa_matches_einsum(
+    only_attend_immediate_media, use_cached_media
+):
+    torch.manual_seed(0)
+    attn = MaskedCrossAttention(
+        dim=DIM,
+        dim_visual=DIM_VISUAL,
+        dim_head=8,
+        heads=4,
+        only_attend_immediate_media=only_attend_immediate_media,
+    ).eval()
+    x = torch.randn(B, T_TXT, DIM)
+    media = torch.randn(B, T_IMG, N_LATENTS, DIM_VISUAL)
+    kwargs = dict(media_locations=_media_locations(), use_cached_media=use_cached_media)
+    with torch.no_grad():
+        expected = attn(x, media, **kwargs)
+        _set_use_sdpa(attn, True)
+        output = attn(x, media, **kwargs)
+    torch.testing.assert_close(output, expected)
+
+
+def test_model_sdpa_matches_einsum(lm):
+    model = create_tiny_flamingo(lm)
+    sdpa_model = create_tiny_flamingo(lm, use_sdpa=True)
+    vision_x = random_images(2, 2)
+    lang_x, attention_mask = left_pad(
+        [random_prompt(2, 12, seed=1), random_prompt(2, 8, seed=2)]
+    )
+    with torch.no_grad():
+        expected = model(vision_x, lang_x, attention_mask=attention_mask).logits
+        output = sdpa_model(vision_x, lang_x, attention_mask=attention_mask).logits
+        torch.testing.assert_close(output, expected)
+        # decoding attends to the cached media
+        kwargs = dict(attention_mask=attention_mask, max_new_tokens=6, min_new_tokens=6)
+        assert torch.equal(
+            sdpa_model.generate(vision_x, lang_x, **kwargs),
+            model.generate(vision_x, lang_x, **kwargs),
+        )
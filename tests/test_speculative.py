@@ -0,0 +1,98 @@
+"""
+Speculative decoding on left-padded batches: the generated sequences are exactly those of
+plain greedy decoding, whatever the draft model proposes.
+"""
+import pytest
+import torch
+
+from conftest import create_tiny_flamingo, left_pad, random_images, random_prompt
+from open_flamingo.src.speculative import SpeculativeDecodingStats
+
+MAX_NEW_TOKENS = 10
+# the tiny models' logits are close, so that a slightly perturbed copy of the model has
+# some of its draft tokens accepted and some rejected
+DRAFT_NOISE = 0.003
+
+
+def _create_draft(lm, noise):
+    """A copy of create_tiny_flamingo(lm) with noise added to its language model."""
+    draft = create_tiny_flamingo(lm)
+    generator = torch.Generator().manual_seed(0)
+    with torch.no_grad():
+        for param in draft.lang_encoder.parameters():
+            param.add_(torch.randn(param.shape, generator=generator) * noise)
+    return draft
+
+
+def _generate(model, **kwargs):
+    vision_x = random_images(2, 2)
+    lang_x, attention_mask = left_pad(
+        [random_prompt(2, 12, seed=1), random_prompt(2, 8, seed=2)]
+    )
+    with torch.no_grad():
+        return model.generate(
+            vision_x,
+            lang_x,
+            attention_mask=attention_mask,
+            max_new_tokens=MAX_NEW_TOKENS,
+            **kwargs,
+        )
+
+
+@pytest.mark.parametrize("draft_noise", [None, DRAFT_NOISE, 0.01])
+@pytest.mark.parametrize("num_draft_tokens", [1, 3])
+@pytest.mark.parametrize("min_new_tokens", [0, MAX_NEW_TOKENS])
+def test_speculative_matches_greedy(lm, draft_noise, num_draft_tokens, min_new_tokens):
+    model = create_tiny_flamingo(lm)
+    if draft_noise is None:
+        # an unrelated draft model, whose tokens are rejected
+        draft = create_tiny_flamingo(lm, seed=1)
+    else:
+        draft = _create_draft(lm, draft_noise)
+    expected = _generate(model, min_new_tokens=min_new_tokens)
+    output = _generate(
+        model,
+        min_new_tokens=min_new_tokens,
+        draft_model=draft,
+        num_draft_tokens=num_draft_tokens,
+    )
+    assert torch.equal(output, expected)
+
+
+def test_speculative_stats():
+    model = create_tiny_flamingo()
+    stats = SpeculativeDecodingStats()
+    expected = _generate(model, min_new_tokens=MAX_NEW_TOKENS)
+    output = _generate(
+        model,
+        min_new_tokens=MAX_NEW_TOKENS,
+        draft_model=_create_draft("opt", DRAFT_NOISE),
+        num_draft_tokens=3,
+        speculative_stats=stats,
+    )
+    assert torch.equal(output, expected)
+    assert stats.num_generated_tokens == MAX_NEW_TOKENS
+    # some of the draft tokens are accepted and some rejected
+    assert 0 < stats.num_accepted_tokens < stats.num_draft_tokens
+    assert stats.acceptance_rate == stats.num_accepted_tokens / stats.num_draft_tokens
+    # each step after the prefill generates its accepted draft tokens and one more
+    assert stats.num_generated_tokens == stats.num_steps + stats.num_accepted_tokens
+    assert stats.tokens_per_step == stats.num_generated_tokens / stats.num_steps
+
+
+def test_identical_draft_accepts_every_token(lm):
+    model = create_tiny_flamingo(lm)
+    stats = SpeculativeDecodingStats()
+    expected = _generate(model, min_new_tokens=MAX_NEW_TOKENS)
+    output = _generate(
+        model,
+        min_new_tokens=MAX_NEW_TOKENS,
+        draft_model=_create_draft(lm, 0.0),
+        num_draft_tokens=3,
+        speculative_stats=stats,
+    )
+    assert torch.equal(output, expected)
+    assert stats.acceptance_rate == 1.0
+    # the prefill, then 3 accepted draft tokens and the target's next token per step
+    assert stats.num_steps == 4
+    assert stats.num_generated_tokens == MAX_NEW_TOKENS
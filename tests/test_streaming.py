@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src.streaming import start_generation_thread
+
+MAX_NEW_TOKENS = 40
+
+
+class CountCalls(StoppingCriteria):
+    """Counts the generated tokens, slowing generation down so that the consumer keeps up."""
+
+    def __init__(self):
+        self.num_calls = 0
+
+    def __call__(self, input_ids, scores, **kwargs):
+        self.num_calls += 1
+        time.sleep(0.01)
+        return False
+
+
+def _inputs():
+    return random_images(1, 2), random_prompt(2, 8).unsqueeze(0)
+
+
+def _generate_kwargs(counter):
+    # min_new_tokens keeps the model from stopping early on <|endofchunk|>
+    return dict(
+        max_new_tokens=MAX_NEW_TOKENS,
+        min_new_tokens=MAX_NEW_TOKENS,
+        stopping_criteria=StoppingCriteriaList([counter]),
+    )
+
+
+def _assert_released(model, counter):
+    # the generation thread has finished soon after the consumer stopped
+    assert counter.num_calls < MAX_NEW_TOKENS // 2
+    assert threading.active_count() == 1
+    assert not any(
+        layer.is_conditioned() for layer in model.lang_encoder._get_decoder_layers()
+    )
+
+
+def test_generate_stream_matches_generate():
+    model = create_tiny_flamingo()
+    vision_x, lang_x = _inputs()
+    with torch.no_grad():
+        expected = model.generate(
+            vision_x, lang_x, max_new_tokens=10, min_new_tokens=10
+        )
+    tokens = list(
+        model.generate_stream(vision_x, lang_x, max_new_tokens=10, min_new_tokens=10)
+    )
+    assert tokens == expected[0, lang_x.shape[1] :].tolist()
+
+
+def test_generate_stream_stops_when_closed():
+    model = create_tiny_flamingo()
+    vision_x, lang_x = _inputs()
+    counter = CountCalls()
+    stream = model.generate_stream(vision_x, lang_x, **_generate_kwargs(counter))
+    for _ in range(3):
+        next(stream)
+    stream.close()
+    _assert_released(model, counter)
+
+
+def test_agenerate_stream_stops_when_closed():
+    model = create_tiny_flamingo()
+    vision_x, lang_x = _inputs()
+    counter = CountCalls()
+
+    async def consume():
+        stream = model.agenerate_stream(vision_x, lang_x, **_generate_kwargs(counter))
+        for _ in range(3):
+            await stream.__anext__()
+        await stream.aclose()
+
+    asyncio.run(consume())
+    _assert_released(model, counter)
+
+
+def test_agenerate_stream_stops_when_cancelled():
+    model = create_tiny_flamingo()
+    vision_x, lang_x = _inputs()
+    counter = CountCalls()
+    consumed = []
+
+    async def consume():
+        async for token in model.agenerate_stream(
+            vision_x, lang_x, **_generate_kwargs(counter)
+        ):
+            consumed.append(token)
+            await asyncio.sleep(3600)
+
+    async def cancel_after_first_token():
+        task = asyncio.create_task(consume())
+        while not consumed:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(cancel_after_first_token())
+    _assert_released(model, counter)
+
+
+def test_generation_thread_carries_cpu_autocast():
+    seen = {}
+
+    def generate_fn(streamer, stopping_criteria):
+        seen["enabled"] = torch.is_autocast_cpu_enabled()
+        seen["dtype"] = torch.get_autocast_cpu_dtype()
+
+    with torch.autocast("cpu", dtype=torch.bfloat16):
+        thread, _ = start_generation_thread(generate_fn, lambda item: None)
+    thread.join()
+    assert seen == {"enabled": True, "dtype": torch.bfloat16}
@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from conftest import create_tiny_flamingo, random_images, random_prompt
+
+GENERATE_KWARGS = dict(max_new_tokens=8, min_new_tokens=8)
+
+
+def _requests(num_requests):
+    """(vision_x, lang_x) pairs of batch size 1, with different images and prompts."""
+    return [
+        (
+            random_images(1, 2, seed=i),
+            random_prompt(2, 6 + i, seed=i).unsqueeze(0),
+        )
+        for i in range(num_requests)
+    ]
+
+
+def test_conditioned_generate_matches_generate(lm):
+    model = create_tiny_flamingo(lm)
+    vision_x, lang_x = _requests(1)[0]
+    with torch.no_grad():
+        expected = model.generate(vision_x, lang_x, **GENERATE_KWARGS)
+        conditioning = model.get_vision_conditioning(vision_x)
+        output = model.generate(
+            None, lang_x, conditioning=conditioning, **GENERATE_KWARGS
+        )
+    assert torch.equal(output, expected)
+
+
+def test_conditioning_is_not_modified():
+    model = create_tiny_flamingo()
+    vision_x, lang_x = _requests(1)[0]
+    with torch.no_grad():
+        conditioning = model.get_vision_conditioning(vision_x)
+        model.generate(None, lang_x, conditioning=conditioning, **GENERATE_KWARGS)
+        model(None, lang_x, conditioning=conditioning)
+    assert conditioning.media_locations is None
+    assert conditioning.media_attention_mask is None
+    assert not conditioning.use_cached_media
+
+
+def test_concurrent_generate_matches_sequential():
+    model = create_tiny_flamingo()
+    requests = _requests(8)
+
+    def generate(request):
+        vision_x, lang_x = request
+        with torch.no_grad():
+            conditioning = model.get_vision_conditioning(vision_x)
+            return model.generate(
+                None, lang_x, conditioning=conditioning, **GENERATE_KWARGS
+            )
+
+    expected = [generate(request) for request in requests]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(generate, requests * 4))
+    for i, output in enumerate(outputs):
+        assert torch.equal(output, expected[i % len(requests)])
+
+
+def test_concurrent_calls_share_one_conditioning():
+    model = create_tiny_flamingo()
+    vision_x = random_images(1, 2)
+    prompts = [random_prompt(2, 6 + i, seed=i).unsqueeze(0) for i in range(4)]
+    with torch.no_grad():
+        conditioning = model.get_vision_conditioning(vision_x)
+
+    def generate(lang_x):
+        with torch.no_grad():
+            return model.generate(
+                None, lang_x, conditioning=conditioning, **GENERATE_KWARGS
+            )
+
+    expected = [generate(lang_x) for lang_x in prompts]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        outputs = list(executor.map(generate, prompts * 4))
+    for i, output in enumerate(outputs):
+        assert torch.equal(output, expected[i % len(prompts)])
+
+
+def test_conditioning_survives_skipping_cross_attn_layers():
+    model = create_tiny_flamingo(cross_attn_every_n_layers=1)
+    vision_x, lang_x = _requests(1)[0]
+    with torch.no_grad():
+        conditioning = model.get_vision_conditioning(vision_x)
+        model.skip_cross_attn_layers(num_layers=1)
+        expected = model.generate(vision_x, lang_x, **GENERATE_KWARGS)
+        output = model.generate(
+            None, lang_x, conditioning=conditioning, **GENERATE_KWARGS
+        )
+    assert torch.equal(output, expected)
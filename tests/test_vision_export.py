@@ -0,0 +1,43 @@
+"""
+The exported vision encoder and perceiver against the model: the same latents, and the
+same language model logits when conditioning on the exported latents.
+"""
+import pytest
+import torch
+
+from conftest import IMAGE_SIZE, create_tiny_flamingo, random_images, random_prompt
+from open_flamingo.src.vision_export import ExportedVisionEncoder, export_vision_encoder
+
+ATOL = 1e-5
+
+
+@pytest.mark.parametrize("freeze", [False, True])
+@pytest.mark.parametrize("format", ["torchscript", "onnx"])
+def test_exported_latents_match_model(tmp_path, format, freeze):
+    if format == "onnx":
+        pytest.importorskip("onnx")
+        pytest.importorskip("onnxruntime")
+    model = create_tiny_flamingo()
+    if freeze:
+        model.freeze_for_inference()
+    num_params = sum(param.numel() for param in model.parameters())
+    path = str(tmp_path / ("vision_encoder.onnx" if format == "onnx" else "vision.pt"))
+    export_vision_encoder(model, path, format=format, image_size=IMAGE_SIZE)
+    # exporting leaves the model as it was
+    assert sum(param.numel() for param in model.parameters()) == num_params
+    exported = ExportedVisionEncoder(path)
+
+    # a different number of images than the example the graph was traced with
+    vision_x = random_images(1, 3)
+    lang_x = random_prompt(3, 24).unsqueeze(0)
+    with torch.no_grad():
+        latents = model._get_media_latents(vision_x)
+        exported_latents = exported.encode_vision_x(vision_x)
+        logits = model(vision_x, lang_x).logits
+        exported_logits = model(
+            None,
+            lang_x,
+            conditioning=model.get_vision_conditioning_from_latents(exported_latents),
+        ).logits
+    torch.testing.assert_close(exported_latents, latents, atol=ATOL, rtol=0)
+    torch.testing.assert_close(exported_logits, logits, atol=ATOL, rtol=0)